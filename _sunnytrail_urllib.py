@@ -346,9 +346,7 @@ class URLopener:
         if auth: h.putheader('Authorization', 'Basic %s' % auth)
         if realhost: h.putheader('Host', realhost)
         for args in self.addheaders: h.putheader(*args)
-        h.endheaders()
-        if data is not None:
-            h.send(data)
+        _end_request(h, data)
         errcode, errmsg, headers = h.getreply()
         fp = h.getfile()
         if errcode == -1:
@@ -441,9 +439,7 @@ class URLopener:
             if auth: h.putheader('Authorization', 'Basic %s' % auth)
             if realhost: h.putheader('Host', realhost)
             for args in self.addheaders: h.putheader(*args)
-            h.endheaders()
-            if data is not None:
-                h.send(data)
+            _end_request(h, data)
             errcode, errmsg, headers = h.getreply()
             fp = h.getfile()
             if errcode == -1:
@@ -996,6 +992,17 @@ class addinfourl(addbase):
         return self.url
 
 
+def _end_request(h, data):
+    """Send the buffered request headers and the body. Python 2.7 sends
+    both in a single write, so that Nagle's algorithm does not hold back
+    a small body until the headers are acknowledged."""
+    if data is not None and sys.version_info >= (2, 7):
+        h.endheaders(data)
+        return
+    h.endheaders()
+    if data is not None:
+        h.send(data)
+
 # Utilities to parse URLs (most of these return None for missing parts):
 # unwrap('<URL:type://host/path>') --> 'type://host/path'
 # splittype('type:opaquestring') --> 'type', 'opaquestring'
@@ -1192,6 +1199,25 @@ always_safe = ('ABCDEFGHIJKLMNOPQRSTUVWXYZ'
                'abcdefghijklmnopqrstuvwxyz'
                '0123456789' '_.-')
 _safemaps = {}
+_safechars = {}
+_identity = string.maketrans('', '')
+
+# above this many distinct characters to escape, one str.replace() pass
+# per character costs more than mapping every character
+_MAX_REPLACE_PASSES = 24
+
+def _safe_map(safe):
+    cachekey = (safe, always_safe)
+    try:
+        return _safemaps[cachekey]
+    except KeyError:
+        safe += always_safe
+        safe_map = {}
+        for i in range(256):
+            c = chr(i)
+            safe_map[c] = (c in safe) and c or ('%%%02X' % i)
+        _safemaps[cachekey] = safe_map
+        return safe_map
 
 def quote(s, safe = '/'):
     """quote('abc def') -> 'abc%20def'
@@ -1214,18 +1240,35 @@ def quote(s, safe = '/'):
     called on a path where the existing slash characters are used as
     reserved characters.
     """
-    cachekey = (safe, always_safe)
+    if not isinstance(s, str):
+        return _quote_map(s, safe)
+
+    # the characters to escape, found at C speed
     try:
-        safe_map = _safemaps[cachekey]
+        unsafe = s.translate(_identity, _safechars[safe])
     except KeyError:
-        safe += always_safe
-        safe_map = {}
-        for i in range(256):
-            c = chr(i)
-            safe_map[c] = (c in safe) and c or ('%%%02X' % i)
-        _safemaps[cachekey] = safe_map
-    res = map(safe_map.__getitem__, s)
-    return ''.join(res)
+        _safechars[safe] = safe + always_safe
+        unsafe = s.translate(_identity, _safechars[safe])
+    if not unsafe:
+        return s
+
+    unsafe = set(unsafe)
+    if len(unsafe) > _MAX_REPLACE_PASSES:
+        return _quote_map(s, safe)
+
+    # escape '%' first: the other escapes introduce it
+    safe_map = _safe_map(safe)
+    if '%' in unsafe:
+        s = s.replace('%', '%25')
+        unsafe.discard('%')
+    for c in unsafe:
+        s = s.replace(c, safe_map[c])
+    return s
+
+def _quote_map(s, safe = '/'):
+    """quote() mapping every character, for unicode strings and
+    strings with many different characters to escape"""
+    return ''.join(map(_safe_map(safe).__getitem__, s))
 
 def quote_plus(s, safe = ''):
     """Quote the query fragment of a URL; replacing ' ' with '+'"""
@@ -1268,9 +1311,9 @@ def urlencode(query,doseq=0):
     if not doseq:
         # preserve old behavior
         for k, v in query:
-            k = quote_plus(str(k))
-            v = quote_plus(str(v))
-            l.append(k + '=' + v)
+            if type(k) is not str: k = str(k)
+            if type(v) is not str: v = str(v)
+            l.append(quote_plus(k) + '=' + quote_plus(v))
     else:
         for k, v in query:
             k = quote_plus(str(k))
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+""" Sunnytrail client benchmarks
+
+Usage:
+
+  ./benchmark.py memory --count=100000
+  ./benchmark.py compression --count=10000
+  ./benchmark.py bodies --count=10000
+  ./benchmark.py quote --count=1000
+  ./benchmark.py preamble --count=100000
+
+The suite measures the hot paths of the client and prints the results
+as JSON, to compare releases. Sends go to http_serve.py on localhost,
+so it runs offline:
+
+  ./benchmark.py suite --count=10000 > new.json
+  ./benchmark.py compare old.json new.json
+
+"""
+
+import os
+import sys
+import gc
+import time
+import socket
+import platform
+import subprocess
+import simplejson
+
+import sunnytrail
+import _sunnytrail_urllib
+
+from optparse import OptionParser
+
+# the classes as they were before __slots__: their constructors are
+# unchanged, only the attributes went from an instance __dict__ to slots
+class LegacyEvent(object):
+  __init__ = sunnytrail.Event.__init__.im_func
+
+class LegacyPlan(object):
+  __init__ = sunnytrail.Plan.__init__.im_func
+
+class LegacyAction(object):
+  __init__ = sunnytrail.Action.__init__.im_func
+
+def legacy_event(i):
+  return LegacyEvent(str(i), 'User %d' % i, 'user%d@example.com' % i,
+    LegacyAction('signup', 1300000000 + i), LegacyPlan('Basic', 9.99, 30))
+
+def slotted_event(i):
+  return sunnytrail.SignupEvent(str(i), 'User %d' % i,
+    'user%d@example.com' % i, sunnytrail.Plan('Basic', 9.99, 30),
+    1300000000 + i)
+
+def deep_size(objects):
+  """ Bytes used by objects and everything they reference, counting
+  shared objects once """
+  seen, size = set(), 0
+  stack = list(objects)
+
+  while stack:
+    obj = stack.pop()
+    if id(obj) in seen: continue
+    seen.add(id(obj))
+    size += sys.getsizeof(obj)
+
+    if isinstance(obj, dict):
+      stack.extend(obj.values())
+    elif hasattr(obj, '__dict__'):
+      stack.append(obj.__dict__)
+
+    for cls in type(obj).__mro__:
+      for slot in cls.__dict__.get('__slots__', ()):
+        if hasattr(obj, slot):
+          stack.append(getattr(obj, slot))
+
+  return size
+
+def bench_memory(count):
+  """ Bytes per buffered signup event, with and without __slots__ """
+  results = {}
+  for name, factory in (('dict', legacy_event), ('slots', slotted_event)):
+    gc.collect()
+    events = [factory(i) for i in xrange(count)]
+    results[name] = deep_size(events) / float(count)
+  return results
+
+def single_bodies(count):
+  """ Form encoded bodies of single signup events, with a few plan
+  names and email domains """
+  plans = [sunnytrail.Plan(name, price, 30) for name, price in
+    (('Basic', 9.99), ('Premium', 19.99), ('Enterprise', 99.0))]
+  return [sunnytrail.urlencode({'message': sunnytrail.SignupEvent(
+    str(i), 'User %d' % i, 'user%d@example.com' % i, plans[i % 3], 
+    1300000000 + i).to_json()}) for i in xrange(count)]
+
+def bench_compression(count):
+  """ Bytes and CPU seconds per single event body for each encoding """
+  bodies = single_bodies(count)
+  dictionary = sunnytrail.PresetDictionary(
+    ['Basic', 'Premium', 'Enterprise', '@example.com'])
+  dictionary.compress('') # prime outside of the timing
+
+  encoders = (
+    ('plain', lambda body: body),
+    ('gzip', lambda body: sunnytrail._compress(body, 'gzip', 6)),
+    ('deflate', lambda body: sunnytrail._compress(body, 'deflate', 6)),
+    ('dictionary', lambda body: dictionary.compress(body, 6)))
+
+  results = {}
+  for name, encode in encoders:
+    start = time.time()
+    size = sum([len(encode(body)) for body in bodies])
+    results[name] = (size / float(count), 
+      (time.time() - start) / count)
+  return results
+
+def bench_bodies(count):
+  """ Bytes and CPU seconds per event to encode the request bodies of
+  single events and batches of 100, form encoded and as JSON """
+  client = sunnytrail.Sunnytrail('key')
+  messages = [slotted_event(i).to_json() for i in xrange(count)]
+
+  results = {}
+  for json in (False, True):
+    start = time.time()
+    size = sum([len(sunnytrail._encode_body([m], json)) for m in messages])
+    results[json and 'json' or 'form', 'single'] = \
+      (size / float(count), (time.time() - start) / count)
+
+    start = time.time()
+    size = sum([len(data) for _, _, data in 
+      client._batches(messages, json)])
+    results[json and 'json' or 'form', 'batch'] = \
+      (size / float(count), (time.time() - start) / count)
+  return results
+
+def bench_quote(count):
+  """ Seconds per quote_plus() call on a 300 byte message and a 300KB
+  batch of messages, escaping every character or only the unsafe ones """
+  message = slotted_event(0).to_json()
+  batch = ','.join([slotted_event(i).to_json() for i in xrange(1000)])
+
+  def mapped(s):
+    # quote_plus() before the bulk escaping
+    return _sunnytrail_urllib._quote_map(s, ' ').replace(' ', '+')
+
+  results = {}
+  for size, body, repeat in (('300B', message, count), 
+      ('300KB', batch, max(1, count / 100))):
+    assert mapped(body) == _sunnytrail_urllib.quote_plus(body)
+
+    for name, quote in (('map', mapped), 
+        ('bulk', _sunnytrail_urllib.quote_plus)):
+      start = time.time()
+      for i in xrange(repeat):
+        quote(body)
+      results[size, name] = (len(body), (time.time() - start) / repeat)
+  return results
+
+def bench_preamble(count):
+  """ Seconds per request to format the request line and headers, 
+  every time or once per client """
+  pool = sunnytrail.ConnectionPool('api.thesunnytrail.com', True)
+  url = sunnytrail.Sunnytrail('key', keep_alive=False)._messages_url
+  headers = (('Content-Encoding', 'gzip'),)
+
+  results = {}
+  for name, cached in (('formatted', False), ('cached', True)):
+    start = time.time()
+    for i in xrange(count):
+      if not cached: pool._preambles = {}
+      '%sContent-Length: %d\r\n\r\n%s' % \
+        (pool._preamble(url, headers), 300, 'x')
+    results[name] = (time.time() - start) / count
+  return results
+
+def mixed_events(count):
+  """ Signup, pay and cancel events in turn """
+  plan = sunnytrail.Plan('Basic', 9.99, 30)
+  events = []
+  for i in xrange(count):
+    id, name, email = str(i), 'User %d' % i, 'user%d@example.com' % i
+    created = 1300000000 + i
+    if i % 3 == 0:
+      events.append(sunnytrail.SignupEvent(id, name, email, plan, created))
+    elif i % 3 == 1:
+      events.append(sunnytrail.PayEvent(id, name, email, plan, created))
+    else:
+      events.append(sunnytrail.CancelEvent(id, name, email, created))
+  return events
+
+def best(func, items, repeat=3):
+  """ Fewest seconds per item of func() over repeat runs """
+  times = []
+  for i in xrange(repeat):
+    start = time.time()
+    func()
+    times.append(time.time() - start)
+  return min(times) / items
+
+def unused_port():
+  sock = socket.socket()
+  sock.bind(('localhost', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+def start_collector(port):
+  """ Run http_serve.py accepting every message on localhost:port """
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'http_serve.py')
+  # http_serve.py logs every request: drop the log
+  devnull = open(os.devnull, 'w')
+  process = subprocess.Popen([sys.executable, path, '--port', str(port),
+    '--code', '202', '--keep-alive'], stdout=devnull, stderr=devnull)
+  devnull.close()
+
+  deadline = time.time() + 10
+  while True:
+    try:
+      socket.create_connection(('localhost', port)).close()
+      return process
+    except socket.error:
+      if process.poll() is not None:
+        raise
+      if time.time() > deadline:
+        process.kill()
+        raise
+      time.sleep(0.01)
+
+def bench_send(count):
+  """ Seconds per event sent to a local collector one by one with
+  send() and in batches of 100 with send_many() """
+  port = unused_port()
+  collector = start_collector(port)
+  client = sunnytrail.Sunnytrail('key', 'localhost:%d' % port,
+    use_ssl=False)
+  try:
+    events = mixed_events(count)
+    client.send(events[0]) # connect outside of the timing
+
+    def single():
+      for event in events:
+        client.send(event)
+
+    def batch():
+      for result in client.send_many(events):
+        assert result is None, result
+
+    return {'single': best(single, count), 'batch': best(batch, count)}
+  finally:
+    client.close()
+    collector.kill()
+    collector.wait()
+
+def bench_suite(count):
+  """ The hot paths of the client: encoding single events, sending them
+  to a local collector and keeping them in memory """
+  events = mixed_events(count)
+  messages = [event.to_json() for event in events]
+  sends = max(100, count / 10)
+
+  send = bench_send(sends)
+  results = {
+    'to_json': (best(lambda: [e.to_json() for e in events], count),
+      'us/event'),
+    'urlencode': (best(lambda: [sunnytrail.urlencode({'message': m})
+      for m in messages], count), 'us/event'),
+    'send': (send['single'], 'us/event'),
+    'send_many': (send['batch'], 'us/event'),
+    'memory': (bench_memory(count)['slots'], 'bytes/event'),
+  }
+
+  for name, (value, unit) in results.items():
+    if unit == 'us/event':
+      value *= 1e6
+    results[name] = {'value': round(value, 3), 'unit': unit}
+
+  return {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    'count': count,
+    'sends': sends,
+    'results': results,
+  }
+
+def compare(old, new):
+  """ Lines comparing the results of two suite runs: lower is better """
+  lines = []
+  for name in sorted(new['results']):
+    if name not in old['results']: continue
+    before, after = old['results'][name], new['results'][name]
+    change = 'n/a'
+    if before['value']:
+      change = '%+.1f%%' % ((after['value'] / before['value'] - 1) * 100)
+    lines.append('%-10s %12.3f %12.3f %-12s %8s' % (name,
+      before['value'], after['value'], after['unit'], change))
+  return lines
+
+def main():
+  parser = OptionParser('%prog [--count=N] '\
+    'memory|compression|bodies|quote|preamble|suite\n'\
+    '       %prog compare OLD.json NEW.json')
+  parser.add_option('-n', '--count', type='int', default=None,
+    help='number of events to create')
+
+  options, args = parser.parse_args()
+  if args == ['memory']:
+    results = bench_memory(options.count or 100000)
+    for name in ('dict', 'slots'):
+      print '%-6s %8.1f bytes/event' % (name, results[name])
+
+  elif args == ['compression']:
+    results = bench_compression(options.count or 10000)
+    plain = results['plain'][0]
+    for name in ('plain', 'gzip', 'deflate', 'dictionary'):
+      size, cpu = results[name]
+      print '%-10s %7.1f bytes/event  ratio %4.2f  %6.1f us/event' % \
+        (name, size, plain / size, cpu * 1e6)
+
+  elif args == ['bodies']:
+    results = bench_bodies(options.count or 10000)
+    for mode in ('single', 'batch'):
+      for name in ('form', 'json'):
+        size, cpu = results[name, mode]
+        print '%-6s %-5s %7.1f bytes/event  %6.2f us/event' % \
+          (mode, name, size, cpu * 1e6)
+
+  elif args == ['quote']:
+    results = bench_quote(options.count or 1000)
+    for size in ('300B', '300KB'):
+      for name in ('map', 'bulk'):
+        length, seconds = results[size, name]
+        print '%-6s %-5s %10.1f us/call  %7.1f MB/s' % (size, name,
+          seconds * 1e6, length / seconds / 1e6)
+
+  elif args == ['preamble']:
+    results = bench_preamble(options.count or 100000)
+    for name in ('formatted', 'cached'):
+      print '%-9s %6.2f us/request' % (name, results[name] * 1e6)
+
+  elif args == ['suite']:
+    print simplejson.dumps(bench_suite(options.count or 10000),
+      indent=2, sort_keys=True)
+
+  elif len(args) == 3 and args[0] == 'compare':
+    old, new = [simplejson.load(open(path)) for path in args[1:]]
+    print '%-10s %12s %12s' % ('', old['time'], new['time'])
+    for line in compare(old, new):
+      print line
+
+  else:
+    parser.error('Unknown benchmark')
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -10,27 +10,85 @@ Usage:
 
   ./http_server.py --port=8080 --code=500 --content="Internal Server Error"
 
+  ./http_server.py --port=8080 --code=202 --keep-alive
+
+Request bodies sent with a gzip or deflate Content-Encoding are 
+decompressed. Bodies that can't be decoded get a 400 response and
+unknown encodings a 415. Bodies compressed with a Sunnytrail preset
+dictionary are only accepted with --dictionary:
+
+  ./http_server.py --port=8080 --code=202 --dictionary \
+    --dictionary-string=Basic --dictionary-string=Premium
+
+application/json bodies must be valid JSON (400 otherwise). With 
+--no-json they get a 415, like from a collector predating them.
+
 """
 
 import sys, os
+import zlib
+import simplejson
 
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
 from optparse import OptionParser
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
 class APIHandler(BaseHTTPRequestHandler, object):
+  # buffer the response: written line by line, Nagle's algorithm and 
+  # the client delayed ACK stall every keep-alive response by 40ms
+  wbufsize = -1
 
   def __init__(self, *args, **kwargs):
     super(APIHandler, self).__init__(*args, **kwargs)
 
   def do_request(self):
     global options
-    
-    self.send_response(int(options.code))
+
+    length = int(self.headers.getheader('content-length') or 0)
+    body = ''
+    if length: body = self.rfile.read(length)
+
+    encoding = self.headers.getheader('content-encoding')
+    dictid = self.headers.getheader('x-sunnytrail-dictionary')
+    if dictid:
+      if dictionary is None or dictid.lower() != '%08x' % dictionary.id:
+        return self.respond(415, 'Unknown dictionary')
+      try:
+        body = dictionary.decompress(body)
+      except zlib.error:
+        return self.respond(400, 'Malformed request body')
+
+    elif encoding:
+      if encoding not in ('gzip', 'deflate'):
+        return self.respond(415, 'Unsupported Content-Encoding')
+      try:
+        # 32 + MAX_WBITS accepts both the gzip and zlib containers
+        body = zlib.decompress(body, 32 + zlib.MAX_WBITS)
+      except zlib.error:
+        return self.respond(400, 'Malformed request body')
+
+    content_type = self.headers.getheader('content-type') or ''
+    if content_type.startswith('application/json'):
+      if options.no_json:
+        return self.respond(415, 'Unsupported Content-Type')
+      try:
+        simplejson.loads(body)
+      except ValueError:
+        return self.respond(400, 'Malformed JSON body')
+
+    self.respond(int(options.code), options.content)
+
+  def respond(self, code, content):
+    self.send_response(code)
     
     self.send_header('Content-type', options.type)
+    self.send_header('Content-length', str(len(content)))
     self.end_headers()
     
-    self.wfile.write(options.content)
+    self.wfile.write(content)
     
   def do_GET(self):
     return self.do_request()
@@ -38,12 +96,21 @@ class APIHandler(BaseHTTPRequestHandler, object):
   def do_POST(self):
     return self.do_request()
 
+dictionary = None
+
 def main():
-  global options
+  global options, dictionary
   options, args = parse_cli()
+
+  if options.dictionary:
+    from sunnytrail import PresetDictionary
+    dictionary = PresetDictionary(options.dictionary_strings)
   
+  if options.keep_alive:
+    APIHandler.protocol_version = 'HTTP/1.1'
+
   server_address = ('', int(options.port))
-  httpd = HTTPServer(server_address, APIHandler)
+  httpd = ThreadingHTTPServer(server_address, APIHandler)
 
   try:
     httpd.serve_forever()
@@ -63,6 +130,19 @@ def parse_cli():
     help="content type")
     
   parser.add_option('', '--content', default='')
+
+  parser.add_option('', '--keep-alive', action='store_true', \
+    default=False, help="speak HTTP/1.1 with persistent connections")
+
+  parser.add_option('', '--no-json', action='store_true', \
+    default=False, help="refuse application/json bodies")
+
+  parser.add_option('', '--dictionary', action='store_true', \
+    default=False, help="accept bodies using the preset dictionary")
+
+  parser.add_option('', '--dictionary-string', action='append', \
+    dest='dictionary_strings', default=[], \
+    help="frequent string of the preset dictionary")
   
   return parser.parse_args()
 
@@ -3,82 +3,2805 @@
 The easiest and fastest way to integrate. This file can also 
 be used as CLI tool if you wish to play with the API."""
 
+import os
 import sys
 import urllib
 import simplejson
 import logging
+import socket
+import select
+import httplib
+import threading
+import Queue
+import atexit
+import zlib
+import errno
+import asyncore
+import mimetools
+import random
+import email.utils
+import csv
+import shutil
+import signal
+import struct
+import stat
+import re
 
-from _sunnytrail_urllib import FancyURLopener, urlencode
+try:
+  import ssl
+except ImportError: # python 2.5 and older
+  ssl = None
 
-from time import time
+from cStringIO import StringIO
+from bisect import bisect_left
+from collections import deque
+from operator import itemgetter
+from simplejson.encoder import encode_basestring_ascii
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+try:
+  import multiprocessing
+except ImportError: # python 2.5 and older
+  multiprocessing = None
+
+try:
+  from concurrent.futures import Future, TimeoutError
+except ImportError: # no futures backport
+  Future = None
+
+  class TimeoutError(Exception):
+    """ A future was not done in time, as concurrent.futures.TimeoutError
+    """
+    pass
+
+from _sunnytrail_urllib import FancyURLopener, urlencode, quote_plus, \
+  splittype, splithost, splitport, getproxies, proxy_bypass
+
+from time import time, sleep
 
 class SunnytrailOpener(FancyURLopener):
   version = 'Sunnytrail Python API Wrapper 1.0'
 
-class SunnytrailException(Exception): 
-  """ Generic class for Sunnytrail related exceptions """
-  pass
+class SunnytrailException(Exception): 
+  """ Generic class for Sunnytrail related exceptions """
+  pass
+
+class InvalidMessage(SunnytrailException):
+  """ Message validation failed on the server """
+
+  def __init__(self, message='', errors=None):
+    SunnytrailException.__init__(self, message)
+    self.errors = errors or []
+
+class InvalidAPIKey(SunnytrailException):
+  """ Invalid Sunnytrail API Key """
+  pass 
+
+class ServiceUnavailable(SunnytrailException):
+  """ The Sunnytrail message collector is not available """
+
+  def __init__(self, message='', retry_after=None):
+    SunnytrailException.__init__(self, message)
+    self.retry_after = retry_after
+
+class SunnytrailTimeout(ServiceUnavailable):
+  """ The collector did not answer in time """
+  pass
+
+class CircuitOpen(ServiceUnavailable):
+  """ The circuit breaker is not letting requests through """
+  pass
+
+class ServerError(SunnytrailException):
+  """ The collector failed with a 5xx status other than 503 """
+
+  def __init__(self, message='', code=None):
+    SunnytrailException.__init__(self, message)
+    self.code = code
+
+class UnsupportedEncoding(SunnytrailException):
+  """ The collector can't decode the request body """
+  pass
+
+class BadRequest(SunnytrailException):
+  """ The collector refused the request as malformed (HTTP 400) """
+  pass
+
+class DispatcherFull(SunnytrailException):
+  """ The dispatcher queue is full """
+  pass
+
+class SunnytrailResponse(object):
+  """ Fully buffered response returned by the pooled transport """
+
+  def __init__(self, code, headers, body):
+    self.code = code
+    self.headers = headers
+    self._body = body
+
+  def read(self): return self._body
+
+  def info(self): return self.headers
+
+  def getcode(self): return self.code
+
+  def close(self): pass
+
+def _is_stale(conn):
+  """ An idle keep-alive socket should never be readable: if it is,
+  the server either closed it or sent something we did not ask for """
+  if conn.sock is None:
+    return True
+  try:
+    readable, _, _ = select.select([conn.sock], [], [], 0)
+  except (select.error, socket.error, ValueError):
+    return True
+  return bool(readable)
+
+class _Timeouts(object):
+  """ Connect and read timeouts of a call, capped by the time left 
+  before its deadline """
+
+  def __init__(self, connect=None, read=None, deadline=None):
+    self.connect_timeout = connect
+    self.read_timeout = read
+    self.expires = None
+    if deadline is not None:
+      self.expires = time() + deadline
+
+  def _cap(self, timeout):
+    if self.expires is None:
+      return timeout
+
+    left = self.expires - time()
+    if left <= 0:
+      raise SunnytrailTimeout('Deadline exceeded')
+    if timeout is None:
+      return left
+    return min(timeout, left)
+
+  def connect(self): return self._cap(self.connect_timeout)
+
+  def read(self): return self._cap(self.read_timeout)
+
+def _timed_out(e):
+  if isinstance(e, socket.timeout):
+    return True
+  # python 2 reports SSL handshake timeouts as a plain SSLError
+  return ssl is not None and isinstance(e, ssl.SSLError) and \
+    'timed out' in str(e)
+
+class RequestTimings(object):
+  """ Durations in seconds of the phases of a request, handed to the
+  observer of a ConnectionPool. Phases that did not happen are None:
+  a reused connection skips resolve, connect and tls, and a failed 
+  request stops at the failing phase and has its error set """
+  __slots__ = ('resolve', 'connect', 'tls', 'write', 'ttfb', 'read',
+    'reused', 'status', 'error')
+
+  def __init__(self):
+    self.resolve = self.connect = self.tls = None
+    self.write = self.ttfb = self.read = None
+    self.reused = False
+    self.status = self.error = None
+
+  def total(self):
+    return sum([t for t in (self.resolve, self.connect, self.tls, 
+      self.write, self.ttfb, self.read) if t is not None])
+
+  def __repr__(self):
+    return '<RequestTimings %s>' % ' '.join(['%s=%s' % 
+      (name, getattr(self, name)) for name in self.__slots__])
+
+def _connect(conn, use_ssl):
+  """ Connect like httplib does, timing the phases in conn.timings """
+  timeout = conn.timeout
+  if conn.timeouts is not None:
+    timeout = conn.timeouts.connect()
+  timings = conn.timings
+
+  start = time()
+  addresses = _resolve(conn.host, conn.port, timeout)
+  now = time()
+  if timings is not None:
+    timings.resolve, start = now - start, now
+
+  if conn.timeouts is not None:
+    timeout = conn.timeouts.connect()
+  conn.sock = _open_socket(addresses, timeout)
+  now = time()
+  if timings is not None:
+    timings.connect, start = now - start, now
+
+  for level, option, value in conn.socket_options:
+    conn.sock.setsockopt(level, option, value)
+
+  if use_ssl:
+    context = getattr(conn, '_context', None)
+    if context is not None: # python 2.7.9 and newer
+      conn.sock = context.wrap_socket(conn.sock, server_hostname=conn.host)
+    else:
+      conn.sock = ssl.wrap_socket(conn.sock, conn.key_file, conn.cert_file)
+    if timings is not None:
+      timings.tls = time() - start
+
+  if conn.timeouts is not None:
+    conn.sock.settimeout(conn.timeouts.read())
+
+def _resolve(host, port, timeout):
+  """ getaddrinfo() bounded by timeout seconds. It can't be interrupted,
+  so with a timeout it runs in a daemon thread left behind if late """
+  if timeout is None or timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+    return socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+  outcome = []
+  def resolve():
+    try:
+      outcome.append((socket.getaddrinfo(host, port, 0, 
+        socket.SOCK_STREAM), None))
+    except Exception, e:
+      outcome.append((None, e))
+
+  thread = threading.Thread(target=resolve, name='sunnytrail-resolver')
+  thread.setDaemon(True)
+  thread.start()
+  thread.join(timeout)
+  if not outcome:
+    raise socket.timeout('timed out resolving %s' % host)
+
+  addresses, error = outcome[0]
+  if error is not None:
+    raise error
+  return addresses
+
+class _DeadlineSocket(object):
+  """ Socket whose every recv() waits at most until the deadline of the
+  call: a single settimeout() would let a response trickling in byte
+  by byte outlast it """
+
+  def __init__(self, sock, timeouts):
+    self._sock = sock
+    self._timeouts = timeouts
+
+  def recv(self, size):
+    self._sock.settimeout(self._timeouts.read())
+    return self._sock.recv(size)
+
+  def makefile(self, mode='r', bufsize=-1):
+    return socket._fileobject(self, mode, bufsize)
+
+  def __getattr__(self, name):
+    return getattr(self._sock, name)
+
+def _open_socket(addresses, timeout):
+  """ Connect to the first address of getaddrinfo() that accepts """
+  error = socket.error('getaddrinfo returns an empty list')
+  for family, socktype, proto, name, address in addresses:
+    sock = socket.socket(family, socktype, proto)
+    try:
+      if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+        sock.settimeout(timeout)
+      sock.connect(address)
+      return sock
+    except socket.error, error:
+      sock.close()
+  raise error
+
+def _dropped_idle(e):
+  """ The server closed the connection without answering, as it does
+  with idle connections it no longer wants, before reading a request """
+  return isinstance(e, httplib.BadStatusLine) and (e.line in ('', "''")
+    or 'server has closed the connection' in e.line)
+
+class _HTTPConnection(httplib.HTTPConnection):
+  timeouts = timings = None
+  socket_options = ()
+  request_sent = False
+
+  def connect(self): _connect(self, False)
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+  timeouts = timings = None
+  socket_options = ()
+  request_sent = False
+
+  def connect(self): _connect(self, True)
+
+class ConnectionPool(object):
+  """ Pool of HTTP/1.1 keep-alive connections to a single host.
+
+  Idle connections are reused most recent first. Connections found
+  stale on checkout are dropped. A request is sent again on a fresh
+  connection only when a reused one failed before the request was 
+  written or was closed without any answer, so the server can't have
+  processed it. The pool connects directly, ignoring proxy settings.
+
+  Each request goes out in a single write. Its request line and 
+  headers are formatted once per URL and set of extra headers; assign
+  a new list to addheaders to change the headers. socket_options are 
+  (level, option, value) tuples set on every new socket. 
+
+  observer(timings) is called after every request with its 
+  RequestTimings, failed ones included. """
+
+  def __init__(self, host, use_ssl=False, max_idle=4, idle_timeout=60,
+      socket_options=(), observer=None):
+    self._host = host
+    self.observer = observer
+    self._use_ssl = use_ssl
+    self._max_idle = max_idle
+    self._idle_timeout = idle_timeout
+    self._socket_options = socket_options
+    self._idle = []
+    self._lock = threading.Lock()
+    self._preambles = {}
+    self.addheaders = [
+      ('Content-Type', 'application/x-www-form-urlencoded'),
+      ('User-Agent', SunnytrailOpener.version)
+    ]
+
+  def _get_addheaders(self):
+    return self._addheaders
+
+  def _set_addheaders(self, headers):
+    self._addheaders = headers
+    self._preambles = {}
+
+  addheaders = property(_get_addheaders, _set_addheaders)
+
+  def _preamble(self, url, headers=None):
+    """ Request line and headers of a POST to url, but Content-Length.
+    headers is a dict or a tuple of (name, value) pairs """
+    if isinstance(headers, dict):
+      headers = tuple(sorted(headers.items()))
+    key = (url, headers)
+    try:
+      return self._preambles[key]
+    except KeyError:
+      pass
+
+    host, selector = splithost(splittype(url)[1])
+    all_headers = dict(self._addheaders)
+    all_headers.update(headers or ())
+
+    lines = ['POST %s HTTP/1.1' % selector, 'Host: %s' % self._host,
+      'Accept-Encoding: identity'] + \
+      ['%s: %s' % item for item in all_headers.items()] + ['']
+    if len(self._preambles) >= 64: 
+      self._preambles = {}
+    preamble = self._preambles[key] = '\r\n'.join(lines)
+    return preamble
+
+  def _connect(self):
+    if self._use_ssl:
+      conn = _HTTPSConnection(self._host)
+    else:
+      conn = _HTTPConnection(self._host)
+    conn.socket_options = self._socket_options
+    return conn
+
+  def _checkout(self):
+    """ Return an (connection, reused) tuple """
+    now = time()
+    self._lock.acquire()
+    try:
+      while self._idle:
+        conn, last_used = self._idle.pop()
+        if now - last_used < self._idle_timeout and not _is_stale(conn):
+          return conn, True
+        conn.close()
+    finally:
+      self._lock.release()
+    return self._connect(), False
+
+  def _checkin(self, conn):
+    self._lock.acquire()
+    try:
+      if len(self._idle) < self._max_idle:
+        self._idle.append((conn, time()))
+        return
+    finally:
+      self._lock.release()
+    conn.close()
+
+  def _roundtrip(self, conn, preamble, data, timeouts, timings=None):
+    conn.timeouts, conn.timings = timeouts, timings
+    conn.request_sent = False
+    if conn.sock is None:
+      conn.connect()
+    else:
+      conn.sock.settimeout(timeouts and timeouts.read())
+
+    # request line, headers and body in one buffer: written piecewise,
+    # a small body waits for the ACK of the headers (Nagle, delayed ACK)
+    start = time()
+    conn.sock.sendall('%sContent-Length: %d\r\n\r\n%s' % 
+      (preamble, len(data), data))
+    conn.request_sent = True
+
+    sock = conn.sock
+    if timeouts is not None and timeouts.expires is not None:
+      sock = _DeadlineSocket(sock, timeouts)
+
+    if timings is None:
+      response = conn.response_class(sock, method='POST')
+      response.begin()
+      return response, response.read()
+
+    now = time()
+    timings.write, start = now - start, now
+    response = conn.response_class(sock, method='POST')
+    response.begin()
+    now = time()
+    timings.ttfb, start = now - start, now
+    timings.status = response.status
+    body = response.read()
+    timings.read = time() - start
+    return response, body
+
+  def open(self, url, data, timeouts=None, headers=None):
+    """ POST data to url. Mirrors URLopener.open but returns a
+    SunnytrailResponse for every status code. headers are sent in 
+    addition to addheaders """
+    preamble = self._preamble(url, headers)
+    observer, timings = self.observer, None
+    if observer is not None:
+      timings = RequestTimings()
+
+    conn, reused = self._checkout()
+    try:
+      try:
+        if timings is not None:
+          timings.reused = reused
+        response, body = self._roundtrip(conn, preamble, data, timeouts,
+          timings)
+
+      except (socket.error, httplib.HTTPException), e:
+        conn.close()
+        if not reused or _timed_out(e) or \
+            (conn.request_sent and not _dropped_idle(e)):
+          raise
+
+        # the server dropped the idle connection under us: reconnect once
+        conn = self._connect()
+        if timings is not None:
+          timings = RequestTimings()
+        response, body = self._roundtrip(conn, preamble, data, timeouts,
+          timings)
+
+    except httplib.HTTPException, e:
+      conn.close()
+      self._observe(timings, e)
+      raise IOError('http protocol error', 0, str(e), None)
+
+    except socket.error, e:
+      exc_info = sys.exc_info()
+      conn.close()
+      self._observe(timings, e)
+      if not _timed_out(e): 
+        raise exc_info[0], exc_info[1], exc_info[2]
+      raise SunnytrailTimeout('Request timed out: %s' % e)
+
+    except:
+      exc_info = sys.exc_info()
+      conn.close()
+      self._observe(timings, exc_info[1])
+      raise exc_info[0], exc_info[1], exc_info[2]
+
+    if response.will_close:
+      conn.close()
+    else:
+      self._checkin(conn)
+
+    self._observe(timings)
+    return SunnytrailResponse(response.status, response.msg, body)
+
+  def _observe(self, timings, error=None):
+    if timings is None:
+      return
+    timings.error = error
+    try:
+      self.observer(timings)
+    except Exception, e:
+      logging.exception(e)
+
+  def close(self):
+    """ Close all idle connections """
+    self._lock.acquire()
+    try:
+      idle, self._idle = self._idle, []
+    finally:
+      self._lock.release()
+    for conn, last_used in idle:
+      conn.close()
+
+def _retry_after(headers):
+  """ Seconds to wait according to a Retry-After header, if any """
+  try:
+    value = headers.get('Retry-After')
+  except AttributeError:
+    return None
+  if not value: return None
+
+  try:
+    return max(0, int(value))
+  except ValueError:
+    date = email.utils.parsedate_tz(value)
+    if date is None: return None
+    return max(0, email.utils.mktime_tz(date) - time())
+
+class RetryPolicy(object):
+  """ Decide if and when a failed request is sent again.
+
+  Only failures that may go away by themselves are retried: 
+  ServiceUnavailable (503s and timeouts) and network errors, but not 
+  other HTTP error statuses. Up to max_attempts are made, waiting a 
+  random time between zero and backoff * 2 ** retry seconds (capped at
+  max_backoff) before each retry, or longer if the server asked so 
+  with Retry-After. The policy gives up when Retry-After asks for more
+  than max_backoff seconds, and no retry starts once deadline seconds
+  passed since the first attempt.
+
+  A request that timed out or lost its connection may still have been
+  received, so retries make delivery at-least-once: the collector can
+  get an event twice. """
+
+  def __init__(self, max_attempts=5, backoff=0.5, max_backoff=30.0,
+      deadline=None):
+    self.max_attempts = max_attempts
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.deadline = deadline
+
+  def retryable(self, e):
+    if isinstance(e, ServiceUnavailable):
+      return not isinstance(e, CircuitOpen)
+    # URLopener reports network errors as IOError('socket error', e)
+    return isinstance(e, socket.error) or \
+      (isinstance(e, IOError) and e.args[:1] == ('socket error',))
+
+  def delay(self, retry, e):
+    """ Seconds to wait before the retry-th retry (counting from 0) """
+    delay = random.uniform(0, min(self.max_backoff, 
+      self.backoff * 2 ** retry))
+
+    retry_after = getattr(e, 'retry_after', None)
+    if retry_after is not None:
+      delay = max(delay, retry_after)
+    return delay
+
+  def call(self, func, *args, **kwargs):
+    """ Call func(*args) until it succeeds or the policy gives up, in 
+    which case the last error is raised. No retry starts after the
+    absolute time given as the expires keyword argument. The on_retry
+    keyword argument is called with the error before each retry """
+    expires = kwargs.get('expires')
+    on_retry = kwargs.get('on_retry')
+    if self.deadline is not None:
+      expires = min(expires or sys.maxint, time() + self.deadline)
+
+    attempt = 1
+    while True:
+      try:
+        return func(*args)
+
+      except (ServiceUnavailable, IOError), e:
+        delay = self.delay(attempt - 1, e)
+        if not self.retryable(e) or attempt >= self.max_attempts or \
+            delay > self.max_backoff or \
+            (expires is not None and time() + delay > expires):
+          raise
+
+      logging.info('Retrying in %.2fs: %s', delay, e)
+      if on_retry is not None:
+        on_retry(e)
+      sleep(delay)
+      attempt += 1
+
+class CircuitBreaker(object):
+  """ Stop calling the collector while it keeps failing.
+
+  While closed, the outcome of the last window requests is tracked and
+  the breaker opens once at least min_requests were made and the 
+  ratio of ServiceUnavailable, ServerError and network errors reaches
+  failure_rate.
+  While open, requests fail right away with CircuitOpen. After 
+  reset_timeout seconds the breaker turns half-open and lets 
+  half_open_probes requests through: it closes if they all succeed
+  and opens again on the first failure. """
+
+  CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+  def __init__(self, failure_rate=0.5, window=20, min_requests=5,
+      reset_timeout=30.0, half_open_probes=1):
+    self.failure_rate = failure_rate
+    self.window = window
+    self.min_requests = min_requests
+    self.reset_timeout = reset_timeout
+    self.half_open_probes = half_open_probes
+
+    self._lock = threading.Lock()
+    self._state = self.CLOSED
+    self._opened_at = None
+    self._outcomes = deque()
+    self._failures = 0
+    self._probes = self._probes_passed = 0
+    self._transitions = {self.CLOSED: 0, self.OPEN: 0, self.HALF_OPEN: 0}
+
+  def _set_state(self, state):
+    logging.warning('Sunnytrail circuit breaker: %s -> %s', 
+      self._state, state)
+    self._state = state
+    self._transitions[state] += 1
+    self._outcomes.clear()
+    self._failures = self._probes = self._probes_passed = 0
+    if state == self.OPEN:
+      self._opened_at = time()
+
+  def _current_state(self):
+    if self._state == self.OPEN and \
+        time() - self._opened_at >= self.reset_timeout:
+      self._set_state(self.HALF_OPEN)
+    return self._state
+
+  @property
+  def state(self):
+    self._lock.acquire()
+    try:
+      return self._current_state()
+    finally:
+      self._lock.release()
+
+  def stats(self):
+    """ Current state, requests and failures in the window and the 
+    number of times each state was entered """
+    self._lock.acquire()
+    try:
+      return {
+        'state': self._current_state(),
+        'requests': len(self._outcomes),
+        'failures': self._failures,
+        'transitions': dict(self._transitions)
+      }
+    finally:
+      self._lock.release()
+
+  def allow(self):
+    """ Raise CircuitOpen unless a request may be made now """
+    self._lock.acquire()
+    try:
+      state = self._current_state()
+      if state == self.CLOSED:
+        return
+
+      if state == self.HALF_OPEN and self._probes < self.half_open_probes:
+        self._probes += 1
+        return
+
+      retry_after = None
+      if state == self.OPEN:
+        retry_after = self._opened_at + self.reset_timeout - time()
+      raise CircuitOpen('Circuit breaker is %s' % state, retry_after)
+    finally:
+      self._lock.release()
+
+  def record(self, success):
+    """ Account for the outcome of a request let through by allow() """
+    self._lock.acquire()
+    try:
+      if self._state == self.HALF_OPEN:
+        if not success:
+          self._set_state(self.OPEN)
+        else:
+          self._probes_passed += 1
+          if self._probes_passed >= self.half_open_probes:
+            self._set_state(self.CLOSED)
+
+      elif self._state == self.CLOSED:
+        if len(self._outcomes) >= self.window and \
+            not self._outcomes.popleft():
+          self._failures -= 1
+        self._outcomes.append(success)
+        if not success:
+          self._failures += 1
+
+        requests = len(self._outcomes)
+        if requests >= self.min_requests and \
+            self._failures >= self.failure_rate * requests:
+          self._set_state(self.OPEN)
+    finally:
+      self._lock.release()
+
+  def call(self, func, *args):
+    """ Call func(*args) if the breaker allows it and record the 
+    outcome """
+    self.allow()
+    try:
+      result = func(*args)
+    except (ServiceUnavailable, ServerError, IOError):
+      exc_info = sys.exc_info()
+      self.record(False)
+      raise exc_info[0], exc_info[1], exc_info[2]
+    except Exception:
+      # the collector answered, even if it did not like the request
+      exc_info = sys.exc_info()
+      self.record(True)
+      raise exc_info[0], exc_info[1], exc_info[2]
+
+    self.record(True)
+    return result
+
+def _log_linear(low, high):
+  """ Histogram bounds from 10 ** low to 10 ** high, nine linear steps
+  per power of ten: 0.0001, 0.0002, ... 0.0009, 0.001, 0.002, ... """
+  return [float('%de%d' % (m, e)) for e in xrange(low, high) 
+    for m in xrange(1, 10)] + [float('1e%d' % high)]
+
+# send latencies in seconds, from 100us to 100s
+_LATENCY_BOUNDS = _log_linear(-4, 2)
+
+class _Shard(object):
+  """ The metrics updated by one thread """
+  __slots__ = ('values', 'histograms')
+
+  def __init__(self):
+    self.values = {}
+    self.histograms = {}
+
+  def merge(self, other):
+    # items() and list() copy in a single step under the GIL, so the
+    # shard of a running thread can be read while it is being updated
+    for key, value in other.values.items():
+      self.values[key] = self.values.get(key, 0) + value
+    for key, counts in other.histograms.items():
+      counts = list(counts)
+      merged = self.histograms.get(key)
+      if merged is None:
+        self.histograms[key] = counts
+      else:
+        for i, count in enumerate(counts):
+          merged[i] += count
+
+class HistogramSnapshot(object):
+  """ Distribution of the values observed by a histogram. counts[i] is
+  the number of values not above bounds[i] and above bounds[i - 1]; 
+  the last count is for the values above all the bounds """
+  __slots__ = ('bounds', 'counts', 'sum')
+
+  def __init__(self, bounds, counts, sum):
+    self.bounds = bounds
+    self.counts = counts
+    self.sum = sum
+
+  @property
+  def count(self): return sum(self.counts)
+
+  def quantile(self, q):
+    """ Upper bound of the bucket holding the q-quantile, e.g. 0.99 """
+    rank, seen = q * self.count, 0
+    if not rank:
+      return None
+    for bound, count in zip(self.bounds, self.counts):
+      seen += count
+      if seen >= rank:
+        return bound
+    return float('inf')
+
+  def __repr__(self):
+    return '<HistogramSnapshot count=%d sum=%s>' % (self.count, self.sum)
+
+class MetricsRegistry(object):
+  """ Counters, gauges and histograms updated from many threads.
+
+  Each thread updates its own shard without locking; snapshot() merges
+  them. Metrics are identified by a name and a tuple of (label, value)
+  pairs. Counters and gauges are both changed with add(), a gauge going
+  down by adding a negative amount """
+
+  def __init__(self, bounds=_LATENCY_BOUNDS):
+    self._bounds = bounds
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._shards = []
+    self._retired = _Shard()
+
+  def _shard(self):
+    try:
+      return self._local.shard
+    except AttributeError:
+      shard = self._local.shard = _Shard()
+      self._lock.acquire()
+      try:
+        # threads may come and go without a snapshot ever being taken
+        self._retire_dead()
+        self._shards.append((threading.currentThread(), shard))
+      finally:
+        self._lock.release()
+      return shard
+
+  def _retire_dead(self):
+    """ Fold the shards of finished threads into the retired shard. 
+    Call with the lock held """
+    live = []
+    for thread, shard in self._shards:
+      if thread.isAlive():
+        live.append((thread, shard))
+      else:
+        self._retired.merge(shard)
+    self._shards = live
+
+  def add(self, name, labels=(), amount=1):
+    values = self._shard().values
+    key = (name, labels)
+    values[key] = values.get(key, 0) + amount
+
+  def observe(self, name, labels, value):
+    """ Add value to a histogram """
+    histograms = self._shard().histograms
+    key = (name, labels)
+    counts = histograms.get(key)
+    if counts is None:
+      # the sum of the values goes last
+      counts = histograms[key] = [0] * (len(self._bounds) + 1) + [0.0]
+    counts[bisect_left(self._bounds, value)] += 1
+    counts[-1] += value
+
+  def snapshot(self):
+    """ Current values as a {name: {labels: value}} dict. Histogram
+    values are HistogramSnapshot objects """
+    merged = _Shard()
+    self._lock.acquire()
+    try:
+      self._retire_dead()
+      merged.merge(self._retired)
+      for thread, shard in self._shards:
+        merged.merge(shard)
+    finally:
+      self._lock.release()
+
+    snapshot = {}
+    for (name, labels), value in merged.values.iteritems():
+      snapshot.setdefault(name, {})[labels] = value
+    for (name, labels), counts in merged.histograms.iteritems():
+      snapshot.setdefault(name, {})[labels] = HistogramSnapshot(
+        self._bounds, counts[:-1], counts[-1])
+    return snapshot
+
+_METRIC_HELP = {
+  'sunnytrail_events_sent_total': 'Events accepted by the collector',
+  'sunnytrail_events_rejected_total': 'Events refused by the collector',
+  'sunnytrail_events_failed_total': 
+    'Events that could not be delivered nor spooled',
+  'sunnytrail_events_spooled_total': 
+    'Events saved to the spool for later delivery',
+  'sunnytrail_events_retried_total': 'Events sent again after a failure',
+  'sunnytrail_sends_in_flight': 
+    'Calls of send() and send_many() in progress',
+  'sunnytrail_requests_in_flight': 'Requests to the collector in progress',
+  'sunnytrail_async_pending': 
+    'Events given to send_async() not sent yet',
+  'sunnytrail_send_duration_seconds': 
+    'Duration of send() and send_many() calls and spool replays, '\
+    'retries included',
+  'sunnytrail_request_duration_seconds': 
+    'Duration of single requests to the collector',
+}
+
+def _format_value(value):
+  if isinstance(value, float):
+    if value == float('inf'):
+      return '+Inf'
+    return repr(value)
+  return str(value)
+
+def _format_labels(labels):
+  if not labels:
+    return ''
+  return '{%s}' % ','.join(['%s="%s"' % (name, str(value).replace('\\', 
+    '\\\\').replace('"', '\\"').replace('\n', '\\n')) 
+    for name, value in labels])
+
+def prometheus_text(snapshot):
+  """ Render a MetricsRegistry snapshot in the Prometheus text format. 
+  Names ending with _total are counters, the other numbers gauges """
+  lines = []
+  for name in sorted(snapshot):
+    series = snapshot[name]
+    histogram = [v for v in series.values() 
+      if isinstance(v, HistogramSnapshot)]
+    if histogram:
+      kind = 'histogram'
+    elif name.endswith('_total'):
+      kind = 'counter'
+    else:
+      kind = 'gauge'
+
+    if name in _METRIC_HELP:
+      lines.append('# HELP %s %s' % (name, _METRIC_HELP[name]))
+    lines.append('# TYPE %s %s' % (name, kind))
+
+    for labels in sorted(series):
+      value = series[labels]
+      if kind != 'histogram':
+        lines.append('%s%s %s' % (name, _format_labels(labels), 
+          _format_value(value)))
+        continue
+
+      cumulative = 0
+      for bound, count in zip(value.bounds + [float('inf')], value.counts):
+        cumulative += count
+        lines.append('%s_bucket%s %d' % (name, _format_labels(labels + 
+          (('le', _format_value(bound)),)), cumulative))
+      lines.append('%s_sum%s %s' % (name, _format_labels(labels), 
+        _format_value(value.sum)))
+      lines.append('%s_count%s %d' % (name, _format_labels(labels), 
+        cumulative))
+
+  return '\n'.join(lines) + '\n'
+
+# the action of a message made by Event.to_json(), which starts with it
+# unless the event has a custom to_hash()
+_ACTION_PREFIX = '{"action": {"name": "'
+_MESSAGE_ACTION = re.compile(r'"action": \{"name": "(\w+)"')
+
+def _message_action(message):
+  if message.startswith(_ACTION_PREFIX):
+    start = len(_ACTION_PREFIX)
+    return message[start:message.find('"', start)]
+  match = _MESSAGE_ACTION.search(message)
+  return match and match.group(1) or 'unknown'
+
+# window bits selecting the zlib container of each Content-Encoding
+_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+def _compress(data, encoding, level):
+  compressor = zlib.compressobj(level, zlib.DEFLATED, _WBITS[encoding])
+  return compressor.compress(data) + compressor.flush()
+
+class PresetDictionary(object):
+  """ zlib preset dictionary for small request bodies.
+
+  Single events are too short for plain compression to pay off, but
+  they share their keys and most of their values. The dictionary holds
+  sample events and the given frequent strings (plan names, email 
+  domains...), most frequent last. Bodies are compressed into standard
+  zlib streams referencing the dictionary by its adler32 id, which is
+  also sent as the X-Sunnytrail-Dictionary header. The collector must
+  have the same dictionary. """
+
+  def __init__(self, strings=()):
+    samples = [e.to_json() for e in (
+      CancelEvent('1', 'User', 'user@example.com', 1300000000),
+      PayEvent('1', 'User', 'user@example.com', 
+        Plan('Basic', 9.99, 30), 1300000000),
+      SignupEvent('1', 'User', 'user@example.com', 
+        Plan('Basic', 9.99, 30), 1300000000))]
+
+    parts = [quote_plus(s) for s in strings] + list(strings) + samples + \
+      [urlencode({'message': m}) for m in samples]
+    self.data = ''.join(parts)[-32768:] # the size of the zlib window
+    self.id = zlib.adler32(self.data) & 0xffffffff
+
+    self._compressors = {}
+    self._decompressor = None
+
+  def _primed(self, level):
+    """ Raw deflate compressor that already went through the 
+    dictionary: python 2 zlib has no preset dictionary support, but 
+    the window of a copy of this compressor is the same """
+    compressor = self._compressors.get(level)
+    if compressor is None:
+      compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+      compressor.compress(self.data)
+      compressor.flush(zlib.Z_SYNC_FLUSH)
+      self._compressors[level] = compressor
+    return compressor
+
+  def compress(self, data, level=6):
+    """ Compress data into a zlib stream using the dictionary """
+    if level == zlib.Z_DEFAULT_COMPRESSION:
+      level = 6
+    compressor = self._primed(level).copy()
+    flg = _FLEVEL[level] << 6 | 0x20 # FDICT
+    flg += 31 - (0x78 << 8 | flg) % 31
+    return struct.pack('>BBI', 0x78, flg, self.id) + \
+      compressor.compress(data) + compressor.flush() + \
+      struct.pack('>I', zlib.adler32(data) & 0xffffffff)
+
+  def decompress(self, stream):
+    """ Decompress a stream made by compress(). Raises zlib.error if
+    it is not valid or uses another dictionary """
+    if len(stream) < 10:
+      raise zlib.error('Truncated stream')
+
+    cmf, flg, dictid = struct.unpack('>BBI', stream[:6])
+    if cmf & 0x0f != zlib.DEFLATED or (cmf << 8 | flg) % 31 or \
+        not flg & 0x20:
+      raise zlib.error('Not a preset dictionary stream')
+    if dictid != self.id:
+      raise zlib.error('Unknown dictionary %08x' % dictid)
+
+    if self._decompressor is None:
+      primer = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+      decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+      decompressor.decompress(primer.compress(self.data) + 
+        primer.flush(zlib.Z_SYNC_FLUSH))
+      self._decompressor = decompressor
+
+    decompressor = self._decompressor.copy()
+    data = decompressor.decompress(stream[6:-4]) + decompressor.flush()
+    if struct.unpack('>I', stream[-4:])[0] != \
+        zlib.adler32(data) & 0xffffffff:
+      raise zlib.error('Corrupt stream')
+    return data
+
+# zlib header FLEVEL of each compression level
+_FLEVEL = [0, 0, 1, 1, 1, 1, 2, 3, 3, 3]
+
+def _check_response(r):
+  """ Raise the Sunnytrail exception matching a collector response """
+  if r.code == 403:
+    try:
+      data = simplejson.loads(r.read())
+      raise InvalidMessage('Invalid message: %s' % \
+        ", ".join(map(lambda e: e[1], data['errors'])), 
+        data['errors'])
+
+    except (TypeError, ValueError, KeyError, IndexError):
+      raise InvalidMessage('Invalid message: error unknown')
+
+  elif r.code == 401:
+    raise InvalidAPIKey()
+
+  elif r.code == 503:
+    raise ServiceUnavailable('Service unavailable', 
+      _retry_after(getattr(r, 'headers', None)))
+
+  elif r.code == 415:
+    raise UnsupportedEncoding()
+
+  elif r.code == 400:
+    raise BadRequest('Bad request')
+
+  elif 500 <= r.code < 600:
+    raise ServerError('Server error: %s' % r.code, r.code)
+
+  elif r.code != 202:
+    raise SunnytrailException("Unexpected server "\
+      "response code: %s" % r.code)
+
+def _join_body(parts, json):
+  """ A single message is posted as a JSON object, batches as arrays """
+  if not json:
+    return '&'.join(parts)
+  if len(parts) == 1:
+    return parts[0]
+  return '[%s]' % ','.join(parts)
+
+def _encode_body(messages, json):
+  if json:
+    return _join_body(messages, True)
+  return '&'.join([urlencode({'message': m}) for m in messages])
+
+def _socket_options(nodelay, keepalive, send_buffer_size):
+  """ setsockopt() arguments of the pooled connections """
+  options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay)),
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(keepalive))]
+  if send_buffer_size is not None:
+    options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer_size))
+  return options
+
+class _BaseClient(object):
+  """ Settings and batching rules shared by the clients """
+
+  def __init__(self, key, base_url, use_ssl, max_batch_size, 
+      max_batch_bytes):
+    self._key = key
+    self._max_batch_size = max_batch_size
+    self._max_batch_bytes = max_batch_bytes
+    if use_ssl:
+      self._base_url = "https://%s" % base_url
+    else:
+      self._base_url = "http://%s" % base_url
+      
+    self._messages_url = "%s/messages?%s" % \
+      (self._base_url, urllib.urlencode({'apikey': self._key}))
+    self._use_ssl = use_ssl
+
+  def _batches(self, messages, json=False, first=0):
+    """ Yield (start, end, data) tuples packing consecutive messages 
+    from the first-th on into bodies bounded by max_batch_size and 
+    max_batch_bytes. The bodies are form encoded, or JSON if json is 
+    true """
+    start, parts, size = first, [], 0
+
+    for i in xrange(first, len(messages)):
+      message = messages[i]
+      if json:
+        part = message
+      else:
+        part = urlencode({'message': message})
+      if parts and (len(parts) >= self._max_batch_size or \
+          size + len(part) > self._max_batch_bytes):
+        yield start, i, _join_body(parts, json)
+        start, parts, size = i, [], 0
+
+      parts.append(part)
+      size += len(part) + 1
+
+    if parts:
+      yield start, len(messages), _join_body(parts, json)
+
+  def _reject(self, results, start, end, e):
+    """ Map the errors of a rejected batch back to its messages.
+
+    Each entry of a batch rejection carries the position of the
+    offending message in the request as a third element. Entries 
+    without it invalidate the whole request. """
+    batch_errors = [err for err in e.errors if len(err) < 3]
+    if batch_errors or not e.errors:
+      for i in xrange(start, end):
+        results[i] = e
+      return
+
+    by_index = {}
+    for err in e.errors:
+      by_index.setdefault(err[2], []).append(err)
+
+    for index, errors in by_index.items():
+      try:
+        index = start + int(index)
+      except (TypeError, ValueError):
+        continue
+      if start <= index < end:
+        results[index] = InvalidMessage('Invalid message: %s' % \
+          ", ".join(map(lambda e: e[1], errors)), errors)
+
+class Sunnytrail(_BaseClient):
+  urlopen = SunnytrailOpener().open
+
+  def __init__(self, key, base_url='api.thesunnytrail.com', use_ssl=True,
+      keep_alive=True, max_idle_connections=4, 
+      max_batch_size=100, max_batch_bytes=512 * 1024, spool=None,
+      retry=None, breaker=None, connect_timeout=None, read_timeout=None,
+      deadline=None, compression=None, compression_level=6, 
+      min_compress_size=1024, dictionary=None, json_bodies=False,
+      tcp_nodelay=True, tcp_keepalive=False, send_buffer_size=None,
+      async_workers=4, async_drain_timeout=5.0, observer=None, 
+      metrics=None):
+    super(Sunnytrail, self).__init__(key, base_url, use_ssl, 
+      max_batch_size, max_batch_bytes)
+    self._async_workers = async_workers
+    self._async_drain_timeout = async_drain_timeout
+    self._async_sender = None
+    self._async_lock = threading.Lock()
+    self._spool = spool
+    self._retry = retry
+    self.breaker = breaker
+    self._connect_timeout = connect_timeout
+    self._read_timeout = read_timeout
+    self._deadline = deadline
+    self._metrics = metrics or MetricsRegistry()
+
+    if compression is not None and compression not in _WBITS:
+      raise ValueError('Unknown compression: %s' % compression)
+    if dictionary is not None and compression not in (None, 'deflate'):
+      raise ValueError('Preset dictionaries require deflate')
+    self._compression = compression
+    self._dictionary = dictionary
+    self._json = json_bodies
+    self._header_sets = {}
+    self._compression_level = compression_level
+    self._min_compress_size = min_compress_size
+
+    self._pool = None
+    self._pool_required = 'keep_alive=True'
+    scheme = use_ssl and 'https' or 'http'
+    if keep_alive and scheme in getproxies() and not proxy_bypass(base_url):
+      # pooled connections go straight to the collector
+      logging.info('Sending through the %s proxy without keep-alive', 
+        scheme)
+      self._pool_required = 'a direct connection, not the %s proxy' % \
+        scheme
+      keep_alive = False
+
+    if keep_alive:
+      self._pool = ConnectionPool(base_url, use_ssl, max_idle_connections,
+        socket_options=_socket_options(tcp_nodelay, tcp_keepalive, 
+        send_buffer_size), observer=observer)
+      self.urlopen = self._pool.open
+
+    elif self._timeouts() is not None:
+      raise ValueError('Timeouts require %s' % self._pool_required)
+
+    elif compression is not None or dictionary is not None:
+      raise ValueError('Compression requires %s' % self._pool_required)
+
+    elif json_bodies:
+      raise ValueError('JSON bodies require %s' % self._pool_required)
+
+    elif observer is not None:
+      raise ValueError('Observers require %s' % self._pool_required)
+
+  def metrics(self):
+    """ Snapshot of the metrics of the client, see MetricsRegistry.
+    Render it with prometheus_text() """
+    return self._metrics.snapshot()
+
+  def close(self, timeout=None):
+    """ Wait up to timeout seconds for the events sent with 
+    send_async() and release the pooled connections. Returns False if
+    some events were still being sent """
+    _forget_at_exit(self)
+    sender, self._async_sender = self._async_sender, None
+    drained = True
+    if sender is not None:
+      drained = sender.close(True, timeout)
+      if not drained:
+        logging.warning('Sunnytrail client closed with events still '\
+          'being sent')
+    if self._pool is not None:
+      self._pool.close()
+    return drained
+
+  def send_async(self, event, callback=None, block=False, timeout=None):
+    """ Send an event from a background worker. Returns a future 
+    resolving to None once the event is accepted, or failing with the
+    exception send() would have raised.
+
+    callback(future) is added as a done callback. Without one, failures
+    are logged. Up to async_workers threads send at the same time and
+    at most 4 times as many events are pending: beyond that this raises
+    DispatcherFull, unless block and timeout allow waiting. Pending 
+    events are sent on close() and for at most async_drain_timeout 
+    seconds at interpreter exit """
+    sender = self._async_sender
+    if sender is None:
+      self._async_lock.acquire()
+      try:
+        if self._async_sender is None:
+          borrowed = _Borrowed(self)
+          self._async_sender = ThreadPoolSender(lambda: borrowed, 
+            self._async_workers)
+          _close_at_exit(self, self._async_drain_timeout)
+        sender = self._async_sender
+      finally:
+        self._async_lock.release()
+
+    metrics = self._metrics
+    future = sender.send(event, block, timeout)
+    metrics.add('sunnytrail_async_pending')
+    future.add_done_callback(lambda future: 
+      metrics.add('sunnytrail_async_pending', (), -1))
+    future.add_done_callback(callback or _log_failed_future)
+    return future
+
+  def _timeouts(self, connect_timeout=None, read_timeout=None, 
+      deadline=None):
+    """ Timeouts for a call: the arguments override the defaults given
+    to the constructor. Returns None if there are none at all """
+    if connect_timeout is None: connect_timeout = self._connect_timeout
+    if read_timeout is None: read_timeout = self._read_timeout
+    if deadline is None: deadline = self._deadline
+
+    if connect_timeout is None and read_timeout is None and \
+        deadline is None:
+      return None
+    if self._pool is None:
+      raise ValueError('Timeouts require %s' % self._pool_required)
+    return _Timeouts(connect_timeout, read_timeout, deadline)
+
+  def send(self, event, connect_timeout=None, read_timeout=None, 
+      deadline=None):
+    """ Send an event to the API. If the client has a spool, events
+    that can't be delivered because the collector is unavailable or
+    failing are saved there instead of raising.
+
+    The timeouts default to the ones given to the constructor. The 
+    deadline bounds the whole call, retries included. A timeout 
+    raises SunnytrailTimeout """
+    message = event.to_json()
+    timeouts = self._timeouts(connect_timeout, read_timeout, deadline)
+    start, result, spooled = time(), None, ()
+    self._metrics.add('sunnytrail_sends_in_flight')
+    try:
+      try:
+        self._post([message], timeouts, self._json)
+
+      except (ServiceUnavailable, ServerError, IOError), e:
+        result = e
+        if self._spool is None: raise
+
+        logging.warning('Spooling event: %s', e)
+        self._spool.append(message)
+        spooled = (0,)
+
+      except:
+        result = sys.exc_info()[1]
+        raise
+    finally:
+      self._metrics.add('sunnytrail_sends_in_flight', (), -1)
+      self._record('send', start, [message], [result], spooled)
+
+  def send_many(self, events, connect_timeout=None, read_timeout=None,
+      deadline=None):
+    """ Send a sequence of events using as few requests as possible.
+
+    Returns a list with one entry per event: None if the event was
+    accepted or the exception explaining why it was not. An invalid
+    API key is raised right away. Events spooled because the
+    collector is unavailable count as accepted. Timeouts work as 
+    for send(), the deadline covering all the requests. 
+
+    events may also be an EventBatch. """
+    if isinstance(events, EventBatch):
+      messages = events.to_messages()
+    else:
+      messages = [e.to_json() for e in events]
+
+    return self._send_messages(messages, True,
+      self._timeouts(connect_timeout, read_timeout, deadline))
+
+  def _send_messages(self, messages, spool=True, timeouts=None, 
+      call='send_many'):
+    """ send_many() of encoded messages. The outcomes are recorded as
+    a call of that name, or not at all if it is None """
+    results = [None] * len(messages)
+    begin, spooled = time(), ()
+    self._metrics.add('sunnytrail_sends_in_flight')
+    try:
+      try:
+        start = 0
+        while start < len(messages):
+          json = self._json
+          for start, end, data in self._batches(messages, json, start):
+            try:
+              self._post(messages[start:end], timeouts, json, data)
+
+            except InvalidMessage, e:
+              self._reject(results, start, end, e)
+
+            except InvalidAPIKey:
+              raise
+
+            except (SunnytrailException, IOError), e:
+              # the collector is unreachable: don't hammer it with the rest
+              for i in xrange(start, len(messages)):
+                results[i] = e
+              end = len(messages)
+              break
+
+            if json and not self._json:
+              break # fell back to forms: pack the rest again
+          start = end
+
+        if spool and self._spool is not None:
+          spooled = self._spool_failed(messages, results)
+
+      except:
+        results = [sys.exc_info()[1]] * len(messages)
+        raise
+    finally:
+      self._metrics.add('sunnytrail_sends_in_flight', (), -1)
+      if call is not None:
+        self._record(call, begin, messages, results, spooled)
+
+    return results
+
+  def _record(self, call, start, messages, results, spooled=(), 
+      kept=False):
+    """ Time a send and count the outcome of each of its messages by
+    action. The messages at the spooled positions were saved to the 
+    spool. With kept, failed messages are still in the spool they are
+    replayed from and are not counted """
+    metrics = self._metrics
+    metrics.observe('sunnytrail_send_duration_seconds', (('call', call),),
+      time() - start)
+
+    spooled = set(spooled)
+    outcomes = {}
+    for i, result in enumerate(results):
+      if i in spooled:
+        name = 'sunnytrail_events_spooled_total'
+      elif result is None:
+        name = 'sunnytrail_events_sent_total'
+      elif isinstance(result, (InvalidMessage, InvalidAPIKey)):
+        name = 'sunnytrail_events_rejected_total'
+      elif kept:
+        continue
+      else:
+        name = 'sunnytrail_events_failed_total'
+      key = (name, _message_action(messages[i]))
+      outcomes[key] = outcomes.get(key, 0) + 1
+
+    for (name, action), count in outcomes.iteritems():
+      metrics.add(name, (('action', action),), count)
+
+  def _count_retry(self, messages):
+    for message in messages:
+      self._metrics.add('sunnytrail_events_retried_total', 
+        (('action', _message_action(message)),))
+
+  def _spool_failed(self, messages, results):
+    """ Spool the messages that failed because the collector is
+    unavailable or failing. Returns their positions """
+    failed = [i for i, r in enumerate(results) \
+      if isinstance(r, (ServiceUnavailable, ServerError, IOError))]
+    if not failed: return failed
+
+    logging.warning('Spooling %d events: %s', len(failed), 
+      results[failed[0]])
+    self._spool.extend([messages[i] for i in failed])
+    for i in failed:
+      results[i] = None
+    return failed
+
+  def _post(self, messages, timeouts=None, json=False, data=None,
+      use_dictionary=True):
+    """ POST messages in a single request, retrying as the retry policy
+    allows. data is their body when already encoded.
+
+    When the collector can't decode the body, JSON and then the 
+    preset dictionary are given up for the rest of the client life. A
+    400 response to a body using the dictionary is tried again without
+    it, and the dictionary given up if that succeeds """
+    if data is None:
+      data = _encode_body(messages, json)
+    dictionary = None
+    if use_dictionary:
+      dictionary = self._dictionary
+    body, encoding = self._compress(data, dictionary)
+    headers = self._headers(json, encoding, dictionary)
+
+    try:
+      if self._retry is None:
+        return self._attempt(body, timeouts, headers)
+      return self._retry.call(self._attempt, body, timeouts, headers,
+        expires=timeouts and timeouts.expires, 
+        on_retry=lambda e: self._count_retry(messages))
+
+    except UnsupportedEncoding:
+      if json:
+        logging.warning('The collector does not accept JSON bodies: '\
+          'falling back to form encoding')
+        self._json = False
+      elif dictionary is not None:
+        logging.warning('The collector does not know the preset '\
+          'dictionary %08x: no longer using it', dictionary.id)
+        self._dictionary = None
+      else:
+        raise
+      return self._post(messages, timeouts, self._json, None, 
+        use_dictionary)
+
+    except BadRequest:
+      if dictionary is None: raise
+      # some collectors answer 400 to a dictionary they don't know: 
+      # if the same messages go through without it, it was the problem
+      result = self._post(messages, timeouts, json, data, False)
+      logging.warning('The collector refused the preset dictionary '\
+        '%08x: no longer using it', dictionary.id)
+      if self._dictionary is dictionary:
+        self._dictionary = None
+      return result
+
+  def _compress(self, data, dictionary):
+    """ Return the body to send for data and its Content-Encoding """
+    if dictionary is not None:
+      return dictionary.compress(data, self._compression_level), 'deflate'
+
+    if self._compression is not None and \
+        len(data) >= self._min_compress_size:
+      return _compress(data, self._compression, self._compression_level), \
+        self._compression
+    return data, None
+
+  def _headers(self, json, encoding, dictionary):
+    """ Extra request headers, as a tuple of pairs so that the 
+    connection pool can reuse the request preamble made for them """
+    key = (json, encoding, dictionary)
+    try:
+      return self._header_sets[key]
+    except KeyError:
+      pass
+
+    headers = []
+    if json:
+      headers.append(('Content-Type', 'application/json'))
+    if encoding is not None:
+      headers.append(('Content-Encoding', encoding))
+    if dictionary is not None:
+      headers.append(('X-Sunnytrail-Dictionary', '%08x' % dictionary.id))
+
+    self._header_sets[key] = headers = tuple(headers) or None
+    return headers
+
+  def _attempt(self, data, timeouts, headers):
+    if self.breaker is None:
+      return self._post_once(data, timeouts, headers)
+    return self.breaker.call(self._post_once, data, timeouts, headers)
+
+  def _post_once(self, data, timeouts, headers=None):
+    """ POST an encoded body to the collector and map the error 
+    responses onto Sunnytrail exceptions """
+    metrics, start = self._metrics, time()
+    metrics.add('sunnytrail_requests_in_flight')
+    try:
+      try:
+        if timeouts is None and headers is None:
+          r = self.urlopen(self._messages_url, data)
+        else:
+          r = self.urlopen(self._messages_url, data, timeouts, headers)
+      finally:
+        metrics.add('sunnytrail_requests_in_flight', (), -1)
+        metrics.observe('sunnytrail_request_duration_seconds', (), 
+          time() - start)
+      _check_response(r)
+      r.close()
+
+    except IOError, e:
+      if len(e.args) < 2: raise
+
+      err, code = e.args[:2]
+      if err != 'http error': raise
+
+      if code == 401:
+        raise InvalidAPIKey()
+
+      elif code == 503:
+        headers = len(e.args) > 3 and e.args[3] or None
+        raise ServiceUnavailable('Service unavailable', 
+          _retry_after(headers))
+
+      elif 500 <= code < 600:
+        raise ServerError('Server error: %s' % code, code)
+
+      raise
+
+class Spool(object):
+  """ Durable append-only queue of serialized messages.
+
+  Messages are appended to numbered segment files as length and CRC
+  prefixed records and read back in order from a persistent cursor.
+  Every append reaches the OS right away, so it survives a crash of
+  the process, and the segment is fsync'ed every sync_every appends
+  or sync_interval seconds. A spool directory must not be shared by 
+  several processes at the same time. """
+
+  _HEADER = 18 # '%08x %08x ' % (length, crc)
+
+  def __init__(self, path, segment_size=64 * 1024 * 1024, 
+      sync_every=1000, sync_interval=1.0):
+    self._path = path
+    self._segment_size = segment_size
+    self._sync_every = sync_every
+    self._sync_interval = sync_interval
+    self._lock = threading.Lock()
+
+    if not os.path.isdir(path):
+      os.makedirs(path)
+
+    self._cursor = self._load_cursor()
+
+    # never append after a record that may have been torn by a crash
+    segments = self._segments()
+    self._open_segment((segments and segments[-1] or 0) + 1)
+
+  def _segment_path(self, segment):
+    return os.path.join(self._path, '%08d.spool' % segment)
+
+  def _segments(self):
+    segments = []
+    for name in os.listdir(self._path):
+      if name.endswith('.spool'):
+        try:
+          segments.append(int(name[:-6]))
+        except ValueError:
+          pass
+    segments.sort()
+    return segments
+
+  def _open_segment(self, segment):
+    self._segment = segment
+    self._fd = os.open(self._segment_path(segment),
+      os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0600)
+    self._size = 0
+    self._unsynced = 0
+    self._last_sync = time()
+
+  def _load_cursor(self):
+    try:
+      f = open(os.path.join(self._path, 'cursor'))
+      try:
+        segment, offset = f.read().split()
+        return int(segment), int(offset)
+      finally:
+        f.close()
+    except (IOError, ValueError):
+      return 0, 0
+
+  def _save_cursor(self, position):
+    path = os.path.join(self._path, 'cursor')
+    f = open(path + '.tmp', 'w')
+    try:
+      f.write('%d %d\n' % position)
+      f.flush()
+      os.fsync(f.fileno())
+    finally:
+      f.close()
+    os.rename(path + '.tmp', path)
+
+  def append(self, message):
+    """ Add a message at the end of the spool """
+    self.extend([message])
+
+  def extend(self, messages):
+    """ Add several messages with a single write """
+    records = ''.join(['%08x %08x %s\n' % (len(m), 
+      zlib.crc32(m) & 0xffffffff, m) for m in messages])
+
+    self._lock.acquire()
+    try:
+      os.write(self._fd, records)
+      self._size += len(records)
+      self._unsynced += len(messages)
+
+      if self._size >= self._segment_size:
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._open_segment(self._segment + 1)
+
+      elif self._unsynced >= self._sync_every or \
+          time() - self._last_sync >= self._sync_interval:
+        self._sync()
+    finally:
+      self._lock.release()
+
+  def _sync(self):
+    os.fsync(self._fd)
+    self._unsynced = 0
+    self._last_sync = time()
+
+  def sync(self):
+    """ Force the appended messages to disk """
+    self._lock.acquire()
+    try:
+      self._sync()
+    finally:
+      self._lock.release()
+
+  def read(self, count=1000):
+    """ Return up to count (message, position) tuples, oldest first,
+    without moving the cursor. Pass a position to commit() once the 
+    messages up to it have been handled """
+    records = []
+
+    self._lock.acquire()
+    try:
+      cursor_segment, cursor_offset = self._cursor
+      for segment in self._segments():
+        if segment < cursor_segment: continue
+        offset = (segment == cursor_segment) and cursor_offset or 0
+
+        f = open(self._segment_path(segment), 'rb')
+        try:
+          f.seek(offset)
+          while len(records) < count:
+            record = self._read_record(f)
+            if record is None: break
+            offset += self._HEADER + len(record) + 1
+            records.append((record, (segment, offset)))
+        finally:
+          f.close()
+
+        if len(records) >= count: break
+    finally:
+      self._lock.release()
+
+    return records
+
+  def _read_record(self, f):
+    """ Return the next message in f or None at the end of the 
+    segment or at a record torn by a crash """
+    header = f.read(self._HEADER)
+    if not header: return None
+
+    try:
+      length, crc = int(header[:8], 16), int(header[9:17], 16)
+    except ValueError:
+      length, crc = -1, None
+
+    if length >= 0:
+      data = f.read(length + 1)
+      if len(data) == length + 1 and data[-1] == '\n' and \
+          zlib.crc32(data[:-1]) & 0xffffffff == crc:
+        return data[:-1]
+
+    logging.warning('Skipping the damaged end of spool segment %s', 
+      f.name)
+    return None
+
+  def commit(self, position):
+    """ Move the cursor past the messages read up to position and 
+    delete the segments that were fully consumed """
+    self._lock.acquire()
+    try:
+      self._save_cursor(position)
+      self._cursor = position
+
+      for segment in self._segments():
+        if segment >= min(position[0], self._segment): break
+        os.unlink(self._segment_path(segment))
+    finally:
+      self._lock.release()
+
+  def close(self):
+    self._lock.acquire()
+    try:
+      if self._fd is not None:
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._fd = None
+    finally:
+      self._lock.release()
+
+class SpoolReplayer(object):
+  """ Deliver the messages saved in a spool, oldest first.
+
+  Delivery is at-least-once: a crash between a send and the commit of
+  the cursor sends those messages again on the next replay. A request
+  rejected as a whole is split and sent again until the invalid 
+  messages are alone, so that only they are dropped. """
+
+  def __init__(self, client, spool, batch_size=1000):
+    self._client = client
+    self._spool = spool
+    self._batch_size = batch_size
+
+  def replay(self):
+    """ Send spooled messages until the spool is empty or the 
+    collector fails again. Returns the number of messages removed 
+    from the spool, including the ones rejected by the server """
+    handled = 0
+
+    while True:
+      records = self._spool.read(self._batch_size)
+      if not records: break
+
+      messages = [message for message, position in records]
+      start = time()
+      results = self._send(messages)
+      self._client._record('replay', start, messages, results, kept=True)
+
+      position = None
+      for (message, next_position), result in zip(records, results):
+        if result is not None:
+          if not isinstance(result, InvalidMessage): break
+          logging.warning('Dropping spooled message: %s', result)
+        position = next_position
+        handled += 1
+
+      if position is not None:
+        self._spool.commit(position)
+
+      if position != records[-1][1]:
+        logging.warning('Spool replay interrupted: %s', result)
+        break
+
+    return handled
+
+  def _send(self, messages):
+    """ Send messages and return their results. Runs of messages 
+    sharing a rejection without positions are halved and sent again """
+    results = self._client._send_messages(messages, False, None, None)
+
+    start = 0
+    while start < len(results):
+      result, end = results[start], start + 1
+      while end < len(results) and results[end] is result:
+        end += 1
+
+      if isinstance(result, InvalidMessage) and end - start > 1:
+        middle = (start + end) // 2
+        results[start:middle] = self._send(messages[start:middle])
+        failed = [r for r in results[start:middle] 
+          if r is not None and not isinstance(r, InvalidMessage)]
+        if failed: # the collector is unavailable again
+          results[middle:end] = [failed[0]] * (end - middle)
+        else:
+          results[middle:end] = self._send(messages[middle:end])
+      start = end
+
+    return results
+
+class _Marker(object):
+  """ Queue item asking the dispatcher thread to flush or stop """
+
+  def __init__(self, stop=False):
+    self.stop = stop
+    self.done = threading.Event()
+
+def _log_failure(event, e):
+  logging.error('Failed to send event: %s', e)
+
+# close() calls to make at interpreter exit, by id of the object: 
+# unlike atexit handlers they are forgotten once the object is closed
+_exit_closers = {}
+
+def _close_at_exit(obj, *args):
+  _exit_closers[id(obj)] = (obj.close, args)
+
+def _forget_at_exit(obj):
+  _exit_closers.pop(id(obj), None)
+
+def _close_all():
+  for close, args in _exit_closers.values():
+    try:
+      close(*args)
+    except Exception, e:
+      logging.exception(e)
+
+atexit.register(_close_all)
+
+def _remaining(start, timeout):
+  """ What is left of timeout seconds counted from start, or None """
+  if timeout is None:
+    return None
+  return max(0, start + timeout - time())
+
+class BatchDispatcher(object):
+  """ Accept events into a bounded in-memory queue and send them
+  from a background thread.
+
+  A batch is sent as soon as batch_size events are waiting or 
+  flush_interval seconds after its first event was queued. Events 
+  that can't be delivered are reported to on_error(event, exception).
+  At interpreter exit the queue is drained for at most drain_timeout
+  seconds. """
+
+  def __init__(self, client, batch_size=100, flush_interval=0.5,
+      max_queue_size=10000, drain_timeout=5.0, on_error=_log_failure):
+    self._client = client
+    self._batch_size = batch_size
+    self._flush_interval = flush_interval
+    self._drain_timeout = drain_timeout
+    self._on_error = on_error
+
+    self._queue = Queue.Queue(max_queue_size)
+    self._closed = self._stop_queued = False
+
+    self._thread = threading.Thread(target=self._run,
+      name='sunnytrail-dispatcher')
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+    _close_at_exit(self, drain_timeout)
+
+  def send(self, event, block=False, timeout=None):
+    """ Queue an event. Raises DispatcherFull if the queue is still
+    full after waiting as instructed by block and timeout """
+    if self._closed:
+      raise SunnytrailException('Dispatcher is closed')
+    try:
+      self._queue.put(event, block, timeout)
+    except Queue.Full:
+      raise DispatcherFull('Dispatcher queue is full')
+
+  def flush(self, timeout=None):
+    """ Wait until all the events queued so far were sent. Returns 
+    False if the timeout expired first """
+    if self._closed:
+      return not self._thread.isAlive()
+    start, marker = time(), _Marker()
+    try:
+      self._queue.put(marker, True, timeout)
+    except Queue.Full:
+      return False
+    marker.done.wait(_remaining(start, timeout))
+    return marker.done.isSet()
+
+  def close(self, timeout=None):
+    """ Send the queued events and stop the background thread. Returns
+    False if they were not all sent before the timeout expired """
+    self._closed = True
+    _forget_at_exit(self)
+    start = time()
+    if not self._stop_queued:
+      try:
+        self._queue.put(_Marker(stop=True), True, timeout)
+        self._stop_queued = True
+      except Queue.Full:
+        pass
+
+    self._thread.join(_remaining(start, timeout))
+    if self._thread.isAlive():
+      logging.warning('Sunnytrail dispatcher closed with %d events '\
+        'still queued', self._queue.qsize())
+      return False
+    return True
+
+  def _run(self):
+    batch, deadline = [], None
+
+    while True:
+      timeout = None
+      if batch:
+        timeout = max(0, deadline - time())
+
+      try:
+        item = self._queue.get(True, timeout)
+      except Queue.Empty:
+        item = None
+
+      if item is not None and not isinstance(item, _Marker):
+        if not batch:
+          deadline = time() + self._flush_interval
+        batch.append(item)
+        if len(batch) < self._batch_size:
+          continue
+
+      if batch:
+        self._dispatch(batch)
+        batch = []
+
+      if isinstance(item, _Marker):
+        item.done.set()
+        if item.stop: return
+
+  def _dispatch(self, batch):
+    try:
+      results = self._client.send_many(batch)
+    except Exception, e:
+      results = [e] * len(batch)
+
+    for event, result in zip(batch, results):
+      if result is not None:
+        try:
+          self._on_error(event, result)
+        except Exception, e:
+          logging.exception(e)
+ 
+class _Future(object):
+  """ The parts of concurrent.futures.Future used by the senders, for 
+  when the futures backport is not installed. Futures can't be 
+  cancelled. result() raises sunnytrail.TimeoutError on timeouts, which
+  is concurrent.futures.TimeoutError when the backport is installed """
+
+  def __init__(self):
+    self._running = False
+    self._done = threading.Event()
+    self._lock = threading.Lock()
+    self._result = self._exception = None
+    self._callbacks = []
+
+  def cancel(self): return False
+
+  def cancelled(self): return False
+
+  def running(self): return self._running and not self.done()
+
+  def done(self): return self._done.isSet()
+
+  def result(self, timeout=None):
+    self._wait(timeout)
+    if self._exception is not None:
+      raise self._exception
+    return self._result
+
+  def exception(self, timeout=None):
+    self._wait(timeout)
+    return self._exception
+
+  def add_done_callback(self, fn):
+    self._lock.acquire()
+    try:
+      if not self.done():
+        self._callbacks.append(fn)
+        return
+    finally:
+      self._lock.release()
+    fn(self)
+
+  def set_running_or_notify_cancel(self):
+    self._running = True
+    return True
+
+  def set_result(self, result):
+    self._result = result
+    self._finish()
+
+  def set_exception(self, exception):
+    self._exception = exception
+    self._finish()
+
+  def _wait(self, timeout):
+    self._done.wait(timeout)
+    if not self._done.isSet():
+      raise TimeoutError('Future not done after %ss' % timeout)
+
+  def _finish(self):
+    self._lock.acquire()
+    try:
+      self._done.set()
+      callbacks, self._callbacks = self._callbacks, []
+    finally:
+      self._lock.release()
+
+    for fn in callbacks:
+      try:
+        fn(self)
+      except Exception, e:
+        logging.exception(e)
+
+if Future is None:
+  Future = _Future
+
+def _log_failed_future(future):
+  e = future.exception()
+  if e is not None:
+    logging.error('Failed to send event: %s', e)
+
+class ThreadPoolSender(object):
+  """ Send events concurrently from a pool of worker threads.
+
+  Each worker sends with its own client, made by client_factory(), and
+  so over its own connections. At most max_in_flight requests are 
+  queued or being sent: submitting more blocks until one completes, or
+  raises DispatcherFull when told not to wait. Results come back as 
+  futures (concurrent.futures.Future when available) """
+
+  def __init__(self, client_factory, workers=8, max_in_flight=None,
+      batch_size=100):
+    self._client_factory = client_factory
+    self._batch_size = batch_size
+    # one item per request queued or being sent
+    self._in_flight = Queue.Queue(max_in_flight or workers * 4)
+    self._tasks = Queue.Queue()
+    self._closed = False
+
+    self._threads = []
+    for i in xrange(workers):
+      thread = threading.Thread(target=self._run, 
+        name='sunnytrail-sender-%d' % i)
+      thread.setDaemon(True)
+      thread.start()
+      self._threads.append(thread)
+
+  def send(self, event, block=True, timeout=None):
+    """ Queue an event. Returns a future resolving to None once the 
+    event was accepted, or failing with the exception that prevented 
+    it, e.g. InvalidMessage. Raises DispatcherFull if max_in_flight 
+    requests are still pending after waiting as instructed by block 
+    and timeout """
+    future = Future()
+    self._submit(future, [event], True, block, timeout)
+    return future
+
+  def send_many(self, events):
+    """ Queue events in batches of batch_size. events may be any 
+    iterable: it is consumed as the in-flight requests allow. Returns 
+    one future per batch resolving to the list of results of its 
+    events, as returned by Sunnytrail.send_many """
+    futures, batch = [], []
+    for event in events:
+      batch.append(event)
+      if len(batch) >= self._batch_size:
+        futures.append(self._submit_batch(batch))
+        batch = []
+
+    if batch:
+      futures.append(self._submit_batch(batch))
+    return futures
+
+  def close(self, wait=True, timeout=None):
+    """ Stop the workers once the queued events are sent. Returns False
+    if they were still sending when the timeout expired """
+    if not self._closed:
+      self._closed = True
+      for thread in self._threads:
+        self._tasks.put(None)
+    if not wait:
+      return True
+
+    start = time()
+    for thread in self._threads:
+      thread.join(_remaining(start, timeout))
+      if thread.isAlive():
+        return False
+    return True
+
+  def _submit_batch(self, events):
+    future = Future()
+    self._submit(future, events, False)
+    return future
+
+  def _submit(self, future, events, single, block=True, timeout=None):
+    if self._closed:
+      raise SunnytrailException('Sender is closed')
+    try:
+      self._in_flight.put(None, block, timeout)
+    except Queue.Full:
+      raise DispatcherFull('Too many requests in flight')
+    self._tasks.put((future, events, single))
+
+  def _run(self):
+    clients = []
+    try:
+      while True:
+        task = self._tasks.get()
+        if task is None: return
+
+        future, events, single = task
+        try:
+          if future.set_running_or_notify_cancel():
+            self._send(clients, future, events, single)
+        finally:
+          self._in_flight.get_nowait()
+    finally:
+      for client in clients:
+        client.close()
+
+  def _send(self, clients, future, events, single):
+    result = None
+    try:
+      if not clients:
+        clients.append(self._client_factory())
+      if single:
+        clients[0].send(events[0])
+      else:
+        result = clients[0].send_many(events)
+
+    except Exception, e:
+      future.set_exception(e)
+      return
+    future.set_result(result)
+
+class _Borrowed(object):
+  """ A client lent to the workers of a ThreadPoolSender, which close 
+  their clients when they stop: this one belongs to its owner """
+
+  def __init__(self, client):
+    self._client = client
+
+  def send(self, event): return self._client.send(event)
+
+  def send_many(self, events): return self._client.send_many(events)
+
+  def close(self): pass
+
+class _RawEvent(object):
+  """ An event received already serialized by the relay """
+  __slots__ = ('_message',)
+
+  def __init__(self, message):
+    self._message = message
+
+  def to_json(self):
+    return self._message
+
+# large enough for any event, below the 64KB limit of UDP
+_MAX_DATAGRAM = 65000
+
+def _datagram_socket(address):
+  """ A datagram socket for a Unix socket path or a (host, port) """
+  if isinstance(address, basestring):
+    return socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+  return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+def _is_socket(path):
+  try:
+    return stat.S_ISSOCK(os.lstat(path).st_mode)
+  except OSError:
+    return False
+
+class Relay(object):
+  """ Forward the events of the local producers to the collector.
+
+  Producers send serialized events with a RelayClient, one datagram 
+  per event, to a Unix socket path or a localhost (host, port). The 
+  relay batches the events of all the producers and sends them from a 
+  BatchDispatcher over the connection pool of client. Give the client
+  a spool to keep the events while the collector is down: the spool is
+  replayed every replay_interval seconds. 
+
+  A Unix socket is only accessible to the user running the relay. A 
+  socket left behind at its path is replaced, but any other file there
+  raises ValueError. """
+
+  def __init__(self, client, address, batch_size=100, flush_interval=0.5,
+      max_queue_size=10000, replay_interval=30.0):
+    self.address = address
+    self._client = client
+    self._closed = threading.Event()
+    self.received = 0
+
+    unix = isinstance(address, basestring)
+    if unix and os.path.lexists(address):
+      if not _is_socket(address):
+        raise ValueError('%s exists and is not a socket' % address)
+      os.unlink(address) # left behind by a relay that died
+    self._socket = _datagram_socket(address)
+    self._socket.bind(address)
+    if unix:
+      # other users could send events under our API key
+      os.chmod(address, 0600)
+    self._socket.settimeout(0.5)
+    self.address = self._socket.getsockname() # the port bound to 0
+
+    self._dispatcher = BatchDispatcher(client, batch_size, flush_interval,
+      max_queue_size)
+
+    self._replayer = None
+    if client._spool is not None:
+      self._replayer = threading.Thread(target=self._replay, 
+        args=(replay_interval,), name='sunnytrail-relay-replay')
+      self._replayer.setDaemon(True)
+      self._replayer.start()
+
+  def serve_forever(self):
+    """ Forward events until close() is called """
+    sock, dispatcher = self._socket, self._dispatcher
+
+    while not self._closed.isSet():
+      try:
+        message = sock.recv(_MAX_DATAGRAM)
+      except socket.timeout:
+        continue
+      except socket.error, e:
+        if self._closed.isSet(): break
+        if e.args[0] == errno.EINTR: continue
+        raise
+
+      if message:
+        # wait for room: producers block on the full socket buffer
+        dispatcher.send(_RawEvent(message), True)
+        self.received += 1
+
+  def flush(self, timeout=None):
+    """ Wait until the events received so far were sent. Returns False
+    if the timeout expired first """
+    return self._dispatcher.flush(timeout)
+
+  def close(self, timeout=None):
+    """ Stop receiving and send the queued events """
+    self._closed.set()
+    self._socket.close()
+    if isinstance(self.address, basestring) and _is_socket(self.address):
+      os.unlink(self.address)
+
+    self._dispatcher.close(timeout)
+    if self._replayer is not None:
+      self._replayer.join(timeout)
+
+  def _replay(self, interval):
+    replayer = SpoolReplayer(self._client, self._client._spool)
+    while True:
+      self._closed.wait(interval)
+      if self._closed.isSet(): return
+      try:
+        replayer.replay()
+      except Exception, e:
+        logging.exception(e)
+
+class RelayClient(object):
+  """ Send events to a local Relay with a single socket write each.
+
+  Raises ServiceUnavailable if the relay is not running and 
+  SunnytrailTimeout if it did not make room for the event within
+  timeout seconds. Validation errors can't be reported back: the 
+  relay logs them. """
+
+  def __init__(self, address='/tmp/sunnytrail.sock', timeout=1.0):
+    self.address = address
+    self._timeout = timeout
+    self._socket = None
+
+  def send(self, event, connect_timeout=None, read_timeout=None,
+      deadline=None):
+    """ Send an event. Only deadline is meaningful for a local relay:
+    it overrides the timeout given to the constructor """
+    if deadline is None: deadline = self._timeout
+    message = event.to_json()
+    if len(message) > _MAX_DATAGRAM:
+      raise InvalidMessage('Event too large for the relay')
+
+    try:
+      sock = self._socket
+      if sock is None:
+        sock = self._socket = _datagram_socket(self.address)
+        sock.connect(self.address)
+      sock.settimeout(deadline)
+      sock.send(message)
+
+    except socket.timeout:
+      raise SunnytrailTimeout('Relay is not keeping up')
 
-class InvalidMessage(SunnytrailException):
-  """ Message validation failed on the server """
-  pass
+    except socket.error, e:
+      # the relay may come back with a new socket: reconnect next time
+      self.close()
+      raise ServiceUnavailable('Relay unavailable: %s' % e)
 
-class InvalidAPIKey(SunnytrailException):
-  """ Invalid Sunnytrail API Key """
-  pass 
+  def close(self):
+    if self._socket is not None:
+      self._socket.close()
+      self._socket = None
 
-class ServiceUnavailable(SunnytrailException):
-  """ The Sunnytrail message collector is not available """
-  pass
+class _ResponseParser(object):
+  """ Incremental parser for the responses read by AsyncSunnytrail """
 
-class Sunnytrail(object):
-  urlopen = SunnytrailOpener().open
+  def __init__(self):
+    self._buffer = ''
+    self._chunks = []
+    self._length = None
+    self._chunked = False
+    self.code = self.headers = self.body = None
+    self.will_close = False
 
-  def __init__(self, key, base_url='api.thesunnytrail.com', use_ssl=True):
-    self._key = key
-    if use_ssl:
-      self._base_url = "https://%s" % base_url
-    else:
-      self._base_url = "http://%s" % base_url
-      
-    self._messages_url = "%s/messages?%s" % \
-      (self._base_url, urllib.urlencode({'apikey': self._key}))
+  def feed(self, data):
+    """ Consume data and return True once the response is complete """
+    self._buffer += data
+
+    if self.headers is None:
+      end = self._buffer.find('\r\n\r\n')
+      if end < 0: return False
+
+      head, self._buffer = self._buffer[:end + 2], self._buffer[end + 4:]
+      status, head = head.split('\r\n', 1)
+      version, code = status.split(None, 2)[:2]
+
+      self.code = int(code)
+      self.headers = mimetools.Message(StringIO(head + '\r\n'))
+
+      connection = (self.headers.getheader('connection') or '').lower()
+      self.will_close = connection == 'close' or \
+        (version == 'HTTP/1.0' and connection != 'keep-alive')
+
+      encoding = self.headers.getheader('transfer-encoding') or ''
+      self._chunked = 'chunked' in encoding.lower()
+      length = self.headers.getheader('content-length')
+
+      if self.code in (204, 304) or 100 <= self.code < 200:
+        self._length = 0
+      elif not self._chunked and length is not None:
+        self._length = int(length)
+      elif not self._chunked:
+        # the body ends when the server closes the connection
+        self.will_close = True
+
+    if self._chunked:
+      return self._feed_chunks()
+
+    if self._length is not None and len(self._buffer) >= self._length:
+      self.body = self._buffer[:self._length]
+      return True
+
+    return False
+
+  def _feed_chunks(self):
+    while True:
+      end = self._buffer.find('\r\n')
+      if end < 0: return False
+
+      size = int(self._buffer[:end].split(';')[0], 16)
+      if size == 0:
+        if self._buffer.find('\r\n\r\n', end) < 0: return False
+        self.body = ''.join(self._chunks)
+        return True
+
+      if len(self._buffer) < end + size + 4: return False
+      self._chunks.append(self._buffer[end + 2:end + 2 + size])
+      self._buffer = self._buffer[end + size + 4:]
+
+  def eof(self):
+    """ The peer closed the connection. Returns True if that 
+    completed the response """
+    if self.headers is not None and self.body is None and \
+        not self._chunked and self._length is None:
+      self.body = self._buffer
+      return True
+    return False
+
+class _AsyncResolver(asyncore.file_dispatcher):
+  """ Resolve an address from a thread, as getaddrinfo() would block 
+  the event loop, and pass the (family, address) pairs found or the 
+  socket.error to callback from the loop """
+
+  def __init__(self, host, port, callback, map):
+    read, self._write = os.pipe()
+    asyncore.file_dispatcher.__init__(self, read, map)
+    os.close(read) # file_dispatcher uses a copy
+    self._callback = callback
+    self._result = None
+
+    thread = threading.Thread(target=self._resolve, args=(host, port))
+    thread.setDaemon(True)
+    thread.start()
+
+  def _resolve(self, host, port):
+    try:
+      self._result = [(info[0], info[4]) for info in 
+        socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)]
+    except socket.error, e:
+      self._result = e
+
+    try:
+      os.write(self._write, 'x')
+    except OSError: # the client was closed meanwhile
+      pass
+    os.close(self._write)
+
+  def writable(self): return False
+
+  def handle_read(self):
+    self.close()
+    self._callback(self._result)
+
+# seconds the addresses of the collector are used before resolving again
+_ASYNC_RESOLVE_INTERVAL = 60
+
+class _AsyncConnection(asyncore.dispatcher):
+  """ Non-blocking keep-alive connection owned by an AsyncSunnytrail.
+  It carries one request at a time. The addresses are tried in turn
+  until a connection succeeds. """
+
+  def __init__(self, client, host, addresses, use_ssl, map):
+    asyncore.dispatcher.__init__(self, map=map)
+    self._client = client
+    self._host = host
+    self._addresses = list(addresses)
     self._use_ssl = use_ssl
+    self._handshaking = None
+    self._out = ''
+    self._request = None
+    self._parser = None
+    self._reused = False
+    self._expires = None
+
+    self._connect_next()
 
-  def send(self, event):
-    """ Send an event to the API """
+  def _connect_next(self):
+    """ Connect to the next address. Raises socket.error when the 
+    last one failed """
+    while True:
+      family, address = self._addresses.pop(0)
+      self.create_socket(family, socket.SOCK_STREAM)
+      try:
+        self.connect(address)
+        return
+      except socket.error:
+        self.close()
+        if not self._addresses: raise
+
+  def start(self, request, reused, timeout=None):
+    self._request = request
+    self._reused = reused
+    self._parser = _ResponseParser()
+    self._out = request.data
+    self._expires = None
+    if timeout is not None:
+      self._expires = time() + timeout
+
+  def readable(self):
+    # asyncore asks before each poll: the request timeout is checked here
+    if self._request is not None and self._expires is not None and \
+        time() >= self._expires:
+      self._out, self._handshaking = '', None
+      self._lost(SunnytrailTimeout('Request timed out'), False)
+      return False
+    return not self.connecting
+
+  def writable(self):
+    if self._handshaking:
+      return self._handshaking == 'write'
+    return self.connecting or bool(self._out)
+
+  def handle_connect(self):
+    if not self._use_ssl: return
+
+    if hasattr(ssl, 'create_default_context'):
+      self.socket = ssl.create_default_context().wrap_socket(self.socket,
+        server_hostname=self._host, do_handshake_on_connect=False)
+    else:
+      self.socket = ssl.wrap_socket(self.socket, 
+        do_handshake_on_connect=False)
+
+    self._handshaking = 'write'
+    self._handshake()
+
+  def _handshake(self):
     try:
-      r = self.urlopen(self._messages_url, 
-        urlencode({'message': event.to_json()}))
+      self.socket.do_handshake()
+    except ssl.SSLError, e:
+      if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+        self._handshaking = 'read'
+      elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+        self._handshaking = 'write'
+      else:
+        raise
+      return
+    self._handshaking = None
 
-      if r.code == 403:
-        try:
-          data = simplejson.loads(r.read())
-          raise InvalidMessage('Invalid message: %s' % \
-            ", ".join(map(lambda e: e[1], data['errors'])))
+  def handle_read(self):
+    if self._handshaking:
+      return self._handshake()
 
-        except (TypeError, ValueError):
-          raise InvalidMessage('Invalid message: error unknown')
+    while True:
+      try:
+        data = self.socket.recv(65536)
+      except socket.error, e:
+        if _would_block(e): return
+        raise
 
-      elif r.code != 202:
-        raise SunnytrailException("Unexpected server "\
-          "response code: %s" % r.code)
+      if not data:
+        return self.handle_close()
 
-      r.close()
+      if self._request is None:
+        # nothing was asked: the idle connection is no longer usable
+        return self._lost(None)
 
-    except IOError, e:
-      err, code = e.args[:2]
-      if err != 'http error': raise
+      if self._parser.feed(data):
+        return self._finish()
 
-      if code == 401:
-        raise InvalidAPIKey()
+      # SSL may hold decrypted data the socket won't signal again
+      if not self._use_ssl or not self.socket.pending():
+        return
 
-      elif code == 503:
-        raise ServiceUnavailable()
+  def handle_write(self):
+    if self._handshaking:
+      return self._handshake()
 
+    try:
+      sent = self.socket.send(self._out)
+    except socket.error, e:
+      if _would_block(e): return
       raise
- 
+    self._out = self._out[sent:]
+
+  def handle_close(self):
+    if self._parser is not None and self._parser.eof():
+      return self._finish()
+    self._lost(IOError('socket error', 'connection closed'))
+
+  def handle_error(self):
+    e = sys.exc_info()[1]
+    if self.connecting and self._addresses and isinstance(e, socket.error):
+      self.close()
+      try:
+        return self._connect_next()
+      except socket.error, e:
+        pass
+    self._lost(e)
+
+  def _finish(self):
+    request, parser = self._request, self._parser
+    self._request = self._parser = None
+
+    if parser.will_close:
+      self.close()
+    self._client._finished(self, request, parser, None, False)
+
+  def _lost(self, e, may_retry=True):
+    request, parser = self._request, self._parser
+    self._request = self._parser = None
+    self.close()
+
+    # a reused connection closed before answering was most likely
+    # dropped by the server while idle: the request can be retried
+    retry = may_retry and self._reused and parser is not None and \
+      parser.code is None
+    self._client._finished(self, request, None, e, retry)
+
+def _would_block(e):
+  if ssl is not None and isinstance(e, ssl.SSLError):
+    return e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+  return e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR)
+
+class _AsyncRequest(object):
+  def __init__(self, data, callback):
+    self.data = data
+    self.callback = callback
+    self.retried = False
+
+def _ignore(result): pass
+
+class AsyncSunnytrail(_BaseClient):
+  """ Non-blocking client built on asyncore.
+
+  Requests are spread over at most max_connections keep-alive 
+  connections and report back through callbacks run from the event
+  loop. Drive the loop with run() or hand a shared socket map to the 
+  constructor and run asyncore.loop() yourself. 
+
+  A request that gets no complete answer within timeout seconds of 
+  being started on a connection fails with SunnytrailTimeout and its
+  connection is closed. The timeout is checked on every pass of the 
+  loop, so run asyncore.loop() with a shorter poll timeout. """
+
+  def __init__(self, key, base_url='api.thesunnytrail.com', use_ssl=True,
+      max_connections=100, max_batch_size=100, 
+      max_batch_bytes=512 * 1024, map=None, timeout=None):
+    super(AsyncSunnytrail, self).__init__(key, base_url, use_ssl,
+      max_batch_size, max_batch_bytes)
+    if use_ssl and ssl is None:
+      raise SunnytrailException('SSL requires python 2.6 or newer')
+
+    host, self._selector = splithost(splittype(self._messages_url)[1])
+    host, port = splitport(host)
+    self._address = (host, int(port or (use_ssl and 443 or 80)))
+
+    self._header = 'POST %s HTTP/1.1\r\nHost: %s\r\n'\
+      'Content-Type: application/x-www-form-urlencoded\r\n'\
+      'User-Agent: %s\r\n' % (self._selector, base_url, 
+      SunnytrailOpener.version)
+
+    if map is None:
+      map = {}
+    self._map = map
+    self._max_connections = max_connections
+    self._connections = []
+    self._idle = []
+    self._pending = deque()
+    self._in_flight = 0
+    self._timeout = timeout
+    self._addresses = None # (addresses, time resolved)
+    self._resolver = None
+
+  def send(self, event, callback=_ignore):
+    """ Queue an event. callback(exception) is called once the request 
+    completes, with None if the event was accepted """
+    self._request(urlencode({'message': event.to_json()}), callback)
+
+  def send_many(self, events, callback=_ignore):
+    """ Queue a sequence of events packed in batches that are sent 
+    concurrently. callback(results) receives a list like the one 
+    returned by Sunnytrail.send_many once all the batches completed """
+    messages = [e.to_json() for e in events]
+    results = [None] * len(messages)
+    batches = list(self._batches(messages))
+    left = [len(batches)]
+
+    if not batches:
+      return callback(results)
+
+    def batch_callback(start, end):
+      def done(e):
+        if isinstance(e, InvalidMessage):
+          self._reject(results, start, end, e)
+        elif e is not None:
+          for i in xrange(start, end):
+            results[i] = e
+
+        left[0] -= 1
+        if not left[0]: callback(results)
+      return done
+
+    for start, end, data in batches:
+      self._request(data, batch_callback(start, end))
+
+  def run(self, timeout=None):
+    """ Run the event loop until all the queued requests completed. 
+    Returns False if the timeout expired first """
+    deadline = timeout is not None and time() + timeout
+    while self._pending or self._in_flight:
+      asyncore.loop(0.05, False, self._map, 1)
+      if deadline and time() >= deadline:
+        return False
+    return True
+
+  def close(self):
+    """ Close all the connections """
+    if self._resolver is not None:
+      self._resolver.close()
+      self._resolver = None
+    for conn in self._connections[:]:
+      conn.close()
+    self._connections, self._idle = [], []
+
+  def _request(self, data, callback):
+    self._pending.append(_AsyncRequest('%sContent-Length: %d\r\n\r\n%s' % \
+      (self._header, len(data), data), callback))
+    self._dispatch()
+
+  def _dispatch(self):
+    while self._pending:
+      if self._idle:
+        conn, reused = self._idle.pop(), True
+      elif len(self._connections) < self._max_connections:
+        addresses = self._resolved_addresses()
+        if addresses is None:
+          return # dispatched again once resolved
+        try:
+          conn, reused = _AsyncConnection(self, self._address[0], 
+            addresses, self._use_ssl, self._map), False
+        except socket.error, e:
+          self._deliver(self._pending.popleft(), None, e)
+          continue
+        self._connections.append(conn)
+      else:
+        return
+
+      conn.start(self._pending.popleft(), reused, self._timeout)
+      self._in_flight += 1
+
+  def _resolved_addresses(self):
+    """ Addresses of the collector, or None while they are resolved """
+    if self._addresses is not None and \
+        time() - self._addresses[1] < _ASYNC_RESOLVE_INTERVAL:
+      return self._addresses[0]
+
+    if self._resolver is None:
+      self._resolver = _AsyncResolver(self._address[0], self._address[1],
+        self._resolved, self._map)
+    return None
+
+  def _resolved(self, result):
+    self._resolver = None
+    if isinstance(result, socket.error):
+      pending, self._pending = self._pending, deque()
+      for request in pending:
+        self._deliver(request, None, result)
+      return
+
+    self._addresses = (result, time())
+    self._dispatch()
+
+  def _finished(self, conn, request, parser, e, retry):
+    if conn in self._idle:
+      self._idle.remove(conn)
+    if conn.socket is None or not conn.connected:
+      if conn in self._connections:
+        self._connections.remove(conn)
+    elif request is not None:
+      self._idle.append(conn)
+
+    if request is not None:
+      self._in_flight -= 1
+
+      if retry and not request.retried:
+        request.retried = True
+        self._pending.appendleft(request)
+      else:
+        self._deliver(request, parser, e)
+
+    self._dispatch()
+
+  def _deliver(self, request, parser, e):
+    if parser is not None:
+      e = None
+      try:
+        _check_response(SunnytrailResponse(parser.code, 
+          parser.headers, parser.body))
+      except SunnytrailException, e:
+        pass
+
+    try:
+      request.callback(e)
+    except Exception, e:
+      logging.exception(e)
+
+def _slots_state(obj):
+  """ The attributes of an object of classes using __slots__, for 
+  pickle: protocols 0 and 1 refuse them without __getstate__ """
+  state = dict(getattr(obj, '__dict__', ()))
+  for cls in type(obj).__mro__:
+    for name in cls.__dict__.get('__slots__', ()):
+      if hasattr(obj, name):
+        state[name] = getattr(obj, name)
+  return state
+
+def _set_slots_state(obj, state):
+  for name, value in state.items():
+    setattr(obj, name, value)
+
 class Event(object):
+  __slots__ = ('_id', '_name', '_email', '_action', '_plan')
+  __getstate__ = _slots_state
+  __setstate__ = _set_slots_state
+
   def __init__(self, id, name, email, action, plan):
     self._id = id
     self._name = name
@@ -99,27 +2822,41 @@ class Event(object):
     return ret
 
   def to_json(self):
-    return simplejson.dumps(self.to_hash())
+    return _encode_event(self)
 
 class SignupEvent(Event):
+  __slots__ = ()
+
   def __init__(self, id, name, email, plan, created=None):
     super(SignupEvent, self).__init__(id, name, \
       email, SignupAction(created), plan)
 
 class PayEvent(Event):
+  __slots__ = ()
+
   def __init__(self, id, name, email, plan, created=None):
     super(PayEvent, self).__init__(id, name, \
       email, PayAction(created), plan)
 
 class CancelEvent(Event):
+  __slots__ = ()
+
   def __init__(self, id, name, email, created = None):
     super(CancelEvent, self).__init__(id, \
-      name, email, CancelAction(created), EmptyPlan())
+      name, email, CancelAction(created), _EMPTY_PLAN)
 
 class EmptyPlan(object):
+  __slots__ = ()
+
   def to_hash(self): return {}
 
+_EMPTY_PLAN = EmptyPlan()
+
 class Plan(object):
+  __slots__ = ('_name', '_price', '_recurring')
+  __getstate__ = _slots_state
+  __setstate__ = _set_slots_state
+
   def __init__(self, name, price = 0, recurring = None):
     self._name = name
     self._price = float(price)
@@ -151,6 +2888,10 @@ class Plan(object):
     return ret
 
 class Action(object):
+  __slots__ = ('_name', '_created')
+  __getstate__ = _slots_state
+  __setstate__ = _set_slots_state
+
   def __init__(self, name, created=None):
     if created is None:
       created = time()
@@ -175,27 +2916,592 @@ class Action(object):
     }
 
 class SignupAction(Action):
+  __slots__ = ()
+
   def __init__(self, created=None):
     super(SignupAction, self).__init__('signup', created)
 
 class PayAction(Action):
+  __slots__ = ()
+
   def __init__(self, created=None):
     super(PayAction, self).__init__('pay', created)
 
 class CancelAction(Action):
+  __slots__ = ()
+
   def __init__(self, created=None):
     super(CancelAction, self).__init__('cancel', created)
 
+def _template(keys):
+  """ Format string and value picker rendering a dict built by 
+  inserting keys in this order just like simplejson.dumps does """
+  order = list(dict.fromkeys(keys))
+  return '{%s}' % ', '.join(['"%s": %%s' % k for k in order]), \
+    itemgetter(*[keys.index(k) for k in order])
+
+_EVENT = _template(('name', 'email', 'action', 'plan'))
+_EVENT_WITH_ID = _template(('name', 'email', 'action', 'plan', 'id'))
+_PLAN = _template(('name', 'price'))
+_RECURRING_PLAN = _template(('name', 'price', 'recurring'))
+_ACTION = _template(('name', 'created'))
+
+_stock_types = {}
+
+def _is_stock(obj, base):
+  """ True if obj serializes with the to_hash() of base """
+  cls = type(obj)
+  try:
+    return _stock_types[cls, base]
+  except KeyError:
+    try:
+      stock = issubclass(cls, base) and \
+        cls.to_hash.im_func is base.__dict__['to_hash']
+    except AttributeError:
+      stock = False
+    _stock_types[cls, base] = stock
+    return stock
+
+def _encode(value):
+  if isinstance(value, basestring):
+    return encode_basestring_ascii(value)
+  if value is None:
+    return 'null'
+  if type(value) in (int, long):
+    return str(value)
+  return simplejson.dumps(value)
+
+def _encode_float(value):
+  if value != value or value in (float('inf'), float('-inf')):
+    return simplejson.dumps(value)
+  return repr(value)
+
+def _encode_event(event):
+  """ Same output as simplejson.dumps(event.to_hash()) without the
+  intermediate dicts. Events using subclasses that change to_hash()
+  fall back to the generic path """
+  action, plan = event._action, event._plan
+
+  if not (_is_stock(event, Event) and _is_stock(action, Action)):
+    return simplejson.dumps(event.to_hash())
+
+  if _is_stock(plan, Plan):
+    if plan._recurring is None:
+      template, pick = _PLAN
+      values = (_encode(plan._name), _encode_float(plan._price))
+    else:
+      template, pick = _RECURRING_PLAN
+      values = (_encode(plan._name), _encode_float(plan._price), 
+        str(plan._recurring))
+    plan = template % pick(values)
+
+  elif _is_stock(plan, EmptyPlan):
+    plan = '{}'
+
+  else:
+    return simplejson.dumps(event.to_hash())
+
+  template, pick = _ACTION
+  action = template % pick((_encode(action._name), str(action._created)))
+
+  if event._id is None:
+    template, pick = _EVENT
+    values = (_encode(event._name), _encode(event._email), action, plan)
+  else:
+    template, pick = _EVENT_WITH_ID
+    values = (_encode(event._name), _encode(event._email), action, plan,
+      _encode(event._id))
+
+  return template % pick(values)
+
+def _column(values):
+  if values is None:
+    return None
+  if hasattr(values, 'tolist'): # numpy and array.array
+    return values.tolist()
+  return list(values)
+
+def _float_column(values, name):
+  """ Column of floats: missing values (None or NaN) are rejected """
+  try:
+    if numpy is not None:
+      column = numpy.asarray(values, dtype=numpy.float64)
+      missing = numpy.isnan(column).any()
+      column = column.tolist()
+    else:
+      column = [None if v is None else float(v) for v in values]
+      missing = [v for v in column if v is None or v != v]
+  except (TypeError, ValueError):
+    raise ValueError('Invalid %s column: expected numbers' % name)
+
+  if missing:
+    raise ValueError('Invalid %s column: missing values' % name)
+  return column
+
+def _int_column(values, name):
+  """ Column of ints where None, and NaN in float columns, are None """
+  try:
+    if numpy is not None:
+      array = numpy.asarray(values)
+      if array.dtype.kind in 'iu':
+        return array.astype(numpy.int64).tolist()
+      if array.dtype.kind == 'f':
+        if numpy.isinf(array).any():
+          raise ValueError('infinite value')
+        missing = numpy.isnan(array)
+        column = numpy.where(missing, 0, array).astype(numpy.int64).tolist()
+        for i in numpy.flatnonzero(missing):
+          column[i] = None
+        return column
+    return [None if v is None or v != v else int(v) for v in values]
+  except (TypeError, ValueError, OverflowError):
+    raise ValueError('Invalid %s column: expected integers' % name)
+
+class EventBatch(object):
+  """ Events given as columns, e.g. straight from a database query.
+
+  All the columns must have the same length. ids, plans, recurring and
+  created may be omitted or contain None; the plan columns are ignored
+  for cancel events. Columns may be lists, array.array or NumPy arrays
+  and are validated as a whole when the batch is created. """
+
+  def __init__(self, ids, names, emails, actions, plans=None, 
+      prices=None, recurring=None, created=None):
+    self._names = _column(names)
+    self._emails = _column(emails)
+    self._actions = _column(actions)
+    count = len(self._names)
+
+    self._ids = self._plans = self._recurring = self._created = \
+      [None] * count
+    self._prices = [0.0] * count
+
+    if ids is not None: 
+      self._ids = _column(ids)
+    if plans is not None: 
+      self._plans = _column(plans)
+    if prices is not None:
+      self._prices = _float_column(prices, 'price')
+    if recurring is not None:
+      self._recurring = _int_column(recurring, 'recurring')
+    if created is not None:
+      self._created = _int_column(created, 'created')
+
+    for column in (self._ids, self._emails, self._actions, self._plans,
+        self._prices, self._recurring, self._created):
+      if len(column) != count:
+        raise ValueError('All the columns must have the same length')
+
+    invalid = set(self._actions) - set(('signup', 'pay', 'cancel'))
+    if invalid:
+      raise ValueError('Invalid action name %r. '\
+        'Expected values: signup, pay or cancel' % invalid.pop())
+
+    if None in [plan for plan, action in zip(self._plans, self._actions) \
+        if action != 'cancel']:
+      raise ValueError('Signup and pay events need a plan')
+
+  def __len__(self):
+    return len(self._names)
+
+  def events(self):
+    """ Iterate over the batch as Event objects """
+    for i in xrange(len(self)):
+      if self._actions[i] == 'cancel':
+        plan = _EMPTY_PLAN
+      else:
+        plan = Plan(self._plans[i], self._prices[i], self._recurring[i])
+      yield Event(self._ids[i], self._names[i], self._emails[i],
+        Action(self._actions[i], self._created[i]), plan)
+
+  def to_messages(self):
+    """ Serialize every event exactly as Event.to_json would """
+    now = int(time())
+    messages = []
+
+    for id, name, email, action, plan, price, recurring, created in \
+        zip(self._ids, self._names, self._emails, self._actions, 
+        self._plans, self._prices, self._recurring, self._created):
+
+      if action == 'cancel':
+        plan = '{}'
+      elif recurring is None:
+        template, pick = _PLAN
+        plan = template % pick((_encode(plan), _encode_float(price)))
+      else:
+        template, pick = _RECURRING_PLAN
+        plan = template % pick((_encode(plan), _encode_float(price),
+          str(recurring)))
+
+      template, pick = _ACTION
+      if created is None:
+        created = now
+      action = template % pick(('"%s"' % action, str(created)))
+
+      if id is None:
+        template, pick = _EVENT
+        values = (_encode(name), _encode(email), action, plan)
+      else:
+        template, pick = _EVENT_WITH_ID
+        values = (_encode(name), _encode(email), action, plan, _encode(id))
+
+      messages.append(template % pick(values))
+
+    return messages
+
+def read_records(f, format='jsonl'):
+  """ Yield the records of a JSONL or CSV stream. JSONL lines are
+  yielded undecoded so that a bad line only rejects that record """
+  if format == 'csv':
+    for record in csv.DictReader(f):
+      yield record
+  else:
+    for line in f:
+      if line.strip():
+        yield line
+
+def event_from_record(record):
+  """ Build an Event from a dict (or JSON object) with the id, name, 
+  email, action, plan, price, recurring and created keys, or nested 
+  like Event.to_json() makes them """
+  if isinstance(record, basestring):
+    record = simplejson.loads(record)
+
+  action, plan = record.get('action'), record.get('plan')
+  if isinstance(action, dict):
+    record = dict(record, action=action.get('name'), 
+      created=action.get('created'))
+    if isinstance(plan, dict):
+      record.update(plan=plan.get('name'), price=plan.get('price'),
+        recurring=plan.get('recurring'))
+
+  def get(key):
+    # CSV has no nulls: empty fields are missing values
+    value = record.get(key)
+    if value == '': return None
+    return value
+
+  if get('action') == 'cancel':
+    return CancelEvent(get('id'), record['name'], record['email'],
+      get('created'))
+
+  return Event(get('id'), record['name'], record['email'], 
+    Action(get('action'), get('created')), 
+    Plan(record['plan'], get('price') or 0, get('recurring')))
+
+class ImportStats(object):
+  """ Counters of a bulk import """
+
+  def __init__(self):
+    self.sent = self.rejected = self.failed = 0
+
+  def __str__(self):
+    return '%d sent, %d rejected, %d failed' % \
+      (self.sent, self.rejected, self.failed)
+
+def _count_results(stats, batch, results, report):
+  """ Count the send_many() results of (key, event) pairs in stats and
+  pass the refused events to report(key, status, error) """
+  for (key, event), result in zip(batch, results):
+    if result is None:
+      stats.sent += 1
+    elif isinstance(result, InvalidMessage):
+      stats.rejected += 1
+      report(key, 'rejected', result)
+    else:
+      stats.failed += 1
+      report(key, 'failed', result)
+
+def _log_result(number, status, error):
+  if status == 'rejected':
+    logging.warning('Record %d rejected: %s', number, error)
+  else:
+    logging.error('Record %d failed: %s', number, error)
+
+def import_records(client, records, batch_size=100, progress=10000):
+  """ Send records in batches of batch_size, holding at most one batch
+  in memory. Bad records and the events refused by the collector are
+  logged and counted as rejected. Returns an ImportStats """
+  stats = ImportStats()
+  batch, number = [], 0
+
+  def flush():
+    results = client.send_many([event for n, event in batch])
+    _count_results(stats, batch, results, _log_result)
+    del batch[:]
+
+  for record in records:
+    number += 1
+    try:
+      batch.append((number, event_from_record(record)))
+    except (KeyError, TypeError, ValueError, AttributeError), e:
+      logging.warning('Record %d rejected: %s', number, e)
+      stats.rejected += 1
+
+    if len(batch) >= batch_size:
+      flush()
+    if progress and number % progress == 0:
+      logging.info('%d records: %s', number, stats)
+
+  if batch:
+    flush()
+  return stats
+
+class Backfill(object):
+  """ Send a large JSONL or CSV file from parallel workers.
+
+  The file is split at line boundaries into byte-range shards. Each 
+  shard keeps a checkpoint of how far it got in checkpoint_dir (by 
+  default FILE.backfill), so running the same backfill again resumes 
+  where it stopped. A shard stops at the first batch that could not be
+  sent, which the next run sends again. Records that can't be parsed 
+  or that the collector refused (InvalidMessage) are logged and copied
+  as is to the rejects file (by default FILE.rejects), which can be 
+  fixed and sent in turn.
+
+  client_factory() is called once per worker to build its client. 
+  With processes=True the workers are processes and the factory must
+  be picklable, e.g. a module level function. CSV records may not 
+  span several lines. """
+
+  def __init__(self, path, client_factory, format=None, shards=4, 
+      workers=None, processes=False, batch_size=100, 
+      checkpoint_dir=None, rejects=None):
+    if format is None:
+      if path.lower().endswith('.csv'): format = 'csv'
+      else: format = 'jsonl'
+
+    if processes and multiprocessing is None:
+      raise ValueError('Worker processes need python 2.6 or newer')
+
+    self.path, self.format = path, format
+    self._client_factory = client_factory
+    self._shards = shards
+    self._workers = workers or shards
+    self._processes = processes
+    self._batch_size = batch_size
+
+    self.checkpoint_dir = checkpoint_dir or path + '.backfill'
+    self.rejects = rejects or path + '.rejects'
+
+    self._header = self._header_line = None
+    self._ranges = []
+
+  def run(self):
+    """ Send every shard not completed yet and write the rejects file.
+    Returns the ImportStats of the whole file, including the records 
+    sent by the previous runs """
+    self._prepare()
+    shards = range(len(self._ranges))
+
+    if self._processes:
+      pool = multiprocessing.Pool(self._workers)
+      try:
+        results = pool.map(_run_shard, [(self, i) for i in shards])
+      finally:
+        pool.terminate()
+    else:
+      results = self._run_threads(shards)
+
+    stats = ImportStats()
+    for shard in results:
+      stats.sent += shard.sent
+      stats.rejected += shard.rejected
+      stats.failed += shard.failed
+
+    self._merge_rejects()
+    return stats
+
+  def _run_threads(self, shards):
+    pending, results, errors = Queue.Queue(), {}, []
+    for i in shards:
+      pending.put(i)
+
+    def work():
+      while not errors:
+        try:
+          i = pending.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          results[i] = self._run_shard(i)
+        except Exception:
+          errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=work) \
+      for i in xrange(min(self._workers, len(shards)))]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    if errors:
+      raise errors[0][0], errors[0][1], errors[0][2]
+    return [results[i] for i in shards]
+
+  def _prepare(self):
+    """ Load the shards of a previous run or split the file """
+    if not os.path.isdir(self.checkpoint_dir):
+      os.makedirs(self.checkpoint_dir)
+
+    f = open(self.path, 'rb')
+    try:
+      start = 0
+      if self.format == 'csv':
+        line = self._header_line = f.readline()
+        self._header = csv.reader([line]).next()
+        start = f.tell()
+
+      size = os.fstat(f.fileno()).st_size
+      manifest = os.path.join(self.checkpoint_dir, 'shards')
+
+      if os.path.exists(manifest):
+        lines = open(manifest).read().split('\n')
+        if int(lines[0]) != size:
+          raise ValueError('%s changed since its checkpoints were made' \
+            % self.path)
+        self._ranges = [tuple(map(int, l.split())) for l in lines[1:] if l]
+        return
+
+      bounds = [start]
+      for i in xrange(1, self._shards):
+        f.seek(max(start + (size - start) * i // self._shards - 1, 
+          bounds[-1]))
+        f.readline()
+        bounds.append(min(f.tell(), size))
+      bounds.append(size)
+
+      self._ranges = [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
+      _write_atomic(manifest, '%d\n' % size + \
+        ''.join(['%d %d\n' % r for r in self._ranges]))
+    finally:
+      f.close()
+
+  def _checkpoint_path(self, shard):
+    return os.path.join(self.checkpoint_dir, 'shard-%d' % shard)
+
+  def _run_shard(self, shard):
+    start, end = self._ranges[shard]
+    stats = ImportStats()
+    checkpoint = self._checkpoint_path(shard)
+
+    position, rejects_size = start, 0
+    if os.path.exists(checkpoint):
+      position, rejects_size, stats.sent, stats.rejected, stats.failed = \
+        map(int, open(checkpoint).read().split())
+    if position >= end:
+      return stats
+
+    # forget the rejects written after the last checkpoint: these
+    # records are sent again
+    rejects = open(checkpoint + '.rejects', 'ab')
+    rejects.truncate(rejects_size)
+    rejects.seek(0, 2)
+    f = open(self.path, 'rb')
+    client = self._client_factory()
+
+    def report(record, status, error):
+      offset, line = record
+      logging.warning('Record at offset %d of %s rejected: %s', offset,
+        self.path, error)
+      if not line.endswith('\n'): line += '\n'
+      rejects.write(line)
+
+    try:
+      f.seek(position)
+      batch = []
+      while position < end:
+        line = f.readline()
+        offset, position = position, position + len(line)
+
+        if line.strip():
+          try:
+            batch.append(((offset, line), self._event(line)))
+          except (KeyError, TypeError, ValueError, AttributeError), e:
+            stats.rejected += 1
+            report((offset, line), 'rejected', e)
+
+        if len(batch) >= self._batch_size or position >= end:
+          if batch:
+            results = client.send_many([event for r, event in batch])
+            failed = [r for r in results 
+              if r is not None and not isinstance(r, InvalidMessage)]
+            if failed:
+              # no checkpoint: the next run starts again at this batch
+              stats.failed += len(failed)
+              logging.error('Shard %d stopped at offset %d: %s', shard, 
+                batch[0][0][0], failed[0])
+              return stats
+            _count_results(stats, batch, results, report)
+            del batch[:]
+
+          rejects.flush()
+          _write_atomic(checkpoint, '%d %d %d %d %d\n' % (position, 
+            rejects.tell(), stats.sent, stats.rejected, stats.failed))
+
+      logging.info('Shard %d done: %s', shard, stats)
+      return stats
+    finally:
+      client.close()
+      f.close()
+      rejects.close()
+
+  def _event(self, line):
+    if self.format == 'csv':
+      return event_from_record(dict(zip(self._header, 
+        csv.reader([line]).next())))
+    return event_from_record(line)
+
+  def _merge_rejects(self):
+    out = open(self.rejects + '.tmp', 'wb')
+    try:
+      if self._header_line is not None:
+        out.write(self._header_line)
+      for shard in xrange(len(self._ranges)):
+        path = self._checkpoint_path(shard) + '.rejects'
+        if os.path.exists(path):
+          f = open(path, 'rb')
+          shutil.copyfileobj(f, out)
+          f.close()
+    finally:
+      out.close()
+    os.rename(self.rejects + '.tmp', self.rejects)
+
+def _run_shard(args):
+  """ Pool.map() target: bound methods can't be pickled """
+  backfill, shard = args
+  return backfill._run_shard(shard)
+
+def _write_atomic(path, data):
+  f = open(path + '.tmp', 'wb')
+  try:
+    f.write(data)
+  finally:
+    f.close()
+  os.rename(path + '.tmp', path)
+
+class _ClientFactory(object):
+  """ Picklable client factory of the CLI backfill workers """
+
+  def __init__(self, *args, **kwargs):
+    self._args, self._kwargs = args, kwargs
+
+  def __call__(self):
+    return Sunnytrail(*self._args, **self._kwargs)
+
 def main(args):
   logging.basicConfig(level=logging.DEBUG)  
   from optparse import OptionParser
   
   parser = OptionParser("%prog [--help] [--url] --key [--id] "\
-    "--name --email --action --plan --price")
+    "--name --email --action --plan --price\n"\
+    "       %prog [--help] [--url] --key --input FILE|- [--format]\n"\
+    "       %prog [--help] [--url] --key --input FILE --workers N\n"\
+    "       %prog [--help] [--url] --key [--socket|--udp] [--spool] serve")
 
   parser.add_option('-k', '--key', help="Sunnytrail API key")
   parser.add_option('-u', '--url', 
     default='api.thesunnytrail.com', help="Sunnytrail API url")
+  parser.add_option('', '--no-ssl', action='store_false', dest='ssl',
+    default=True, help="Use plain HTTP")
 
   parser.add_option('-i', '--id', help="Account internal ID")
   parser.add_option('-n', '--name', help="Account user name")
@@ -206,8 +3512,48 @@ def main(args):
   parser.add_option('-p', '--plan', help='Plan name')
   parser.add_option('', '--price', help='Plan price')
 
+  parser.add_option('', '--input', 
+    help='Send the records of a JSONL or CSV file (- for stdin), with '\
+    'the id, name, email, action, plan, price, recurring and created '\
+    'fields')
+  parser.add_option('', '--format', choices=('jsonl', 'csv'),
+    help='Input format: jsonl or csv. Guessed from the file name')
+  parser.add_option('', '--batch-size', type='int', default=100,
+    help='Events per request when sending an input file')
+  parser.add_option('', '--workers', type='int',
+    help='Send the input file from N workers, resuming from checkpoints')
+  parser.add_option('', '--processes', action='store_true', default=False,
+    help='Use worker processes instead of threads')
+  parser.add_option('', '--checkpoint-dir', 
+    help='Backfill checkpoints directory (default: FILE.backfill)')
+  parser.add_option('', '--rejects',
+    help='Backfill rejected records file (default: FILE.rejects)')
+
+  parser.add_option('', '--socket', default='/tmp/sunnytrail.sock',
+    help='Relay Unix socket path')
+  parser.add_option('', '--udp', help='Relay on localhost UDP HOST:PORT')
+  parser.add_option('', '--spool', 
+    help='Relay spool directory for events the collector did not accept')
+
   (opts, args) = parser.parse_args(args)
 
+  if args[1:] == ['serve']:
+    if opts.key is None:
+      parser.error('A mandatory parameter is missing.')
+      return -1
+    return _serve(opts)
+
+  if opts.input is not None:
+    if opts.key is None:
+      parser.error('A mandatory parameter is missing.')
+      return -1
+    if opts.workers is not None:
+      if opts.input == '-':
+        parser.error('Backfills need an input file.')
+        return -1
+      return _backfill(opts)
+    return _import(opts)
+
   if any(map(lambda e: getattr(opts, e) is None, \
       ('key', 'name', 'email', 'action'))):
     parser.error('A mandatory parameter is missing.')
@@ -226,7 +3572,7 @@ def main(args):
     parser.error('Please specify a valid email address.')
     return -3
 
-  s = Sunnytrail(opts.key)
+  s = Sunnytrail(opts.key, opts.url, opts.ssl)
   try:
     if opts.action == 'cancel':
       s.send(CancelEvent(opts.id, opts.name, opts.email))
@@ -243,6 +3589,93 @@ def main(args):
     logging.exception(e)
     return -5
 
+def _import(opts):
+  format = opts.format
+  if format is None:
+    format = opts.input.lower().endswith('.csv') and 'csv' or 'jsonl'
+
+  if opts.input == '-':
+    f = sys.stdin
+  else:
+    f = open(opts.input, 'rb')
+
+  client = Sunnytrail(opts.key, opts.url, opts.ssl, retry=RetryPolicy(),
+    max_batch_size=opts.batch_size)
+  try:
+    try:
+      stats = import_records(client, read_records(f, format), 
+        opts.batch_size)
+
+    except SunnytrailException, e:
+      logging.error(e)
+      return -4
+
+    except Exception, e:
+      logging.exception(e)
+      return -5
+  finally:
+    client.close()
+    if f is not sys.stdin: f.close()
+
+  logging.info('Import done: %s', stats)
+  if stats.rejected or stats.failed:
+    return -4
+
+def _backfill(opts):
+  factory = _ClientFactory(opts.key, opts.url, opts.ssl, 
+    retry=RetryPolicy(), max_batch_size=opts.batch_size)
+  backfill = Backfill(opts.input, factory, opts.format, 
+    shards=opts.workers, processes=opts.processes, 
+    batch_size=opts.batch_size, checkpoint_dir=opts.checkpoint_dir,
+    rejects=opts.rejects)
+  try:
+    stats = backfill.run()
+
+  except SunnytrailException, e:
+    logging.error(e)
+    return -4
+
+  except Exception, e:
+    logging.exception(e)
+    return -5
+
+  logging.info('Backfill done: %s', stats)
+  if stats.rejected:
+    logging.info('Rejected records written to %s', backfill.rejects)
+  if stats.failed:
+    logging.info('Run the same command again to send the failed records')
+  if stats.rejected or stats.failed:
+    return -4
+
+def _serve(opts):
+  address = opts.socket
+  if opts.udp is not None:
+    host, port = opts.udp.rsplit(':', 1)
+    address = (host, int(port))
+
+  spool = None
+  if opts.spool is not None:
+    spool = Spool(opts.spool)
+
+  client = Sunnytrail(opts.key, opts.url, opts.ssl, retry=RetryPolicy(),
+    max_batch_size=opts.batch_size, spool=spool)
+  relay = Relay(client, address, opts.batch_size)
+
+  def stop(signum, frame):
+    raise KeyboardInterrupt
+  signal.signal(signal.SIGTERM, stop)
+
+  logging.info('Relaying events from %s', address)
+  try:
+    try:
+      relay.serve_forever()
+    except KeyboardInterrupt:
+      pass
+  finally:
+    relay.close()
+    client.close()
+    if spool is not None: spool.close()
+
 if __name__ == '__main__':
   sys.exit(main(sys.argv))
 
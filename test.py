@@ -6,6 +6,13 @@ import sunnytrail
 import simplejson
 import socket
 import subprocess
+import tempfile
+import array
+import struct
+import threading
+
+from StringIO import StringIO
+import shutil
 
 import _sunnytrail_urllib as urllib
 
@@ -53,14 +60,14 @@ class FunctionalTest(unittest.TestCase):
       self.process.wait()
       self.process = None
 
-  def serve(self, code, content = ''):
-    port = get_unused_port()
+  def serve(self, code, content = '', port = None, *extra):
+    port = port or get_unused_port()
     self.process = subprocess.Popen([
         'python', 'http_serve.py',
         '--port', str(port),
         '--code', str(code),
         '--content', str(content),
-    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    ] + list(extra), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     wait_for_port('localhost', port)
     return 'localhost:%d' % port
 
@@ -70,6 +77,473 @@ class FunctionalTest(unittest.TestCase):
     client = sunnytrail.Sunnytrail('key', hostport, use_ssl = False)
     client.send(sunnytrail.CancelEvent('id', 'name', 'email'))
 
+  def test_legacy_transport(self):
+    hostport = self.serve(202)
+
+    client = sunnytrail.Sunnytrail('key', hostport, use_ssl = False,
+      keep_alive = False)
+    client.send(sunnytrail.CancelEvent('id', 'name', 'email'))
+
+  def test_keep_alive_connection_is_reused(self):
+    hostport = self.serve(202, '', None, '--keep-alive')
+
+    client = sunnytrail.Sunnytrail('key', hostport, use_ssl = False)
+    client.send(sunnytrail.CancelEvent('id', 'name', 'email'))
+    conn = client._pool._idle[0][0]
+
+    client.send(sunnytrail.CancelEvent('id', 'name', 'email'))
+    self.assertEqual(len(client._pool._idle), 1)
+    assert client._pool._idle[0][0] is conn
+
+  def test_compressed_requests(self):
+    hostport = self.serve(202, '', None, '--keep-alive')
+
+    for encoding in ('gzip', 'deflate'):
+      client = sunnytrail.Sunnytrail('key', hostport, use_ssl = False,
+        compression = encoding, min_compress_size = 0)
+      self.assertEqual(client.send_many([sunnytrail.CancelEvent(
+        str(i), 'name', 'email') for i in range(10)]), [None] * 10)
+
+    import httplib
+    conn = httplib.HTTPConnection(hostport)
+    conn.request('POST', '/messages', 'not gzip', 
+      {'Content-Encoding': 'gzip'})
+    self.assertEqual(conn.getresponse().status, 400)
+
+  def test_preset_dictionary_is_negotiated(self):
+    event = sunnytrail.CancelEvent('id', 'name', 'email')
+    hostport = self.serve(202, '', None, '--keep-alive', '--dictionary',
+      '--dictionary-string', 'Basic')
+
+    client = sunnytrail.Sunnytrail('key', hostport, use_ssl = False,
+      dictionary = sunnytrail.PresetDictionary(['Basic']))
+    client.send(event)
+    assert client._dictionary is not None
+
+    client = sunnytrail.Sunnytrail('key', hostport, use_ssl = False,
+      dictionary = sunnytrail.PresetDictionary(['Premium']))
+    client.send(event)
+    assert client._dictionary is None
+
+  def test_json_bodies(self):
+    events = [sunnytrail.CancelEvent(str(i), 'name', 'email') \
+      for i in range(3)]
+    hostport = self.serve(202, '', None, '--keep-alive')
+
+    client = sunnytrail.Sunnytrail('key', hostport, use_ssl = False,
+      json_bodies = True)
+    client.send(events[0])
+    self.assertEqual(client.send_many(events), [None] * 3)
+    assert client._json
+
+  def test_json_bodies_fall_back_to_forms(self):
+    hostport = self.serve(202, '', None, '--keep-alive', '--no-json')
+
+    client = sunnytrail.Sunnytrail('key', hostport, use_ssl = False,
+      json_bodies = True)
+    client.send(sunnytrail.CancelEvent('id', 'name', 'email'))
+    assert not client._json
+
+  def test_socket_options(self):
+    hostport = self.serve(202, '', None, '--keep-alive')
+
+    client = sunnytrail.Sunnytrail('key', hostport, use_ssl = False,
+      tcp_keepalive = True, send_buffer_size = 65536)
+    client.send(sunnytrail.CancelEvent('id', 'name', 'email'))
+    sock = client._pool._idle[0][0].sock
+
+    assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+    assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+    assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) >= 65536
+
+  def test_request_phases_are_observed(self):
+    hostport = self.serve(403, '{"errors": [["name", "bad name"]]}', None,
+      '--keep-alive')
+    observed = []
+
+    client = sunnytrail.Sunnytrail('key', hostport, use_ssl = False,
+      observer = observed.append)
+    for i in range(2):
+      self.assertRaises(sunnytrail.InvalidMessage, client.send, 
+        sunnytrail.CancelEvent('id', 'name', 'email'))
+
+    first, second = observed
+    self.assertEqual((first.reused, second.reused), (False, True))
+    self.assertEqual((first.status, first.error), (403, None))
+    for phase in ('resolve', 'connect', 'write', 'ttfb', 'read'):
+      assert getattr(first, phase) >= 0
+    self.assertEqual((first.tls, second.connect), (None, None))
+    assert second.total() > 0
+
+  def test_failed_connections_are_observed(self):
+    observed = []
+    client = sunnytrail.Sunnytrail('key', 
+      'localhost:%d' % get_unused_port(), use_ssl = False,
+      observer = observed.append)
+
+    self.assertRaises(IOError, client.send, 
+      sunnytrail.CancelEvent('id', 'name', 'email'))
+    assert isinstance(observed[0].error, socket.error)
+    assert observed[0].resolve >= 0
+    self.assertEqual(observed[0].connect, None)
+
+  def test_reconnect_after_server_restart(self):
+    port = get_unused_port()
+    hostport = self.serve(202, '', port, '--keep-alive')
+
+    client = sunnytrail.Sunnytrail('key', hostport, use_ssl = False)
+    client.send(sunnytrail.CancelEvent('id', 'name', 'email'))
+
+    self.tearDown()
+    self.serve(202, '', port, '--keep-alive')
+
+    client.send(sunnytrail.CancelEvent('id', 'name', 'email'))
+
+  def test_503_error(self):
+    hostport = self.serve(503, '', None, '--keep-alive')
+
+    client = sunnytrail.Sunnytrail('key', hostport, use_ssl = False)
+    self.assertRaises(sunnytrail.ServiceUnavailable, client.send,
+      sunnytrail.CancelEvent('id', 'name', 'email'))
+
+  def test_async_send_concurrently(self):
+    hostport = self.serve(202, '', None, '--keep-alive')
+    client = sunnytrail.AsyncSunnytrail('key', hostport, use_ssl = False,
+      max_connections = 4)
+
+    results = []
+    for i in range(20):
+      client.send(sunnytrail.CancelEvent(str(i), 'name', 'email'), 
+        results.append)
+
+    assert client.run(5)
+    self.assertEqual(results, [None] * 20)
+    self.assertEqual(len(client._connections), 4)
+    client.close()
+
+  def test_async_send_many(self):
+    hostport = self.serve(202)
+    client = sunnytrail.AsyncSunnytrail('key', hostport, use_ssl = False,
+      max_batch_size = 2)
+
+    results = []
+    client.send_many([sunnytrail.CancelEvent(str(i), 'name', 'email') \
+      for i in range(5)], results.append)
+
+    assert client.run(5)
+    self.assertEqual(results, [[None] * 5])
+
+  def test_async_503_error(self):
+    hostport = self.serve(503, '', None, '--keep-alive')
+    client = sunnytrail.AsyncSunnytrail('key', hostport, use_ssl = False)
+
+    results = []
+    client.send(sunnytrail.CancelEvent('id', 'name', 'email'), 
+      results.append)
+
+    assert client.run(5)
+    assert isinstance(results[0], sunnytrail.ServiceUnavailable)
+
+  def test_async_connection_refused(self):
+    client = sunnytrail.AsyncSunnytrail('key', 
+      'localhost:%d' % get_unused_port(), use_ssl = False)
+
+    results = []
+    client.send(sunnytrail.CancelEvent('id', 'name', 'email'), 
+      results.append)
+
+    assert client.run(5)
+    assert isinstance(results[0], IOError)
+
+  def test_async_requests_time_out(self):
+    listener = socket.socket()
+    listener.bind(('localhost', 0))
+    listener.listen(5)
+    client = sunnytrail.AsyncSunnytrail('key', 
+      'localhost:%d' % listener.getsockname()[1], use_ssl = False,
+      max_connections = 1, timeout = 0.2)
+
+    results = []
+    for i in range(2):
+      client.send(sunnytrail.CancelEvent(str(i), 'name', 'email'), 
+        results.append)
+
+    start = time()
+    assert client.run(5)
+    assert time() - start < 2
+    self.assertEqual(len(results), 2)
+    assert all([isinstance(r, sunnytrail.SunnytrailTimeout) \
+      for r in results])
+    client.close()
+    listener.close()
+
+  def test_async_name_resolution_does_not_block(self):
+    hostport = self.serve(202, '', None, '--keep-alive')
+    client = sunnytrail.AsyncSunnytrail('key', hostport, use_ssl = False)
+
+    getaddrinfo = socket.getaddrinfo
+    def slow_getaddrinfo(*args):
+      sleep(0.5)
+      return getaddrinfo(*args)
+    socket.getaddrinfo = slow_getaddrinfo
+    try:
+      results = []
+      start = time()
+      client.send(sunnytrail.CancelEvent('id', 'name', 'email'), 
+        results.append)
+      assert time() - start < 0.25
+      assert client.run(5)
+    finally:
+      socket.getaddrinfo = getaddrinfo
+
+    self.assertEqual(results, [None])
+    client.close()
+
+class TimeoutTest(unittest.TestCase):
+
+  def setUp(self):
+    # a server that accepts connections but never answers
+    self.server = socket.socket()
+    self.server.bind(('localhost', 0))
+    self.server.listen(5)
+    self.hostport = 'localhost:%d' % self.server.getsockname()[1]
+
+    self.event = sunnytrail.CancelEvent('id', 'name', 'email')
+
+  def tearDown(self):
+    self.server.close()
+
+  def test_read_timeout(self):
+    client = sunnytrail.Sunnytrail('key', self.hostport, use_ssl = False,
+      read_timeout = 0.1)
+
+    start = time()
+    self.assertRaises(sunnytrail.SunnytrailTimeout, 
+      client.send, self.event)
+    assert time() - start < 1
+
+  def test_per_call_deadline(self):
+    client = sunnytrail.Sunnytrail('key', self.hostport, use_ssl = False)
+
+    start = time()
+    self.assertRaises(sunnytrail.SunnytrailTimeout, 
+      client.send, self.event, deadline = 0.1)
+    assert time() - start < 1
+
+  def test_deadline_bounds_retries(self):
+    client = sunnytrail.Sunnytrail('key', self.hostport, use_ssl = False,
+      retry = sunnytrail.RetryPolicy(max_attempts = 100, backoff = 0.01),
+      read_timeout = 0.05, deadline = 0.3)
+
+    start = time()
+    self.assertRaises(sunnytrail.SunnytrailTimeout, 
+      client.send, self.event)
+    assert time() - start < 1
+
+  def test_deadline_bounds_a_trickling_response(self):
+    def drip():
+      conn, address = self.server.accept()
+      conn.recv(4096)
+      conn.sendall('HTTP/1.1 202 Accepted\r\n')
+      try:
+        for i in range(60):
+          conn.sendall('X')
+          sleep(0.05)
+      except socket.error:
+        pass
+      conn.close()
+    thread = threading.Thread(target=drip)
+    thread.setDaemon(True)
+    thread.start()
+
+    client = sunnytrail.Sunnytrail('key', self.hostport, use_ssl = False,
+      read_timeout = 0.2)
+    start = time()
+    self.assertRaises(sunnytrail.SunnytrailTimeout, 
+      client.send, self.event, deadline = 0.3)
+    assert time() - start < 0.6
+
+  def test_name_resolution_is_bounded(self):
+    getaddrinfo = socket.getaddrinfo
+    def slow_getaddrinfo(*args):
+      sleep(1)
+      return getaddrinfo(*args)
+    socket.getaddrinfo = slow_getaddrinfo
+    try:
+      client = sunnytrail.Sunnytrail('key', self.hostport, 
+        use_ssl = False)
+      start = time()
+      self.assertRaises(sunnytrail.SunnytrailTimeout, 
+        client.send, self.event, deadline = 0.1)
+      assert time() - start < 0.5
+    finally:
+      socket.getaddrinfo = getaddrinfo
+
+  def test_expired_deadline(self):
+    timeouts = sunnytrail._Timeouts(1, 1, -1)
+    self.assertRaises(sunnytrail.SunnytrailTimeout, timeouts.connect)
+
+  def test_timeouts_need_keep_alive(self):
+    self.assertRaises(ValueError, sunnytrail.Sunnytrail, 'key', 
+      keep_alive = False, deadline = 1)
+
+class ResponseParserTest(unittest.TestCase):
+
+  def test_content_length(self):
+    p = sunnytrail._ResponseParser()
+
+    assert not p.feed('HTTP/1.1 202 Accepted\r\nContent-Length: 4\r\n\r\nab')
+    assert p.feed('cd')
+    self.assertEqual((p.code, p.body, p.will_close), (202, 'abcd', False))
+
+  def test_chunked(self):
+    p = sunnytrail._ResponseParser()
+
+    assert not p.feed('HTTP/1.1 403 Forbidden\r\n'\
+      'Transfer-Encoding: chunked\r\n\r\n2\r\nab\r\n')
+    assert p.feed('3\r\ncde\r\n0\r\n\r\n')
+    self.assertEqual((p.code, p.body), (403, 'abcde'))
+
+  def test_body_delimited_by_close(self):
+    p = sunnytrail._ResponseParser()
+
+    assert not p.feed('HTTP/1.0 202 Accepted\r\n\r\nabc')
+    assert p.eof()
+    self.assertEqual((p.body, p.will_close), ('abc', True))
+
+class ConnectionPoolTest(unittest.TestCase):
+  def test_idle_connection_closed_by_peer_is_stale(self):
+    local, remote = socket.socketpair()
+    conn = sunnytrail.httplib.HTTPConnection('localhost')
+    conn.sock = local
+
+    assert not sunnytrail._is_stale(conn)
+
+    remote.close()
+    assert sunnytrail._is_stale(conn)
+    conn.close()
+
+  def test_unconnected_connection_is_stale(self):
+    conn = sunnytrail.httplib.HTTPConnection('localhost')
+    assert sunnytrail._is_stale(conn)
+
+  def test_max_idle_connections(self):
+    pool = sunnytrail.ConnectionPool('localhost', max_idle=1)
+    first = sunnytrail.httplib.HTTPConnection('localhost')
+    second = sunnytrail.httplib.HTTPConnection('localhost')
+
+    pool._checkin(first)
+    pool._checkin(second)
+
+    self.assertEqual(len(pool._idle), 1)
+    assert pool._idle[0][0] is first
+
+  def test_preambles_are_cached(self):
+    pool = sunnytrail.ConnectionPool('example.com')
+    url = 'https://example.com/messages?apikey=key'
+
+    preamble = pool._preamble(url)
+    assert pool._preamble(url) is preamble
+    assert preamble.startswith('POST /messages?apikey=key HTTP/1.1\r\n')
+    assert preamble.endswith('\r\n')
+
+    json = pool._preamble(url, (('Content-Type', 'application/json'),))
+    assert 'Content-Type: application/json\r\n' in json
+    assert 'x-www-form-urlencoded' not in json
+
+    pool.addheaders = [('User-Agent', 'test')]
+    self.assertEqual(pool._preamble(url), 'POST /messages?apikey=key '\
+      'HTTP/1.1\r\nHost: example.com\r\nAccept-Encoding: identity\r\n'\
+      'User-Agent: test\r\n')
+
+  def test_request_is_sent_in_a_single_write(self):
+    local, remote = socket.socketpair()
+    writes = []
+
+    class RecordingSocket(object):
+      def sendall(self, data):
+        writes.append(data)
+        local.sendall(data)
+      def __getattr__(self, name):
+        return getattr(local, name)
+
+    remote.sendall('HTTP/1.1 202 Accepted\r\nContent-Length: 0\r\n\r\n')
+    pool = sunnytrail.ConnectionPool('example.com')
+    conn = pool._connect()
+    conn.sock = RecordingSocket()
+
+    response, body = pool._roundtrip(conn, pool._preamble(
+      'http://example.com/messages', {'Content-Encoding': 'gzip'}), 
+      'message=x', None)
+
+    self.assertEqual(response.status, 202)
+    self.assertEqual(len(writes), 1)
+    assert writes[0].startswith('POST /messages HTTP/1.1\r\n'\
+      'Host: example.com\r\n')
+    assert 'Content-Encoding: gzip\r\n' in writes[0]
+    assert writes[0].endswith('Content-Length: 9\r\n\r\nmessage=x')
+    remote.close()
+    local.close()
+
+  def reused_pool(self, answer):
+    """ A pool holding an idle connection whose server reads a request
+    and then sends answer and closes, and the connections it opens """
+    local, remote = socket.socketpair()
+    def serve():
+      remote.recv(4096)
+      remote.sendall(answer)
+      remote.close()
+    threading.Thread(target=serve).start()
+
+    pool = sunnytrail.ConnectionPool('example.com')
+    conn = pool._connect()
+    conn.sock = local
+    pool._checkin(conn)
+
+    opened = []
+    def connect():
+      fresh_local, fresh_remote = socket.socketpair()
+      fresh_remote.sendall('HTTP/1.1 202 Accepted\r\n'\
+        'Content-Length: 0\r\n\r\n')
+      conn = sunnytrail._HTTPConnection('example.com')
+      conn.sock = fresh_local
+      opened.append(fresh_remote)
+      return conn
+    pool._connect = connect
+    return pool, opened
+
+  def test_dropped_idle_connection_is_retried(self):
+    pool, opened = self.reused_pool('')
+
+    r = pool.open('http://example.com/messages', 'message=x')
+    self.assertEqual(r.code, 202)
+    self.assertEqual(len(opened), 1)
+
+  def test_request_is_not_resent_after_a_partial_answer(self):
+    pool, opened = self.reused_pool('HTTP/1.1 202 Accepted\r\n'\
+      'Content-Length: 10\r\n\r\nab')
+
+    self.assertRaises(IOError, pool.open, 'http://example.com/messages',
+      'message=x')
+    self.assertEqual(opened, [])
+
+  def test_proxy_settings_disable_pooling(self):
+    saved = dict(os.environ)
+    try:
+      os.environ['http_proxy'] = 'http://proxy.example.com:3128'
+      os.environ['no_proxy'] = 'direct.example.com'
+      client = sunnytrail.Sunnytrail('key', 'example.com', use_ssl=False)
+      assert client._pool is None
+      self.assertRaises(ValueError, sunnytrail.Sunnytrail, 'key', 
+        'example.com', use_ssl=False, json_bodies=True)
+
+      client = sunnytrail.Sunnytrail('key', 'direct.example.com', 
+        use_ssl=False)
+      assert client._pool is not None
+    finally:
+      os.environ.clear()
+      os.environ.update(saved)
+
 class PlanTest(unittest.TestCase):
   def test_create_plan(self):
     p = sunnytrail.Plan('plan-name', 10, 30)
@@ -126,6 +600,18 @@ class EventTest(unittest.TestCase):
       '"name": "name", "email": "email"}'
     self.assertEqual(actual, expected)
 
+  def test_events_can_be_pickled(self):
+    import pickle
+    events = [sunnytrail.SignupEvent('id', 'name', 'email', 
+        sunnytrail.Plan('plan', 49, 30), 123),
+      sunnytrail.CancelEvent(None, 'name', 'email', 123)]
+
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+      for event in events:
+        copy = pickle.loads(pickle.dumps(event, protocol))
+        self.assertEqual(type(copy), type(event))
+        self.assertEqual(copy.to_json(), event.to_json())
+
   def test_create_payment_event(self):
     actual = sunnytrail.PayEvent('id', 'name', \
       'email', sunnytrail.Plan('plan', 49), 123).to_json()
@@ -142,11 +628,170 @@ class EventTest(unittest.TestCase):
       '"plan": {}, "id": "id", "name": "name", "email": "email"}'
     self.assertEqual(actual, expected)
 
+  def test_instances_have_no_dict(self):
+    plan = sunnytrail.Plan('plan', 49, 30)
+    event = sunnytrail.PayEvent('id', 'name', 'email', plan, 123)
+    cancel = sunnytrail.CancelEvent('id', 'name', 'email', 123)
+
+    for obj in (event, cancel, plan, event._action, cancel._action,
+        sunnytrail.Action('pay', 123), cancel._plan):
+      assert not hasattr(obj, '__dict__'), obj
+      self.assertRaises(AttributeError, setattr, obj, 'unknown', 1)
+
+class FastEncoderTest(unittest.TestCase):
+  """ Event.to_json must match simplejson.dumps(event.to_hash()) """
+
+  def assertSameJSON(self, event):
+    self.assertEqual(event.to_json(), simplejson.dumps(event.to_hash()))
+
+  def test_plans(self):
+    for plan in (sunnytrail.Plan('plan'), sunnytrail.Plan('plan', 9.99),
+        sunnytrail.Plan('plan', '49', 30), sunnytrail.Plan('plan', 1e20),
+        sunnytrail.Plan('plan', 1 / 3.0, 365), sunnytrail.Plan(None, 1)):
+      self.assertSameJSON(sunnytrail.SignupEvent('id', 'name', 'email', 
+        plan, 123))
+      self.assertSameJSON(sunnytrail.PayEvent(None, 'name', 'email', 
+        plan))
+
+  def test_non_finite_price(self):
+    event = sunnytrail.SignupEvent('id', 'name', 'email', 
+      sunnytrail.Plan('plan', float('nan')), 123)
+    try:
+      expected = simplejson.dumps(event.to_hash())
+    except ValueError:
+      self.assertRaises(ValueError, event.to_json)
+    else:
+      self.assertEqual(event.to_json(), expected)
+
+  def test_ids(self):
+    for id in (None, 'id', 42, 42L, 10 ** 20, u'\xfcnicode', True, 1.5):
+      self.assertSameJSON(sunnytrail.CancelEvent(id, 'name', 'email'))
+
+  def test_strings_are_escaped(self):
+    for text in ('"quoted"', 'back\\slash', 'new\nline\t', '\x01',
+        'caf\xc3\xa9', u'caf\xe9', u'\u2603 snow', '</script>'):
+      self.assertSameJSON(sunnytrail.SignupEvent(text, text, text, 
+        sunnytrail.Plan(text, 1, 2), 123))
+
+  def test_custom_to_hash_is_honored(self):
+    class TaggedPlan(sunnytrail.Plan):
+      def to_hash(self):
+        ret = super(TaggedPlan, self).to_hash()
+        ret['tag'] = 'custom'
+        return ret
+
+    event = sunnytrail.SignupEvent('id', 'name', 'email', 
+      TaggedPlan('plan'), 123)
+    assert '"tag": "custom"' in event.to_json()
+    self.assertSameJSON(event)
+
+class EventBatchTest(unittest.TestCase):
+
+  def setUp(self):
+    self.columns = dict(
+      ids = ['1', None, 3],
+      names = ['one', 'two', u'thr\xe9\xe9'],
+      emails = ['one@example.com', 'two@example.com', 'three@example.com'],
+      actions = ['signup', 'pay', 'cancel'],
+      plans = ['Basic', 'Pro', None],
+      prices = array.array('d', [0, 49.5, 0]),
+      recurring = [None, 30, None],
+      created = array.array('l', [100, 200, 300]))
+
+  def test_messages_match_event_json(self):
+    batch = sunnytrail.EventBatch(**self.columns)
+
+    self.assertEqual(batch.to_messages(), [
+      sunnytrail.SignupEvent('1', 'one', 'one@example.com', 
+        sunnytrail.Plan('Basic', 0), 100).to_json(),
+      sunnytrail.PayEvent(None, 'two', 'two@example.com', 
+        sunnytrail.Plan('Pro', 49.5, 30), 200).to_json(),
+      sunnytrail.CancelEvent(3, u'thr\xe9\xe9', 'three@example.com', 
+        300).to_json()])
+
+  def test_events(self):
+    batch = sunnytrail.EventBatch(**self.columns)
+
+    self.assertEqual([e.to_json() for e in batch.events()], 
+      batch.to_messages())
+
+  def test_optional_columns(self):
+    now = int(time())
+    batch = sunnytrail.EventBatch(None, ['name'], ['email'], ['cancel'])
+
+    message = simplejson.loads(batch.to_messages()[0])
+    assert 'id' not in message
+    assert message['action']['created'] >= now
+
+  def test_invalid_action(self):
+    self.columns['actions'][1] = 'refund'
+    self.assertRaises(ValueError, sunnytrail.EventBatch, **self.columns)
+
+  def test_invalid_price(self):
+    self.columns['prices'] = [0, 'free', 0]
+    self.assertRaises(ValueError, sunnytrail.EventBatch, **self.columns)
+
+  def test_missing_price(self):
+    self.columns['prices'] = [0, None, 0]
+    self.assertRaises(ValueError, sunnytrail.EventBatch, **self.columns)
+    self.columns['prices'] = [0, float('nan'), 0]
+    self.assertRaises(ValueError, sunnytrail.EventBatch, **self.columns)
+
+  def test_nan_in_int_columns_is_missing(self):
+    self.columns['created'] = [100.0, float('nan'), 300.0]
+    self.columns['recurring'] = [float('nan'), 30.0, float('nan')]
+    batch = sunnytrail.EventBatch(**self.columns)
+
+    self.assertEqual(batch._created, [100, None, 300])
+    self.assertEqual(batch._recurring, [None, 30, None])
+    self.assertEqual(sunnytrail._int_column([0, None], 'created'), 
+      [0, None])
+
+  def test_columns_are_checked_the_same_without_numpy(self):
+    numpy, sunnytrail.numpy = sunnytrail.numpy, None
+    try:
+      for test in (self.test_missing_price, self.test_invalid_price,
+          self.test_nan_in_int_columns_is_missing):
+        self.setUp()
+        test()
+    finally:
+      sunnytrail.numpy = numpy
+
+  def test_numpy_columns(self):
+    if sunnytrail.numpy is None: return
+    numpy = sunnytrail.numpy
+    self.columns['created'] = numpy.array([100.0, numpy.nan, 300.0])
+    self.assertEqual(sunnytrail.EventBatch(**self.columns)._created, 
+      [100, None, 300])
+
+    self.columns['prices'] = numpy.array([0, numpy.nan, 0])
+    self.assertRaises(ValueError, sunnytrail.EventBatch, **self.columns)
+
+  def test_missing_plan(self):
+    self.columns['plans'][0] = None
+    self.assertRaises(ValueError, sunnytrail.EventBatch, **self.columns)
+
+  def test_columns_of_different_length(self):
+    self.columns['emails'].pop()
+    self.assertRaises(ValueError, sunnytrail.EventBatch, **self.columns)
+
+  def test_send_many(self):
+    client = sunnytrail.Sunnytrail('dummykey')
+    opener = TestOpener()
+    client.urlopen = opener.open
+
+    batch = sunnytrail.EventBatch(**self.columns)
+    self.assertEqual(client.send_many(batch), [None] * 3)
+    self.assertEqual(parse_qs(opener._data)['message'], 
+      batch.to_messages())
+
 class TestOpener(object):
   def __init__(self):
     self._url = self._data = None
     self._exception = None
     self._response = None
+    self._requests = []
+    self._headers = []
 
   def should_raise(self, e):
     self._exception = e
@@ -154,11 +799,13 @@ class TestOpener(object):
   def should_respond(self, r):
     self._response = r
 
-  def open(self, url, data):
+  def open(self, url, data, timeouts=None, headers=None):
     if self._exception is not None:
       raise self._exception
 
     self._url, self._data = url, data
+    self._requests.append(data)
+    self._headers.append(headers and dict(headers))
 
     class EmptyResponse(object):
       code = 202
@@ -219,6 +866,1364 @@ class SunnytrailTest(unittest.TestCase):
     self.assertRaises(sunnytrail.ServiceUnavailable,
       self.client.send, self.cancel_event)
 
+class SendManyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.client = sunnytrail.Sunnytrail('dummykey', max_batch_size=2)
+
+    self.opener = TestOpener()
+    self.client.urlopen = self.opener.open
+
+    self.events = [sunnytrail.CancelEvent(str(i), 'name', 'email', 123) \
+      for i in range(5)]
+
+  def test_events_are_packed_in_batches(self):
+    results = self.client.send_many(self.events)
+
+    self.assertEqual(results, [None] * 5)
+    self.assertEqual(len(self.opener._requests), 3)
+
+    messages = [simplejson.loads(m) for data in self.opener._requests \
+      for m in parse_qs(data)['message']]
+    self.assertEqual([m['id'] for m in messages], 
+      ['0', '1', '2', '3', '4'])
+
+  def test_batches_are_bounded_by_size_in_bytes(self):
+    self.client._max_batch_size = 100
+    self.client._max_batch_bytes = 300
+
+    self.client.send_many(self.events)
+
+    assert len(self.opener._requests) > 1
+    assert all(map(lambda d: len(d) <= 300, self.opener._requests))
+
+  def test_rejected_messages_are_mapped_back(self):
+    class InvalidMessages(object):
+      code = 403
+      def close(self): pass
+      def read(self):
+        return '{"message": "invalid message", "errors": '\
+          '[["email", "email should be valid", 1]]}'
+
+    self.opener.should_respond(InvalidMessages())
+    results = self.client.send_many(self.events[:2])
+
+    self.assertEqual(results[0], None)
+    assert isinstance(results[1], sunnytrail.InvalidMessage)
+    self.assertEqual(results[1].errors, 
+      [["email", "email should be valid", 1]])
+
+  def test_unavailable_service_fails_remaining_events(self):
+    self.opener.should_raise(IOError('http error', 503, None, None))
+    results = self.client.send_many(self.events)
+
+    assert all(map(lambda r: isinstance(r, sunnytrail.ServiceUnavailable),
+      results))
+
+  def test_invalid_api_key_is_raised(self):
+    self.opener.should_raise(IOError('http error', 401, None, None))
+
+    self.assertRaises(sunnytrail.InvalidAPIKey, 
+      self.client.send_many, self.events)
+
+class BatchDispatcherTest(unittest.TestCase):
+
+  def setUp(self):
+    self.client = sunnytrail.Sunnytrail('dummykey')
+
+    self.opener = TestOpener()
+    self.client.urlopen = self.opener.open
+
+    self.failures = []
+    self.dispatcher = sunnytrail.BatchDispatcher(self.client, 
+      batch_size=2, flush_interval=60, 
+      on_error=lambda event, e: self.failures.append((event, e)))
+
+    self.event = sunnytrail.CancelEvent('id', 'name', 'email')
+
+  def tearDown(self):
+    self.dispatcher.close(1)
+
+  def test_full_batches_are_sent(self):
+    for i in range(4):
+      self.dispatcher.send(self.event)
+    self.dispatcher.flush(1)
+
+    self.assertEqual(len(self.opener._requests), 2)
+
+  def test_flush_sends_partial_batch(self):
+    self.dispatcher.send(self.event)
+    assert self.dispatcher.flush(1)
+
+    self.assertEqual(len(self.opener._requests), 1)
+
+  def test_partial_batch_is_sent_after_flush_interval(self):
+    self.dispatcher.close(1)
+    self.dispatcher = sunnytrail.BatchDispatcher(self.client, 
+      batch_size=100, flush_interval=0.05)
+
+    self.dispatcher.send(self.event)
+
+    for i in range(50):
+      if self.opener._requests: break
+      sleep(0.02)
+    self.assertEqual(len(self.opener._requests), 1)
+
+  def test_failures_are_reported(self):
+    self.opener.should_raise(IOError('http error', 401, None, None))
+
+    self.dispatcher.send(self.event)
+    self.dispatcher.flush(1)
+
+    self.assertEqual(len(self.failures), 1)
+    assert self.failures[0][0] is self.event
+    assert isinstance(self.failures[0][1], sunnytrail.InvalidAPIKey)
+
+  def test_close_drains_the_queue(self):
+    self.dispatcher.send(self.event)
+    assert self.dispatcher.close(1)
+
+    self.assertEqual(len(self.opener._requests), 1)
+    self.assertRaises(sunnytrail.SunnytrailException,
+      self.dispatcher.send, self.event)
+
+  def test_send_fails_when_queue_is_full(self):
+    self.dispatcher.close(1)
+
+    import threading
+    release = threading.Event()
+    def blocking_open(url, data):
+      release.wait(1)
+      return self.opener.open(url, data)
+    self.client.urlopen = blocking_open
+
+    self.dispatcher = sunnytrail.BatchDispatcher(self.client, 
+      batch_size=1, max_queue_size=1)
+    try:
+      def fill():
+        for i in range(3):
+          self.dispatcher.send(self.event)
+      self.assertRaises(sunnytrail.DispatcherFull, fill)
+    finally:
+      release.set()
+
+  def test_flush_and_close_time_out_on_a_full_queue(self):
+    self.dispatcher.close(1)
+
+    release = threading.Event()
+    def blocking_open(url, data):
+      release.wait(5)
+      return self.opener.open(url, data)
+    self.client.urlopen = blocking_open
+
+    self.dispatcher = sunnytrail.BatchDispatcher(self.client, 
+      batch_size=1, max_queue_size=1)
+    try:
+      self.dispatcher.send(self.event)
+      while self.dispatcher._queue.qsize(): sleep(0.001)
+      self.dispatcher.send(self.event)
+
+      start = time()
+      self.assertEqual(self.dispatcher.flush(0.1), False)
+      self.assertEqual(self.dispatcher.close(0.1), False)
+      assert time() - start < 1
+    finally:
+      release.set()
+    assert self.dispatcher.close(1)
+
+  def test_closed_dispatchers_are_not_kept_for_exit(self):
+    assert id(self.dispatcher) in sunnytrail._exit_closers
+    self.dispatcher.close(1)
+    assert id(self.dispatcher) not in sunnytrail._exit_closers
+
+class RetryPolicyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.delays = []
+    self.sleep, sunnytrail.sleep = sunnytrail.sleep, self.delays.append
+
+    self.responses = []
+    self.client = sunnytrail.Sunnytrail('dummykey', 
+      retry=sunnytrail.RetryPolicy(max_attempts=3, backoff=1))
+    self.client.urlopen = self.open
+
+    self.event = sunnytrail.CancelEvent('id', 'name', 'email')
+
+  def tearDown(self):
+    sunnytrail.sleep = self.sleep
+
+  def open(self, url, data):
+    if isinstance(self.responses[0], Exception):
+      raise self.responses.pop(0)
+    code, headers = self.responses.pop(0)
+
+    class Response(object):
+      def read(self): return ''
+      def close(self): pass
+
+    r = Response()
+    r.code, r.headers = code, headers
+    return r
+
+  def test_unavailable_service_is_retried(self):
+    self.responses = [(503, {}), (503, {}), (202, {})]
+    self.client.send(self.event)
+
+    self.assertEqual(len(self.delays), 2)
+    assert 0 <= self.delays[0] <= 1
+    assert 0 <= self.delays[1] <= 2
+
+  def test_gives_up_after_max_attempts(self):
+    self.responses = [(503, {})] * 3
+
+    self.assertRaises(sunnytrail.ServiceUnavailable,
+      self.client.send, self.event)
+    self.assertEqual(len(self.delays), 2)
+
+  def test_invalid_api_key_is_not_retried(self):
+    self.responses = [(401, {}), (202, {})]
+
+    self.assertRaises(sunnytrail.InvalidAPIKey, 
+      self.client.send, self.event)
+    self.assertEqual(self.delays, [])
+
+  def test_network_errors_are_retried(self):
+    self.responses = [socket.error(104, 'Connection reset by peer'),
+      IOError('socket error', socket.error(111, 'Connection refused')),
+      (202, {})]
+    self.client.send(self.event)
+
+    self.assertEqual(len(self.delays), 2)
+
+  def test_http_errors_are_not_retried(self):
+    self.responses = [IOError('http error', 500, 'Internal Server Error',
+      {}), (202, {})]
+
+    self.assertRaises(sunnytrail.ServerError, self.client.send, self.event)
+    self.assertEqual(self.delays, [])
+
+  def test_retry_after_is_honored(self):
+    self.responses = [(503, {'Retry-After': '7'}), (202, {})]
+    self.client.send(self.event)
+
+    self.assertEqual(self.delays, [7])
+
+  def test_long_retry_after_gives_up(self):
+    self.responses = [(503, {'Retry-After': '86400'}), (202, {})]
+
+    self.assertRaises(sunnytrail.ServiceUnavailable,
+      self.client.send, self.event)
+    self.assertEqual(self.delays, [])
+
+  def test_retry_after_http_date(self):
+    date = sunnytrail.email.utils.formatdate(time() + 60)
+    self.assertTrue(55 < sunnytrail._retry_after({'Retry-After': date}) <= 60)
+
+  def test_no_retry_past_the_deadline(self):
+    self.client._retry.deadline = 5
+    self.responses = [(503, {'Retry-After': '7'}), (202, {})]
+
+    self.assertRaises(sunnytrail.ServiceUnavailable,
+      self.client.send, self.event)
+    self.assertEqual(self.delays, [])
+
+  def test_batches_are_retried(self):
+    self.responses = [(503, {}), (202, {})]
+    results = self.client.send_many([self.event, self.event])
+
+    self.assertEqual(results, [None, None])
+    self.assertEqual(len(self.delays), 1)
+
+class CircuitBreakerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.breaker = sunnytrail.CircuitBreaker(failure_rate=0.5, window=4,
+      min_requests=2, reset_timeout=60)
+    self.client = sunnytrail.Sunnytrail('dummykey', breaker=self.breaker)
+
+    self.opener = TestOpener()
+    self.client.urlopen = self.opener.open
+
+    self.event = sunnytrail.CancelEvent('id', 'name', 'email')
+
+  def fail(self, times):
+    self.opener.should_raise(IOError('http error', 503, None, None))
+    for i in range(times):
+      self.assertRaises(sunnytrail.ServiceUnavailable,
+        self.client.send, self.event)
+    self.opener.should_raise(None)
+
+  def test_opens_when_failure_rate_is_reached(self):
+    self.client.send(self.event)
+    self.fail(1)
+    self.assertEqual(self.breaker.state, 'open')
+
+    self.assertRaises(sunnytrail.CircuitOpen, self.client.send, self.event)
+    self.assertEqual(len(self.opener._requests), 1)
+
+  def test_server_errors_are_failures(self):
+    for response in (IOError('http error', 500, None, None), 
+        sunnytrail.SunnytrailResponse(502, {}, '')):
+      breaker = sunnytrail.CircuitBreaker(min_requests=2)
+      self.client.breaker = breaker
+      self.opener.should_respond(None)
+      self.opener.should_raise(None)
+      if isinstance(response, Exception):
+        self.opener.should_raise(response)
+      else:
+        self.opener.should_respond(response)
+
+      for i in range(2):
+        self.assertRaises(sunnytrail.ServerError, 
+          self.client.send, self.event)
+      self.assertEqual(breaker.state, 'open')
+
+  def test_stays_closed_below_failure_rate(self):
+    for i in range(3):
+      self.client.send(self.event)
+    self.fail(1)
+
+    self.assertEqual(self.breaker.state, 'closed')
+
+  def test_successful_probe_closes_the_circuit(self):
+    self.fail(2)
+    self.breaker.reset_timeout = 0
+    self.assertEqual(self.breaker.state, 'half-open')
+
+    self.client.send(self.event)
+
+    stats = self.breaker.stats()
+    self.assertEqual(stats['state'], 'closed')
+    self.assertEqual(stats['transitions'], 
+      {'open': 1, 'half-open': 1, 'closed': 1})
+
+  def test_failed_probe_opens_the_circuit(self):
+    self.fail(2)
+    self.breaker.reset_timeout = 0
+    self.assertEqual(self.breaker.state, 'half-open')
+
+    self.breaker.reset_timeout = 60
+    self.fail(1)
+
+    self.assertEqual(self.breaker.state, 'open')
+    self.assertEqual(self.breaker.stats()['transitions']['open'], 2)
+
+  def test_invalid_messages_are_not_failures(self):
+    self.opener.should_raise(IOError('http error', 401, None, None))
+    for i in range(3):
+      self.assertRaises(sunnytrail.InvalidAPIKey, 
+        self.client.send, self.event)
+
+    self.assertEqual(self.breaker.state, 'closed')
+
+  def test_open_circuit_is_not_retried(self):
+    self.client._retry = sunnytrail.RetryPolicy(backoff=0.01)
+    self.breaker.min_requests = 1
+    self.breaker.window = 1
+
+    self.opener.should_raise(IOError('http error', 503, None, None))
+    self.assertRaises(sunnytrail.CircuitOpen, self.client.send, self.event)
+
+  def test_open_circuit_diverts_to_spool(self):
+    path = tempfile.mkdtemp()
+    try:
+      self.client._spool = sunnytrail.Spool(path)
+      self.breaker._set_state('open')
+
+      self.client.send(self.event)
+
+      self.assertEqual(len(self.client._spool.read()), 1)
+      self.assertEqual(self.opener._requests, [])
+      self.client._spool.close()
+    finally:
+      shutil.rmtree(path)
+
+class SpoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.spool = sunnytrail.Spool(self.path, segment_size=64)
+
+  def tearDown(self):
+    self.spool.close()
+    shutil.rmtree(self.path)
+
+  def messages(self, records):
+    return [message for message, position in records]
+
+  def test_messages_are_read_in_order_across_segments(self):
+    for i in range(10):
+      self.spool.append('message %d' % i)
+
+    assert len(os.listdir(self.path)) > 2
+    self.assertEqual(self.messages(self.spool.read()),
+      ['message %d' % i for i in range(10)])
+
+  def test_commit_moves_the_cursor_and_deletes_segments(self):
+    for i in range(10):
+      self.spool.append('message %d' % i)
+
+    records = self.spool.read(6)
+    self.spool.commit(records[-1][1])
+
+    self.assertEqual(self.messages(self.spool.read()),
+      ['message %d' % i for i in range(6, 10)])
+    assert '00000001.spool' not in os.listdir(self.path)
+
+  def test_spool_survives_reopening(self):
+    self.spool.extend(['first', 'second', 'third'])
+    self.spool.commit(self.spool.read(1)[0][1])
+    self.spool.close()
+
+    self.spool = sunnytrail.Spool(self.path, segment_size=64)
+    self.spool.append('fourth')
+
+    self.assertEqual(self.messages(self.spool.read()), 
+      ['second', 'third', 'fourth'])
+
+  def test_torn_record_is_skipped(self):
+    self.spool.close()
+    self.spool = sunnytrail.Spool(self.path)
+    self.spool.extend(['first', 'second'])
+    self.spool.close()
+
+    segment = os.path.join(self.path, sorted(os.listdir(self.path))[-1])
+    f = open(segment, 'r+b')
+    f.truncate(os.path.getsize(segment) - 3)
+    f.close()
+
+    self.spool = sunnytrail.Spool(self.path)
+    self.spool.append('third')
+
+    self.assertEqual(self.messages(self.spool.read()), ['first', 'third'])
+
+class SpoolingClientTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.spool = sunnytrail.Spool(self.path)
+    self.client = sunnytrail.Sunnytrail('dummykey', spool=self.spool)
+
+    self.opener = TestOpener()
+    self.client.urlopen = self.opener.open
+
+    self.events = [sunnytrail.CancelEvent(str(i), 'name', 'email', 123) \
+      for i in range(3)]
+
+  def tearDown(self):
+    self.spool.close()
+    shutil.rmtree(self.path)
+
+  def test_unavailable_service_spools_events(self):
+    self.opener.should_raise(IOError('http error', 503, None, None))
+
+    self.client.send(self.events[0])
+    self.assertEqual(self.client.send_many(self.events[1:]), [None, None])
+
+    self.assertEqual([m for m, p in self.spool.read()],
+      [e.to_json() for e in self.events])
+
+  def test_server_errors_are_spooled(self):
+    self.opener.should_respond(sunnytrail.SunnytrailResponse(504, {}, ''))
+
+    self.client.send(self.events[0])
+    self.assertEqual(self.client.send_many(self.events[1:]), [None, None])
+    self.assertEqual(len(self.spool.read()), 3)
+
+  def test_invalid_api_key_is_not_spooled(self):
+    self.opener.should_raise(IOError('http error', 401, None, None))
+
+    self.assertRaises(sunnytrail.InvalidAPIKey, 
+      self.client.send, self.events[0])
+    self.assertEqual(self.spool.read(), [])
+
+  def test_replay_drains_the_spool(self):
+    self.spool.extend([e.to_json() for e in self.events])
+
+    replayer = sunnytrail.SpoolReplayer(self.client, self.spool)
+    self.assertEqual(replayer.replay(), 3)
+
+    self.assertEqual(self.spool.read(), [])
+    self.assertEqual(len(self.opener._requests), 1)
+
+  def test_replay_stops_when_service_is_unavailable(self):
+    self.spool.extend([e.to_json() for e in self.events])
+    self.opener.should_raise(IOError('http error', 503, None, None))
+
+    replayer = sunnytrail.SpoolReplayer(self.client, self.spool)
+    self.assertEqual(replayer.replay(), 0)
+
+    self.assertEqual(len(self.spool.read()), 3)
+
+  def test_replay_isolates_messages_of_rejected_requests(self):
+    events = [sunnytrail.CancelEvent(str(i), 'name', 'email', 123) \
+      for i in range(5)]
+    events[3] = sunnytrail.CancelEvent('3', 'bad', 'email', 123)
+    self.spool.extend([e.to_json() for e in events])
+
+    sent = []
+    def open(url, data):
+      response = sunnytrail.SunnytrailResponse(202, {}, '')
+      if 'bad' in data:
+        response = sunnytrail.SunnytrailResponse(403, {}, 
+          '{"errors": [["name", "is bad"]]}')
+      else:
+        sent.extend(parse_qs(data)['message'])
+      return response
+    self.client.urlopen = open
+
+    replayer = sunnytrail.SpoolReplayer(self.client, self.spool)
+    self.assertEqual(replayer.replay(), 5)
+
+    self.assertEqual(self.spool.read(), [])
+    self.assertEqual(sorted(sent), 
+      sorted([e.to_json() for e in events if e is not events[3]]))
+
+class ImportTest(unittest.TestCase):
+
+  def setUp(self):
+    self.client = sunnytrail.Sunnytrail('dummykey')
+
+    self.opener = TestOpener()
+    self.client.urlopen = self.opener.open
+
+  def sent_messages(self):
+    return [simplejson.loads(m) for data in self.opener._requests \
+      for m in parse_qs(data)['message']]
+
+  def test_jsonl_records(self):
+    f = StringIO(
+      '{"id": "1", "name": "one", "email": "one@example.com", '\
+        '"action": "signup", "plan": "Basic", "price": 9.99, '\
+        '"recurring": 30, "created": 100}\n'\
+      '\n'\
+      '{"name": "two", "email": "two@example.com", "action": "cancel"}\n')
+
+    stats = sunnytrail.import_records(self.client, 
+      sunnytrail.read_records(f))
+
+    self.assertEqual(str(stats), '2 sent, 0 rejected, 0 failed')
+    self.assertEqual([m['action']['name'] for m in self.sent_messages()],
+      ['signup', 'cancel'])
+
+  def test_records_in_the_wire_format(self):
+    events = [sunnytrail.PayEvent('1', 'one', 'one@example.com', 
+        sunnytrail.Plan('Basic', 9.99, 30), 100),
+      sunnytrail.CancelEvent(None, 'two', 'two@example.com', 200)]
+
+    stats = sunnytrail.import_records(self.client, 
+      [e.to_json() + '\n' for e in events])
+
+    self.assertEqual(stats.sent, 2)
+    self.assertEqual(self.sent_messages(), 
+      [simplejson.loads(e.to_json()) for e in events])
+
+  def test_csv_records(self):
+    f = StringIO('id,name,email,action,plan,price,recurring,created\n'\
+      '1,one,one@example.com,pay,Basic,9.99,,100\n'\
+      ',two,two@example.com,cancel,,,,200\n')
+
+    stats = sunnytrail.import_records(self.client, 
+      sunnytrail.read_records(f, 'csv'))
+
+    self.assertEqual(stats.sent, 2)
+    first, second = self.sent_messages()
+    self.assertEqual(first['plan'], {'name': 'Basic', 'price': 9.99})
+    assert 'id' not in second
+
+  def test_bad_records_are_rejected(self):
+    f = StringIO('not json\n'\
+      '{"name": "one", "email": "one@example.com", "action": "refund"}\n'\
+      '{"name": "two", "email": "two@example.com", "action": "cancel"}\n')
+
+    stats = sunnytrail.import_records(self.client, 
+      sunnytrail.read_records(f))
+    self.assertEqual(str(stats), '1 sent, 2 rejected, 0 failed')
+
+  def test_records_are_sent_in_batches(self):
+    records = ['{"name": "n", "email": "e", "action": "cancel"}'] * 5
+
+    stats = sunnytrail.import_records(self.client, iter(records), 2)
+
+    self.assertEqual(stats.sent, 5)
+    self.assertEqual(len(self.opener._requests), 3)
+
+  def test_failures_are_counted(self):
+    self.opener.should_raise(IOError('http error', 503, None, None))
+    records = ['{"name": "n", "email": "e", "action": "cancel"}'] * 3
+
+    stats = sunnytrail.import_records(self.client, iter(records))
+    self.assertEqual(stats.failed, 3)
+
+class BackfillTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'events.jsonl')
+    self.opener = TestOpener()
+
+    f = open(self.path, 'wb')
+    for i in range(50):
+      f.write('{"id": "%d", "name": "n", "email": "e", '\
+        '"action": "cancel"}\n' % i)
+    f.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def client(self):
+    client = sunnytrail.Sunnytrail('dummykey')
+    client.urlopen = self.opener.open
+    return client
+
+  def backfill(self, **kwargs):
+    return sunnytrail.Backfill(self.path, self.client, batch_size=4, 
+      **kwargs)
+
+  def sent_ids(self):
+    return [simplejson.loads(m)['id'] for data in self.opener._requests \
+      for m in parse_qs(data)['message']]
+
+  def test_shards_are_sent_in_parallel(self):
+    stats = self.backfill(shards=3).run()
+
+    self.assertEqual(str(stats), '50 sent, 0 rejected, 0 failed')
+    self.assertEqual(sorted(self.sent_ids(), key=int), 
+      [str(i) for i in range(50)])
+    self.assertEqual(len(os.listdir(os.path.join(self.dir, 
+      'events.jsonl.backfill'))), 1 + 3 * 2)
+
+  def test_rerun_resumes_from_checkpoints(self):
+    sent = []
+    def crashing_open(url, data):
+      if len(sent) == 3: raise RuntimeError('crash')
+      sent.append(data)
+      return self.opener.open(url, data)
+
+    def crashing_client():
+      client = self.client()
+      client.urlopen = crashing_open
+      return client
+
+    backfill = sunnytrail.Backfill(self.path, crashing_client, 
+      shards=1, batch_size=4)
+    self.assertRaises(RuntimeError, backfill.run)
+    self.assertEqual(len(self.sent_ids()), 12)
+
+    stats = self.backfill(shards=1).run()
+    self.assertEqual(stats.sent, 50)
+    self.assertEqual(sorted(self.sent_ids(), key=int), 
+      [str(i) for i in range(50)])
+
+    self.backfill(shards=1).run()
+    self.assertEqual(len(self.sent_ids()), 50)
+
+  def test_rejects_are_written(self):
+    class InvalidMessages(object):
+      code = 403
+      def close(self): pass
+      def read(self):
+        return '{"message": "invalid message", "errors": '\
+          '[["email", "email should be valid", 0]]}'
+
+    f = open(self.path, 'ab')
+    f.write('not json\n')
+    f.close()
+
+    self.opener.should_respond(InvalidMessages())
+    stats = self.backfill(shards=2).run()
+    self.assertEqual(stats.rejected, 14)
+
+    rejects = open(os.path.join(self.dir, 'events.jsonl.rejects')
+      ).readlines()
+    self.assertEqual(len(rejects), 14)
+    self.assertEqual(rejects[-1], 'not json\n')
+    self.assertEqual(simplejson.loads(rejects[0])['id'], '0')
+
+  def test_unsent_batches_are_sent_by_the_next_run(self):
+    self.opener.should_raise(IOError('http error', 503, None, None))
+    stats = self.backfill(shards=2).run()
+    self.assertEqual(stats.sent, 0)
+    self.assertEqual(stats.failed, 8)
+    self.assertEqual(open(os.path.join(self.dir, 
+      'events.jsonl.rejects')).read(), '')
+
+    self.opener.should_raise(None)
+    stats = self.backfill(shards=2).run()
+    self.assertEqual(str(stats), '50 sent, 0 rejected, 0 failed')
+    self.assertEqual(sorted(self.sent_ids(), key=int), 
+      [str(i) for i in range(50)])
+
+  def test_csv_header_is_kept_out_of_shards(self):
+    self.path = os.path.join(self.dir, 'events.csv')
+    f = open(self.path, 'wb')
+    f.write('id,name,email,action\n')
+    for i in range(10):
+      f.write('%d,n,e,cancel\n' % i)
+
+    f.write('11,n,e,refund\n')
+    f.close()
+
+    stats = self.backfill(shards=4).run()
+    self.assertEqual(stats.sent, 10)
+    self.assertEqual(sorted(self.sent_ids(), key=int), 
+      [str(i) for i in range(10)])
+    self.assertEqual(open(os.path.join(self.dir, 'events.csv.rejects')
+      ).read(), 'id,name,email,action\n11,n,e,refund\n')
+
+  def test_changed_input_is_refused(self):
+    self.backfill(shards=2).run()
+
+    f = open(self.path, 'ab')
+    f.write('{"name": "n", "email": "e", "action": "cancel"}\n')
+    f.close()
+    self.assertRaises(ValueError, self.backfill(shards=2).run)
+
+class RelayTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.client = sunnytrail.Sunnytrail('dummykey')
+    self.opener = TestOpener()
+    self.client.urlopen = self.opener.open
+
+    self.events = [sunnytrail.CancelEvent(str(i), 'name', 'email', 123) \
+      for i in range(5)]
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def relay(self, address):
+    import threading
+    relay = sunnytrail.Relay(self.client, address, flush_interval=0.05)
+    thread = threading.Thread(target=relay.serve_forever)
+    thread.start()
+    return relay, thread
+
+  def sent_messages(self):
+    return [m for data in self.opener._requests \
+      for m in parse_qs(data)['message']]
+
+  def check_relayed(self, address):
+    relay, thread = self.relay(address)
+    producer = sunnytrail.RelayClient(relay.address)
+    for event in self.events:
+      producer.send(event)
+    producer.close()
+
+    deadline = time() + 5
+    while relay.received < len(self.events) and time() < deadline:
+      sleep(0.001)
+    assert relay.flush(5)
+    relay.close()
+    thread.join()
+
+    self.assertEqual(self.sent_messages(), 
+      [e.to_json() for e in self.events])
+    self.assertEqual(len(self.opener._requests), 1)
+
+  def test_events_are_relayed_in_batches(self):
+    address = os.path.join(self.dir, 'relay.sock')
+    self.check_relayed(address)
+    assert not os.path.exists(address)
+
+  def test_socket_is_private(self):
+    address = os.path.join(self.dir, 'relay.sock')
+    relay = sunnytrail.Relay(self.client, address)
+    try:
+      self.assertEqual(os.stat(address).st_mode & 0777, 0600)
+    finally:
+      relay.close()
+
+  def test_other_files_are_not_replaced(self):
+    address = os.path.join(self.dir, 'events.jsonl')
+    open(address, 'w').write('{}')
+
+    self.assertRaises(ValueError, sunnytrail.Relay, self.client, address)
+    self.assertEqual(open(address).read(), '{}')
+
+  def test_udp_relay(self):
+    self.check_relayed(('127.0.0.1', 0))
+
+  def test_missing_relay(self):
+    producer = sunnytrail.RelayClient(os.path.join(self.dir, 'none.sock'))
+    self.assertRaises(sunnytrail.ServiceUnavailable, 
+      producer.send, self.events[0])
+
+class CompressionTest(unittest.TestCase):
+
+  def setUp(self):
+    self.opener = TestOpener()
+    self.events = [sunnytrail.SignupEvent(str(i), 'name', 'email', 
+      sunnytrail.Plan('Basic', 9.99, 30), 123) for i in range(20)]
+
+  def client(self, **kwargs):
+    client = sunnytrail.Sunnytrail('dummykey', **kwargs)
+    client.urlopen = self.opener.open
+    return client
+
+  def test_large_bodies_are_compressed(self):
+    import zlib
+    client = self.client(compression='gzip')
+    client.send_many(self.events)
+
+    self.assertEqual(self.opener._headers, [{'Content-Encoding': 'gzip'}])
+    body = zlib.decompress(self.opener._data, 16 + zlib.MAX_WBITS)
+    self.assertEqual(len(parse_qs(body)['message']), 20)
+    assert len(self.opener._data) < len(body) / 4
+
+  def test_deflate(self):
+    import zlib
+    client = self.client(compression='deflate', compression_level=9,
+      min_compress_size=0)
+    client.send(self.events[0])
+
+    self.assertEqual(self.opener._headers, 
+      [{'Content-Encoding': 'deflate'}])
+    assert 'message' in parse_qs(zlib.decompress(self.opener._data))
+
+  def test_small_bodies_are_sent_as_is(self):
+    client = self.client(compression='gzip')
+    client.send(self.events[0])
+
+    self.assertEqual(self.opener._headers, [None])
+    assert 'message' in parse_qs(self.opener._data)
+
+  def test_preset_dictionary(self):
+    dictionary = sunnytrail.PresetDictionary(['Basic', 'Premium'])
+    client = self.client(dictionary=dictionary)
+    client.send(self.events[0])
+
+    self.assertEqual(self.opener._headers, [{'Content-Encoding': 'deflate',
+      'X-Sunnytrail-Dictionary': '%08x' % dictionary.id}])
+    body = dictionary.decompress(self.opener._data)
+    self.assertEqual(parse_qs(body)['message'], [self.events[0].to_json()])
+    assert len(self.opener._data) < len(body) / 4
+
+  def test_preset_dictionary_streams_are_standard(self):
+    import zlib
+    dictionary = sunnytrail.PresetDictionary()
+    stream = dictionary.compress('message=' + self.events[0].to_json(), 9)
+
+    self.assertEqual((ord(stream[0]) << 8 | ord(stream[1])) % 31, 0)
+    self.assertEqual(stream[2:6], 
+      struct.pack('>I', zlib.adler32(dictionary.data) & 0xffffffff))
+    self.assertRaises(zlib.error, 
+      sunnytrail.PresetDictionary(['other']).decompress, stream)
+    self.assertRaises(zlib.error, dictionary.decompress, 
+      stream[:-1] + chr(ord(stream[-1]) ^ 1))
+
+  def test_unknown_dictionary_falls_back(self):
+    class Response(object):
+      def __init__(self, code): self.code = code
+      def read(self): return ''
+      def close(self): pass
+
+    responses = [Response(415), Response(202)]
+    def open(url, data, timeouts=None, headers=None):
+      self.opener.open(url, data, timeouts, headers)
+      return responses.pop(0)
+
+    client = self.client(dictionary=sunnytrail.PresetDictionary())
+    client.urlopen = open
+    client.send(self.events[0])
+
+    self.assertEqual(self.opener._headers[1], None)
+    assert 'message' in parse_qs(self.opener._data)
+    self.assertEqual(client._dictionary, None)
+
+  def fallback_client(self, codes):
+    class Response(object):
+      def __init__(self, code): self.code = code
+      def read(self): return ''
+      def close(self): pass
+
+    responses = [Response(code) for code in codes]
+    def open(url, data, timeouts=None, headers=None):
+      self.opener.open(url, data, timeouts, headers)
+      return responses.pop(0)
+
+    client = self.client(dictionary=sunnytrail.PresetDictionary())
+    client.urlopen = open
+    return client
+
+  def test_dictionary_refused_with_400_falls_back(self):
+    client = self.fallback_client([400, 202])
+    client.send(self.events[0])
+
+    self.assertEqual(self.opener._headers[1], None)
+    self.assertEqual(client._dictionary, None)
+
+  def test_bad_requests_keep_the_dictionary(self):
+    client = self.fallback_client([400, 400])
+    dictionary = client._dictionary
+
+    self.assertRaises(sunnytrail.BadRequest, client.send, self.events[0])
+    assert client._dictionary is dictionary
+
+  def test_failed_resend_keeps_the_dictionary(self):
+    client = self.fallback_client([400, 503])
+    dictionary = client._dictionary
+
+    self.assertRaises(sunnytrail.ServiceUnavailable, client.send, 
+      self.events[0])
+    assert client._dictionary is dictionary
+
+  def test_default_compression_level(self):
+    import zlib
+    dictionary = sunnytrail.PresetDictionary()
+    stream = dictionary.compress('message=x', zlib.Z_DEFAULT_COMPRESSION)
+
+    self.assertEqual(ord(stream[1]) >> 6, 2)
+    self.assertEqual(stream, dictionary.compress('message=x', 6))
+
+  def test_invalid_settings(self):
+    self.assertRaises(ValueError, sunnytrail.Sunnytrail, 'key', 
+      compression='br')
+    self.assertRaises(ValueError, sunnytrail.Sunnytrail, 'key', 
+      compression='gzip', keep_alive=False)
+    self.assertRaises(ValueError, sunnytrail.Sunnytrail, 'key', 
+      compression='gzip', dictionary=sunnytrail.PresetDictionary())
+
+class JSONBodyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.client = sunnytrail.Sunnytrail('dummykey', json_bodies=True,
+      max_batch_size=2)
+    self.opener = TestOpener()
+    self.client.urlopen = self.opener.open
+
+    self.events = [sunnytrail.CancelEvent(str(i), 'name', 'email', 123) \
+      for i in range(3)]
+
+  def test_single_event_is_an_object(self):
+    self.client.send(self.events[0])
+
+    self.assertEqual(self.opener._data, self.events[0].to_json())
+    self.assertEqual(self.opener._headers, 
+      [{'Content-Type': 'application/json'}])
+
+  def test_batches_are_arrays(self):
+    self.assertEqual(self.client.send_many(self.events), [None] * 3)
+
+    batches = [simplejson.loads(data) for data in self.opener._requests]
+    self.assertEqual([[m['id'] for m in b] for b in batches[:1]], 
+      [['0', '1']])
+    self.assertEqual(batches[1]['id'], '2')
+
+  def test_remaining_batches_fall_back_to_forms(self):
+    def open(url, data, timeouts=None, headers=None):
+      self.opener.open(url, data, timeouts, headers)
+      if headers and dict(headers).get('Content-Type') == \
+          'application/json':
+        return sunnytrail.SunnytrailResponse(415, {}, '')
+      return sunnytrail.SunnytrailResponse(202, {}, '')
+    self.client.urlopen = open
+    self.client._max_batch_size = 1
+
+    self.assertEqual(self.client.send_many(self.events), [None] * 3)
+    self.assertEqual(len(self.opener._requests), 4)
+    self.assertEqual([parse_qs(data)['message'] for data in 
+      self.opener._requests[1:]], [[e.to_json()] for e in self.events])
+
+  def test_json_bodies_are_compressed(self):
+    self.client = sunnytrail.Sunnytrail('dummykey', json_bodies=True,
+      dictionary=sunnytrail.PresetDictionary())
+    self.client.urlopen = self.opener.open
+    self.client.send(self.events[0])
+
+    headers = self.opener._headers[0]
+    self.assertEqual(headers['Content-Type'], 'application/json')
+    self.assertEqual(headers['Content-Encoding'], 'deflate')
+
+class QuoteTest(unittest.TestCase):
+
+  def check(self, s, safe='/'):
+    import urllib as reference
+    self.assertEqual(urllib.quote(s, safe), reference.quote(s, safe))
+    self.assertEqual(urllib.quote_plus(s, safe), 
+      reference.quote_plus(s, safe))
+
+  def test_messages(self):
+    self.check(sunnytrail.SignupEvent('1', 'User 100%', 'user@example.com',
+      sunnytrail.Plan('Basic', 9.99, 30), 1300000000).to_json())
+
+  def test_safe_characters(self):
+    self.check('abc-def_0.9')
+    self.check('a/b c%d', ' %/')
+    self.check('')
+
+  def test_every_byte(self):
+    self.check(''.join(map(chr, range(256))) * 2)
+    self.check(''.join(map(chr, range(256)))[:40], '')
+
+  def test_unicode(self):
+    self.check(u'abc def')
+
+  def test_urlencode(self):
+    self.assertEqual(urllib.urlencode([('message', 'a b&c'), (1, 2.5)]),
+      'message=a+b%26c&1=2.5')
+
+class ThreadPoolSenderTest(unittest.TestCase):
+
+  def setUp(self):
+    self.opener = TestOpener()
+    self.events = [sunnytrail.CancelEvent(str(i), 'name', 'email', 123) \
+      for i in range(10)]
+    self.sender = None
+
+  def tearDown(self):
+    if self.sender is not None:
+      self.sender.close()
+
+  def client(self):
+    client = sunnytrail.Sunnytrail('dummykey')
+    client.urlopen = self.opener.open
+    return client
+
+  def test_send_returns_futures(self):
+    self.sender = sunnytrail.ThreadPoolSender(self.client, workers=3)
+    futures = [self.sender.send(event) for event in self.events]
+
+    self.assertEqual([f.result(5) for f in futures], [None] * 10)
+    self.assertEqual(len(self.opener._requests), 10)
+
+  def test_errors_are_reported_through_futures(self):
+    class InvalidMessage(object):
+      code = 403
+      def close(self): pass
+      def read(self):
+        return '{"message": "invalid message", "errors": '\
+          '[["email", "email should be valid"]]}'
+    self.opener.should_respond(InvalidMessage())
+
+    self.sender = sunnytrail.ThreadPoolSender(self.client, workers=2)
+    future = self.sender.send(self.events[0])
+
+    assert isinstance(future.exception(5), sunnytrail.InvalidMessage)
+    self.assertRaises(sunnytrail.InvalidMessage, future.result)
+
+  def test_send_many_returns_a_future_per_batch(self):
+    self.sender = sunnytrail.ThreadPoolSender(self.client, workers=2,
+      batch_size=4)
+    futures = self.sender.send_many(iter(self.events))
+
+    self.assertEqual([f.result(5) for f in futures], 
+      [[None] * 4, [None] * 4, [None] * 2])
+
+  def test_in_flight_requests_are_bounded(self):
+    import threading
+    lock, state = threading.Lock(), {'now': 0, 'max': 0}
+
+    def slow_open(url, data):
+      lock.acquire()
+      state['now'] += 1
+      state['max'] = max(state['max'], state['now'])
+      lock.release()
+      sleep(0.01)
+      lock.acquire()
+      state['now'] -= 1
+      lock.release()
+      return self.opener.open(url, data)
+
+    def client():
+      client = self.client()
+      client.urlopen = slow_open
+      return client
+
+    self.sender = sunnytrail.ThreadPoolSender(client, workers=4, 
+      max_in_flight=2)
+    futures = [self.sender.send(event) for event in self.events]
+    for f in futures: f.result(5)
+
+    self.assertEqual(state['max'], 2)
+
+  def test_full_sender_fails_fast_and_close_times_out(self):
+    release = threading.Event()
+    def blocking_open(url, data):
+      release.wait(5)
+      return self.opener.open(url, data)
+
+    def client():
+      client = self.client()
+      client.urlopen = blocking_open
+      return client
+
+    sender = sunnytrail.ThreadPoolSender(client, workers=1, 
+      max_in_flight=1)
+    try:
+      sender.send(self.events[0])
+      self.assertRaises(sunnytrail.DispatcherFull, sender.send, 
+        self.events[1], False)
+      self.assertRaises(sunnytrail.DispatcherFull, sender.send, 
+        self.events[1], True, 0.05)
+
+      start = time()
+      self.assertEqual(sender.close(True, 0.1), False)
+      assert time() - start < 1
+    finally:
+      release.set()
+    assert sender.close(True, 5)
+
+  def test_fallback_future(self):
+    future, called = sunnytrail._Future(), []
+    future.add_done_callback(called.append)
+
+    self.assertRaises(sunnytrail.TimeoutError, future.result, 0.01)
+    self.assertEqual(future.running(), False)
+    assert future.set_running_or_notify_cancel()
+    self.assertEqual(future.running(), True)
+    future.set_result(42)
+    self.assertEqual(future.running(), False)
+
+    self.assertEqual(future.result(), 42)
+    self.assertEqual(called, [future])
+    future.add_done_callback(called.append)
+    self.assertEqual(len(called), 2)
+
+class SendAsyncTest(unittest.TestCase):
+
+  def setUp(self):
+    self.client = sunnytrail.Sunnytrail('dummykey', async_workers=2)
+    self.opener = TestOpener()
+    self.client.urlopen = self.opener.open
+    self.event = sunnytrail.CancelEvent('id', 'name', 'email', 123)
+
+  def tearDown(self):
+    self.client.close()
+
+  def test_send_async(self):
+    futures = [self.client.send_async(self.event) for i in range(5)]
+
+    self.assertEqual([f.result(5) for f in futures], [None] * 5)
+    self.assertEqual(len(self.opener._requests), 5)
+
+  def test_errors_reach_the_callback(self):
+    self.opener.should_raise(IOError('http error', 401, None, None))
+    done = []
+
+    future = self.client.send_async(self.event, done.append)
+    assert isinstance(future.exception(5), sunnytrail.InvalidAPIKey)
+    deadline = time() + 5
+    while not done and time() < deadline:
+      sleep(0.001)
+    self.assertEqual(done, [future])
+
+  def test_close_waits_for_pending_events(self):
+    for i in range(5):
+      self.client.send_async(self.event)
+    self.client.close()
+
+    self.assertEqual(len(self.opener._requests), 5)
+    self.assertEqual(self.client._async_sender, None)
+
+  def test_workers_leave_the_client_open(self):
+    closed = []
+    self.client._pool.close = lambda: closed.append(True)
+
+    self.client.send_async(self.event).result(5)
+    self.client.close()
+    self.assertEqual(closed, [True])
+
+  def test_send_async_fails_fast_when_full(self):
+    release = threading.Event()
+    def blocking_open(url, data):
+      release.wait(5)
+      return self.opener.open(url, data)
+    self.client.urlopen = blocking_open
+
+    try:
+      futures = [self.client.send_async(self.event) for i in range(8)]
+      start = time()
+      self.assertRaises(sunnytrail.DispatcherFull, 
+        self.client.send_async, self.event)
+      assert time() - start < 1
+      self.assertEqual(self.client.metrics()['sunnytrail_async_pending'],
+        {(): 8})
+
+      start = time()
+      self.assertEqual(self.client.close(0.1), False)
+      assert time() - start < 1
+    finally:
+      release.set()
+    for future in futures:
+      future.result(5)
+
+  def test_exit_hook_is_registered_once(self):
+    for i in range(3):
+      self.client.send_async(self.event).result(5)
+      assert id(self.client) in sunnytrail._exit_closers
+      self.client.close()
+      assert id(self.client) not in sunnytrail._exit_closers
+
+class MetricsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.client = sunnytrail.Sunnytrail('dummykey')
+    self.opener = TestOpener()
+    self.client.urlopen = self.opener.open
+    self.signup = sunnytrail.SignupEvent('id', 'name', 'email', 
+      sunnytrail.Plan('Basic', 9.99), 123)
+    self.cancel = sunnytrail.CancelEvent('id', 'name', 'email', 123)
+
+  def counter(self, name, action):
+    return self.client.metrics().get(name, {}).get((('action', action),))
+
+  def test_shards_of_all_threads_are_merged(self):
+    registry = sunnytrail.MetricsRegistry()
+    def work():
+      for i in range(100):
+        registry.add('requests_total', (('host', 'a'),))
+      registry.observe('latency_seconds', (), 0.003)
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for thread in threads: thread.start()
+    work()
+    for thread in threads: thread.join()
+
+    snapshot = registry.snapshot()
+    self.assertEqual(snapshot['requests_total'], {(('host', 'a'),): 500})
+    histogram = snapshot['latency_seconds'][()]
+    self.assertEqual(histogram.count, 5)
+    self.assertAlmostEqual(histogram.sum, 0.015)
+    self.assertEqual(histogram.quantile(0.5), 0.003)
+    # the shards of finished threads survive them
+    self.assertEqual(registry.snapshot()['requests_total'], 
+      {(('host', 'a'),): 500})
+
+  def test_shards_of_finished_threads_are_folded(self):
+    registry = sunnytrail.MetricsRegistry()
+    for i in range(20):
+      thread = threading.Thread(target=registry.add, args=('sends_total',))
+      thread.start()
+      thread.join()
+
+    assert len(registry._shards) <= 1
+    self.assertEqual(registry.snapshot()['sends_total'], {(): 20})
+
+  def test_log_linear_buckets(self):
+    registry = sunnytrail.MetricsRegistry()
+    for value in (0.00005, 0.0012, 0.002, 0.25, 500):
+      registry.observe('latency_seconds', (), value)
+    histogram = registry.snapshot()['latency_seconds'][()]
+
+    self.assertEqual(histogram.bounds[:3], [0.0001, 0.0002, 0.0003])
+    counts = dict([(b, c) for b, c in zip(histogram.bounds + ['inf'], 
+      histogram.counts) if c])
+    self.assertEqual(counts, {0.0001: 1, 0.002: 2, 0.3: 1, 'inf': 1})
+    self.assertEqual(histogram.quantile(1), float('inf'))
+
+  def test_prometheus_text(self):
+    registry = sunnytrail.MetricsRegistry(bounds=[0.1, 1.0])
+    registry.add('sunnytrail_events_sent_total', (('action', 'pay'),), 2)
+    registry.add('sunnytrail_requests_in_flight', (), 1)
+    registry.observe('sunnytrail_send_duration_seconds', 
+      (('call', 'send'),), 0.5)
+
+    self.assertEqual(sunnytrail.prometheus_text(registry.snapshot()), 
+      '# HELP sunnytrail_events_sent_total Events accepted by the collector\n'
+      '# TYPE sunnytrail_events_sent_total counter\n'
+      'sunnytrail_events_sent_total{action="pay"} 2\n'
+      '# HELP sunnytrail_requests_in_flight '
+        'Requests to the collector in progress\n'
+      '# TYPE sunnytrail_requests_in_flight gauge\n'
+      'sunnytrail_requests_in_flight 1\n'
+      '# HELP sunnytrail_send_duration_seconds '
+        'Duration of send() and send_many() calls and spool replays, '
+        'retries included\n'
+      '# TYPE sunnytrail_send_duration_seconds histogram\n'
+      'sunnytrail_send_duration_seconds_bucket{call="send",le="0.1"} 0\n'
+      'sunnytrail_send_duration_seconds_bucket{call="send",le="1.0"} 1\n'
+      'sunnytrail_send_duration_seconds_bucket{call="send",le="+Inf"} 1\n'
+      'sunnytrail_send_duration_seconds_sum{call="send"} 0.5\n'
+      'sunnytrail_send_duration_seconds_count{call="send"} 1\n')
+
+  def test_sent_events_are_counted_by_action(self):
+    self.client.send(self.signup)
+    self.client.send_many([self.cancel, self.cancel])
+
+    self.assertEqual(self.counter('sunnytrail_events_sent_total', 
+      'signup'), 1)
+    self.assertEqual(self.counter('sunnytrail_events_sent_total', 
+      'cancel'), 2)
+
+    metrics = self.client.metrics()
+    self.assertEqual(metrics['sunnytrail_sends_in_flight'], {(): 0})
+    self.assertEqual(metrics['sunnytrail_requests_in_flight'], {(): 0})
+    self.assertEqual(metrics['sunnytrail_send_duration_seconds']
+      [(('call', 'send_many'),)].count, 1)
+    self.assertEqual(metrics['sunnytrail_request_duration_seconds'][()]
+      .count, 2)
+
+  def test_rejected_and_failed_events(self):
+    self.opener.should_raise(IOError('http error', 401, None, None))
+    self.assertRaises(sunnytrail.InvalidAPIKey, 
+      self.client.send, self.signup)
+    self.opener.should_raise(IOError('http error', 503, None, None))
+    self.assertRaises(sunnytrail.ServiceUnavailable, 
+      self.client.send, self.cancel)
+    self.client.send_many([self.cancel])
+
+    self.assertEqual(self.counter('sunnytrail_events_rejected_total', 
+      'signup'), 1)
+    self.assertEqual(self.counter('sunnytrail_events_failed_total', 
+      'cancel'), 2)
+    self.assertEqual(self.client.metrics().get(
+      'sunnytrail_events_sent_total'), None)
+
+  def test_retried_and_spooled_events(self):
+    path = tempfile.mkdtemp()
+    try:
+      self.client._spool = sunnytrail.Spool(path)
+      self.client._retry = sunnytrail.RetryPolicy(max_attempts=3, 
+        backoff=0.001)
+      self.opener.should_raise(IOError('http error', 503, None, None))
+
+      self.client.send(self.signup)
+      self.client.send_many([self.cancel])
+
+      self.assertEqual(self.counter('sunnytrail_events_retried_total', 
+        'signup'), 2)
+      self.assertEqual(self.counter('sunnytrail_events_spooled_total', 
+        'signup'), 1)
+      self.assertEqual(self.counter('sunnytrail_events_spooled_total', 
+        'cancel'), 1)
+      self.assertEqual(self.client.metrics().get(
+        'sunnytrail_events_failed_total'), None)
+      self.client._spool.close()
+    finally:
+      shutil.rmtree(path)
+
+  def test_replays_are_not_failures(self):
+    path = tempfile.mkdtemp()
+    try:
+      spool = sunnytrail.Spool(path)
+      spool.extend([self.cancel.to_json()] * 2)
+      replayer = sunnytrail.SpoolReplayer(self.client, spool)
+
+      self.opener.should_raise(IOError('http error', 503, None, None))
+      self.assertEqual(replayer.replay(), 0)
+      self.assertEqual(self.client.metrics().get(
+        'sunnytrail_events_failed_total'), None)
+
+      self.opener.should_raise(None)
+      self.assertEqual(replayer.replay(), 2)
+      self.assertEqual(self.counter('sunnytrail_events_sent_total', 
+        'cancel'), 2)
+      self.assertEqual(self.client.metrics()
+        ['sunnytrail_send_duration_seconds'][(('call', 'replay'),)].count,
+        2)
+      spool.close()
+    finally:
+      shutil.rmtree(path)
+
+  def test_async_pending_events(self):
+    futures = [self.client.send_async(self.cancel) for i in range(3)]
+    self.client.close()
+
+    self.assertEqual([f.result(5) for f in futures], [None] * 3)
+    self.assertEqual(self.client.metrics()['sunnytrail_async_pending'], 
+      {(): 0})
+
 if __name__ == '__main__':
   unittest.main()
 